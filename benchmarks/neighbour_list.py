@@ -0,0 +1,59 @@
+'''
+benchmarks the cached neighbour list used for social distancing and
+infection against population size
+
+Moves a population around the way the motion kernel does, at the density
+of the default simulation (2000 people in a world of 2 by 2), and reports
+per population size the time per timestep spent updating and querying the
+neighbour list, the number of cached pairs and the memory they take.
+Time per agent should stay about flat as the population grows.
+
+usage: python benchmarks/neighbour_list.py [pop_size ...]
+'''
+
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import Configuration
+from spatial import Neighbour_list
+
+
+def benchmark(pop_size, steps=50, warmup=5, speed=0.01):
+    '''returns seconds per timestep, number of cached pairs and their bytes'''
+    Config = Configuration()
+    size = 2 * np.sqrt(pop_size / 2000)
+    rng = np.random.default_rng(0)
+
+    population = np.zeros((pop_size, 15))
+    population[:,1:3] = rng.uniform(0, size, (pop_size, 2))
+    population[:,3:5] = rng.normal(0, 1/3, (pop_size, 2))
+    population[:,5] = np.clip(rng.normal(speed, speed / 3, pop_size), 0.0001, 0.05)
+
+    neighbour_list = Neighbour_list(max(Config.distancing_radius, Config.infection_range),
+                                    Config.neighbour_skin)
+    spent = 0
+    for step in range(warmup + steps):
+        population[:,1:3] += population[:,3:5] * population[:,5:6]
+        np.mod(population[:,1:3], size, out=population[:,1:3])
+        turn = rng.uniform(size=pop_size) < 0.02
+        population[:,3:5][turn] = rng.normal(0, 1/3, (np.count_nonzero(turn), 2))
+
+        start = time.perf_counter()
+        neighbour_list.pairs_within(population, Config.distancing_radius)
+        if step >= warmup:
+            spent += time.perf_counter() - start
+    return spent / steps, neighbour_list.pair_count, neighbour_list.nbytes
+
+
+if __name__ == '__main__':
+    sizes = [int(size) for size in sys.argv[1:]] or [5000, 20000, 50000, 200000]
+    print('%10s %12s %12s %12s %10s' %('agents', 'ms / step', 'us / agent', 'pairs', 'MB'))
+    for pop_size in sizes:
+        seconds, pairs, nbytes = benchmark(pop_size)
+        print('%10i %12.2f %12.3f %12i %10.1f' %(pop_size, seconds * 1000, seconds / pop_size * 1e6,
+                                                 pairs, nbytes / 1e6))
@@ -14,12 +14,28 @@ class Configuration():
         self.verbose = kwargs.get('verbose', True) #whether to print infections, recoveries and fatalities to the terminal
         self.simulation_steps = kwargs.get('simulation_steps', 10000) #total simulation steps performed
         self.tstep = kwargs.get('tstep', 0) #current simulation timestep
-        self.save_data = kwargs.get('save_data', False) #whether to dump data at end of simulation
+        self.seed = kwargs.get('seed', None) #if given, numpy's and numba's random generators are seeded with it before initializing
+        self.save_data = kwargs.get('save_data', False) #whether to write the tracked counts of every timestep to a run store (see storage.Run_store)
+        self.save_data_folder = kwargs.get('save_data_folder', 'data/') #folder to write run stores to, one file per run
         self.save_pop = kwargs.get('save_pop', False) #whether to save population matrix every 'save_pop_freq' timesteps
         self.save_pop_freq = kwargs.get('save_pop_freq', 10) #population data will be saved every 'n' timesteps. Default: 10
         self.save_pop_folder = kwargs.get('save_pop_folder', 'pop_data/') #folder to write population timestep data to
+        #'snapshots' for one memory-mapped file per run (see storage.Snapshot_store), 'npy' for a file
+        #per timestep, or 'results' for compressed snapshots in the run store (needs save_data)
+        self.save_pop_format = kwargs.get('save_pop_format', 'snapshots')
         self.endif_no_infections = kwargs.get('endif_no_infections', True) #whether to stop simulation if no infections remain
         self.world_size = kwargs.get('world_size', [2, 2]) #x and y sizes of the world
+        #'reflect' to turn people around at the world bounds, or 'torus' to have those leaving
+        #come back in on the opposite side. Note that infections are not found across the edges
+        self.boundary = kwargs.get('boundary', 'reflect')
+        self.backend = kwargs.get('backend', 'numpy') #'numpy' or 'numba', falls back to numpy if numba is not installed
+        #how population data is stored: 'matrix' (float64 array), 'columnar' (compact array per column)
+        #or 'columnar32' (compact, with float32 positions and motion). Columnar always uses the numpy backend
+        self.population_format = kwargs.get('population_format', 'matrix')
+        self.profile = kwargs.get('profile', False) #whether to time the stages of every timestep
+        self.profile_memory = kwargs.get('profile_memory', False) #whether to also trace memory allocations per stage (slow)
+        self.profile_window = kwargs.get('profile_window', 1000) #number of most recent timesteps to keep timings of
+        self.profile_path = kwargs.get('profile_path', 'profile.json') #file the stage timings are written to at the end of run()
 
 
         #scenario flags
@@ -38,6 +54,11 @@ class Configuration():
         self.save_plot = kwargs.get('save_plot', False)
         self.plot_path = kwargs.get('plot_path', 'render/') #folder where plots are saved to
         self.plot_style = kwargs.get('plot_style', 'default') #can be default, dark, ...
+        #'scatter' to draw everyone as a point, 'raster' to draw the density of each state on a grid,
+        #or 'auto' to use the raster from raster_threshold people on
+        self.render_mode = kwargs.get('render_mode', 'auto')
+        self.raster_threshold = kwargs.get('raster_threshold', 100000)
+        self.raster_resolution = kwargs.get('raster_resolution', 300) #number of raster cells along the longest side of the plot
         self.colorblind_mode = kwargs.get('colorblind_mode', False)
         #if colorblind is enabled, set type of colorblindness
         #available: deuteranopia, protanopia, tritanopia. defauld=deuteranopia
@@ -51,6 +72,8 @@ class Configuration():
         self.pop_size = kwargs.get('pop_size', 2000)
         self.mean_age = kwargs.get('mean_age', 45)
         self.max_age = kwargs.get('max_age', 105)
+        self.track_age_cohorts = kwargs.get('track_age_cohorts', False) #whether to count the people in each state per age cohort every timestep
+        self.age_bins = kwargs.get('age_bins', [0, 20, 40, 60, 80]) #lowest age of each age cohort
         self.age_dependent_risk = kwargs.get('age_dependent_risk', True) #whether risk increases with age
         self.risk_age = kwargs.get('risk_age', 55) #age where mortality risk starts increasing
         self.critical_age = kwargs.get('critical_age', 75) #age at and beyond which mortality risk reaches maximum
@@ -61,8 +84,11 @@ class Configuration():
         #mean_speed = 0.01 # the mean speed (defined as heading * speed)
         #std_speed = 0.01 / 3 #the standard deviation of the speed parameter
         #the proportion of the population that practices social distancing, simulated
-        #by them standing still
+        #by them steering away from anyone within the distancing radius
         self.proportion_distancing = kwargs.get('proportion_distancing', 0)
+        self.distancing_radius = kwargs.get('distancing_radius', 0.03) #comfort radius of those distancing
+        self.distancing_strength = kwargs.get('distancing_strength', 0.5) #how hard they steer away from each neighbour
+        self.neighbour_skin = kwargs.get('neighbour_skin', None) #margin of the cached neighbour list, None for 0.3 times its range, see spatial.Neighbour_list
         self.speed = kwargs.get('speed', 0.01) #average speed of population
         #when people have an active destination, the wander range defines the area
         #surrounding the destination they will wander upon arriving
@@ -108,9 +134,9 @@ class Configuration():
                                 'dark': ['#404040', '#ff0000', '#00ff00', '#000000']},
                     'deuteranopia': {'default': ['gray', '#a50f15', '#08519c', 'black'],
                                      'dark': ['#404040', '#fcae91', '#6baed6', '#000000']},
-                    'protanopia': {'default': ['gray', '#a50f15', '08519c', 'black'],
+                    'protanopia': {'default': ['gray', '#a50f15', '#08519c', 'black'],
                                    'dark': ['#404040', '#fcae91', '#6baed6', '#000000']},
-                    'tritanopia': {'default': ['gray', '#a50f15', '08519c', 'black'],
+                    'tritanopia': {'default': ['gray', '#a50f15', '#08519c', 'black'],
                                    'dark': ['#404040', '#fcae91', '#6baed6', '#000000']}
                     }
 
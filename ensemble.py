@@ -0,0 +1,242 @@
+'''
+contains the ensemble engine, which runs many replicas of the same scenario
+in one vectorized simulation for Monte Carlo studies
+'''
+
+import sys
+
+import numpy as np
+
+from config import Configuration
+from infection import Recovery_scheduler
+from numba_backend import select_backend, seed as seed_numba
+from path_planning import update_pops_destination
+from population import initialize_population, initialize_destination_matrix,\
+Population_trackers, State_registry, set_active_destination
+
+
+class Ensemble():
+    '''runs replicas of one scenario side by side
+
+    All replicas are stacked into one population array of shape
+    (replicas, pop_size, 15) and advanced together every timestep, using
+    the same motion kernel, infection and recovery functions as Simulation
+    on the flattened (replicas * pop_size, 15) view. Replicas do not infect
+    each other and each have their own healthcare capacity and lockdown.
+
+    Per-replica counts are kept in a Population_trackers for each replica,
+    and the mean, median, min and max over replicas are computed on the fly.
+
+    Keyword arguments
+    -----------------
+    replicas : int
+        the number of replicas to run
+
+    seed : int or None
+        if given, used to seed numpy's (and with the numba backend, numba's)
+        random generator before initializing
+
+    all other arguments are passed on to Configuration
+    '''
+    def __init__(self, replicas=50, seed=None, *args, **kwargs):
+        self.Config = Configuration(*args, **kwargs)
+        self.replicas = replicas
+        self.frame = 0
+
+        self.backend = select_backend(self.Config.backend)
+
+        #compiled functions have their own random generator, seed it as well
+        if seed is not None:
+            np.random.seed(seed)
+            if self.backend.name == 'numba':
+                seed_numba(seed)
+        self.recovery_scheduler = Recovery_scheduler()
+        self.population_init()
+
+        #moves everyone in all replicas each timestep, in place
+        self.motion_kernel = self.backend.Motion_kernel(len(self.flat_population))
+
+
+    def population_init(self):
+        '''(re-)initializes the population of all replicas'''
+        self.frame = 0
+        self.population = np.stack([initialize_population(self.Config, self.Config.mean_age,
+                                                          self.Config.max_age, self.Config.xbounds,
+                                                          self.Config.ybounds)
+                                    for replica in range(self.replicas)])
+        #view on the same data with all replicas one after another
+        self.flat_population = self.population.reshape(-1, self.population.shape[2])
+
+        self.destinations = initialize_destination_matrix(len(self.flat_population), 1)
+        self.state_registry = State_registry(self.flat_population)
+        self.recovery_scheduler.clear()
+        if hasattr(self, 'motion_kernel'):
+            self.motion_kernel.clear(len(self.flat_population))
+        self.locked_down = False
+
+        #lockdown vector is 1 for those not complying, drawn for every replica
+        self.lockdown_vector = np.zeros((self.replicas, self.Config.pop_size))
+        self.lockdown_vector[np.random.uniform(size=self.lockdown_vector.shape) >=
+                             self.Config.lockdown_compliance] = 1
+
+        self.pop_trackers = [Population_trackers() for replica in range(self.replicas)]
+        self.max_infectious = np.zeros((self.replicas,), dtype=np.int64)
+        self.statistics = {}
+        for key in ['infectious', 'fatalities']:
+            self.statistics[key] = {'mean': [], 'median': [], 'max': [], 'min': []}
+
+
+    def count_states(self, state):
+        '''returns the number of people in given state for every replica'''
+        return np.bincount(self.state_registry.in_state(state) // self.Config.pop_size,
+                           minlength = self.replicas)
+
+
+    def tstep(self):
+        '''takes a time step in all replicas'''
+
+        if self.frame == 0:
+            #pick up any changes made to the population during setup
+            self.state_registry.rebuild(self.flat_population)
+
+        self.flat_population = update_pops_destination(self.flat_population, self.destinations,
+                                                       self.Config, registry = self.state_registry,
+                                                       backend = self.backend,
+                                                       check_bounds = False)
+
+        #find replicas in lockdown
+        locked = np.zeros((self.replicas,), dtype=bool)
+        if self.Config.lockdown:
+            threshold = self.Config.pop_size * self.Config.lockdown_percentage
+            locked = (self.count_states(1) >= threshold) | (self.max_infectious >= threshold)
+
+        #the dead are retired from motion for good
+        dead = self.state_registry.in_state(3)
+
+        if locked.any():
+            #set speeds of complying people to 0, reduce those of the others
+            speeds = self.population[:,:,5][locked]
+            speeds = np.clip(speeds, a_min = None, a_max = 0.001)
+            speeds[self.lockdown_vector[locked] == 0] = 0
+            self.population[:,:,5][locked] = speeds
+
+            #move those not in lockdown as usual, then the rest without randoms,
+            #keeping the complying in place
+            in_lockdown = np.repeat(locked, self.Config.pop_size)
+            complying = (self.lockdown_vector == 0).ravel()
+            self.motion_kernel.hold(np.flatnonzero(in_lockdown))
+            self.flat_population = self.motion_kernel.step(self.flat_population, self.Config,
+                                                           frozen = dead)
+            self.motion_kernel.hold(np.flatnonzero(~in_lockdown | complying))
+            self.flat_population = self.motion_kernel.step(self.flat_population, self.Config,
+                                                           randomize = False)
+            self.locked_down = True
+        else:
+            if self.locked_down:
+                self.motion_kernel.hold(None)
+                self.locked_down = False
+            self.flat_population = self.motion_kernel.step(self.flat_population, self.Config,
+                                                           frozen = dead)
+
+        #find new infections, per replica
+        self.flat_population, self.destinations = self.backend.infect(self.flat_population, self.Config, self.frame,
+                                                                      send_to_location = self.Config.self_isolate,
+                                                                      location_bounds = self.Config.isolation_bounds,
+                                                                      destinations = self.destinations,
+                                                                      location_no = 1,
+                                                                      location_odds = self.Config.self_isolate_proportion,
+                                                                      scheduler = self.recovery_scheduler,
+                                                                      registry = self.state_registry,
+                                                                      group_size = self.Config.pop_size)
+
+        #recover and die
+        self.flat_population = self.backend.recover_or_die(self.flat_population, self.frame, self.Config,
+                                                           scheduler = self.recovery_scheduler,
+                                                           registry = self.state_registry)
+
+        #send cured back to population, only those in isolation (destination 1)
+        traveling = self.state_registry.destination.indices()
+        cured = traveling[(self.flat_population[:,6][traveling] == 2) &
+                          (self.flat_population[:,11][traveling] == 1)]
+        set_active_destination(self.flat_population, cured, 0, self.state_registry)
+
+        self.update_statistics()
+
+        if self.Config.verbose:
+            sys.stdout.write('\r')
+            sys.stdout.write('%i: infected (mean): %.1f, dead (mean): %.1f, replicas: %i' %(self.frame,
+                             self.statistics['infectious']['mean'][-1],
+                             self.statistics['fatalities']['mean'][-1], self.replicas))
+
+        #run callback
+        self.callback()
+
+        #update frame
+        self.frame += 1
+
+
+    def update_statistics(self):
+        '''updates per-replica trackers and the aggregate statistics'''
+        infectious = self.count_states(1)
+        recovered = self.count_states(2)
+        fatalities = self.count_states(3)
+
+        self.max_infectious = np.maximum(self.max_infectious, infectious)
+
+        for replica, tracker in enumerate(self.pop_trackers):
+            tracker.add_counts(self.Config.pop_size, infectious[replica],
+                               recovered[replica], fatalities[replica])
+
+        for key, counts in [['infectious', infectious], ['fatalities', fatalities]]:
+            self.statistics[key]['mean'].append(np.mean(counts))
+            self.statistics[key]['median'].append(np.median(counts))
+            self.statistics[key]['max'].append(np.max(counts))
+            self.statistics[key]['min'].append(np.min(counts))
+
+
+    def callback(self):
+        '''placeholder function that can be overwritten.
+
+        Works like Simulation.callback. By default infects the first
+        person of every replica at timestep 50.
+        '''
+
+        if self.frame == 50:
+            patients = np.arange(self.replicas) * self.Config.pop_size
+            self.state_registry.set_state(self.flat_population, patients, 1)
+            self.flat_population[:,8][patients] = 50
+            self.state_registry.set_treatment(self.flat_population, patients, 1)
+            self.recovery_scheduler.schedule(self.flat_population, patients, self.Config)
+
+
+    def run(self):
+        '''run all replicas'''
+
+        i = 0
+
+        while i < self.Config.simulation_steps:
+            try:
+                self.tstep()
+            except KeyboardInterrupt:
+                print('\nCTRL-C caught, exiting')
+                sys.exit(1)
+
+            i += 1
+
+            #check whether to end if no infecious persons remain in any replica.
+            if self.Config.endif_no_infections and self.frame >= 500:
+                if self.state_registry.count(1) + self.state_registry.count(4) == 0:
+                    i = self.Config.simulation_steps
+
+
+    def get_statistics(self):
+        '''returns the aggregate statistics over replicas as arrays
+
+        Returns
+        -------
+        statistics : dict
+            for 'infectious' and 'fatalities', a dict with 'mean', 'median',
+            'max' and 'min' arrays over time
+        '''
+        return {key: {stat: np.asarray(values) for stat, values in stats.items()}
+                for key, stats in self.statistics.items()}
@@ -3,6 +3,7 @@ file that contains all functions to define destinations in the
 environment of the simulated world.
 '''
 
+from matplotlib.collections import LineCollection
 import numpy as np
 
 def build_hospital(xmin, xmax, ymin, ymax, plt, addcross=True):
@@ -49,4 +50,269 @@ def build_hospital(xmin, xmax, ymin, ymax, plt, addcross=True):
                  linewidth = 3)
         plt.plot([xmiddle - (height / 2), xmiddle + (height / 2)],
                  [ymax + (height / 2), ymax + (height / 2)], color='red',
-                 linewidth = 3)
\ No newline at end of file
+                 linewidth = 3)
+
+class Environment():
+    '''static geometry of the world: walls and zones
+
+    Walls are axis-aligned line segments that nobody can walk through. Zones
+    are named rectangular areas, such as the inside of a building, that can
+    be looked up for any position.
+
+    To keep collision checks cheap, the world is divided into a grid of cells,
+    and for each cell the walls and zones overlapping it are stored (in CSR
+    form, as offsets into one array of indices). Only those moving through a
+    cell with walls in it are checked, and only against those walls.
+
+    There is no path finding: people heading for a destination on the other
+    side of a wall will walk into it, unless there is an entrance in the way.
+
+    Keyword arguments
+    -----------------
+    xbounds, ybounds : list or tuple
+        the lower and upper bounds of the world [min, max]
+
+    cell_size : float
+        the side length of a lookup grid cell. Must be larger than the
+        distance anyone moves in a single timestep
+    '''
+    def __init__(self, xbounds, ybounds, cell_size=0.05):
+        self.origin = np.array([xbounds[0], ybounds[0]], dtype=np.float64)
+        self.cell_size = cell_size
+        self.nx = max(int(np.ceil((xbounds[1] - xbounds[0]) / cell_size)), 1)
+        self.ny = max(int(np.ceil((ybounds[1] - ybounds[0]) / cell_size)), 1)
+
+        self.walls = np.zeros((0, 4))
+        self.zones = np.zeros((0, 4))
+        self.zone_names = []
+        self.wall_lookup = None
+        self.zone_lookup = None
+
+
+    def add_wall(self, x0, y0, x1, y1):
+        '''adds a wall from (x0, y0) to (x1, y1), which must be horizontal or vertical'''
+        if x0 != x1 and y0 != y1:
+            raise ValueError('walls must be horizontal or vertical')
+        self.walls = np.vstack([self.walls, [min(x0, x1), min(y0, y1),
+                                             max(x0, x1), max(y0, y1)]])
+        self.wall_lookup = None
+
+
+    def add_zone(self, name, bounds):
+        '''adds a named zone, format of bounds: [xmin, ymin, xmax, ymax]'''
+        self.zones = np.vstack([self.zones, bounds])
+        self.zone_names.append(name)
+        self.zone_lookup = None
+
+
+    def add_building(self, bounds, entrance=None, name=None):
+        '''adds the four walls of a rectangular building, and a zone for its inside
+
+        Keyword arguments
+        -----------------
+        bounds : list or tuple
+            the outside of the building, format: [xmin, ymin, xmax, ymax]
+
+        entrance : list or tuple or None
+            gap in one of the walls, format: [side, start, end], with side one of
+            'left', 'right', 'bottom' or 'top', and start and end the coordinates
+            along that side between which the gap is. No entrance if None.
+
+        name : str or None
+            the name of the zone, if None no zone is added
+        '''
+        xmin, ymin, xmax, ymax = bounds
+        sides = {'left': [xmin, ymin, xmin, ymax], 'right': [xmax, ymin, xmax, ymax],
+                 'bottom': [xmin, ymin, xmax, ymin], 'top': [xmin, ymax, xmax, ymax]}
+
+        for side, (x0, y0, x1, y1) in sides.items():
+            if entrance is None or entrance[0] != side:
+                self.add_wall(x0, y0, x1, y1)
+            elif side in ['left', 'right']:
+                self.add_wall(x0, y0, x1, entrance[1])
+                self.add_wall(x0, entrance[2], x1, y1)
+            else:
+                self.add_wall(x0, y0, entrance[1], y1)
+                self.add_wall(entrance[2], y0, x1, y1)
+
+        if name is not None:
+            self.add_zone(name, bounds)
+
+
+    def _cells(self, x, y):
+        '''returns cell coordinates of positions, clipped onto the grid'''
+        cx = np.clip(np.floor((x - self.origin[0]) / self.cell_size), 0, self.nx - 1).astype(np.int64)
+        cy = np.clip(np.floor((y - self.origin[1]) / self.cell_size), 0, self.ny - 1).astype(np.int64)
+        return cx, cy
+
+
+    def _build_lookup(self, rectangles):
+        '''returns CSR offsets and indices of the rectangles overlapping each cell'''
+        cx0, cy0 = self._cells(rectangles[:,0], rectangles[:,1])
+        cx1, cy1 = self._cells(rectangles[:,2], rectangles[:,3])
+
+        #list every (cell, rectangle) pair
+        cells = []
+        index = []
+        for i in range(len(rectangles)):
+            gx, gy = np.meshgrid(np.arange(cx0[i], cx1[i] + 1), np.arange(cy0[i], cy1[i] + 1))
+            cells.append((gx * self.ny + gy).ravel())
+            index.append(np.full(gx.size, i))
+        cells = np.concatenate(cells) if len(cells) > 0 else np.zeros((0,), dtype=np.int64)
+        index = np.concatenate(index) if len(index) > 0 else np.zeros((0,), dtype=np.int64)
+
+        order = np.argsort(cells, kind='stable')
+        offsets = np.zeros((self.nx * self.ny + 1,), dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(cells, minlength = self.nx * self.ny))
+        return offsets, index[order]
+
+
+    def _pairs(self, lookup, keys):
+        '''returns (query, index) pairs of everything stored in given cells'''
+        offsets, index = lookup
+        starts = offsets[keys]
+        counts = offsets[keys + 1] - starts
+        queries = np.repeat(np.arange(len(keys)), counts)
+        positions = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return queries, index[np.repeat(starts, counts) + positions]
+
+
+    def collide(self, population, old_x, old_y):
+        '''stops those who walked through a wall
+
+        Compares everyone's position with their position before moving, and
+        for those whose path crossed a wall, moves them back and reverses
+        their heading on that axis. Works in place on the population.
+
+        Keyword arguments
+        -----------------
+        population : ndarray
+            the array containing all the population information, after moving
+
+        old_x, old_y : ndarray
+            everyone's position before moving
+        '''
+        if len(self.walls) == 0:
+            return population
+        if self.wall_lookup is None:
+            self.wall_lookup = self._build_lookup(self.walls)
+            #cells with a wall in them or in one of their neighbours
+            has_wall = np.pad((np.diff(self.wall_lookup[0]) > 0).reshape(self.nx, self.ny), 1)
+            self.near_wall = np.zeros((self.nx, self.ny), dtype=bool)
+            for dx in range(3):
+                for dy in range(3):
+                    self.near_wall |= has_wall[dx:dx + self.nx, dy:dy + self.ny]
+
+        #only those ending up near a wall can have walked through one
+        cx1, cy1 = self._cells(population[:,1], population[:,2])
+        movers = np.flatnonzero(self.near_wall[cx1, cy1])
+        if len(movers) == 0:
+            return population
+
+        #a step shorter than a cell only passes through these cells,
+        #which are often the same, so duplicates are left out
+        cx0, cy0 = self._cells(old_x[movers], old_y[movers])
+        cx1, cy1 = cx1[movers], cy1[movers]
+        keys = np.stack([cx0 * self.ny + cy0, cx1 * self.ny + cy1,
+                         cx0 * self.ny + cy1, cx1 * self.ny + cy0], axis=1)
+        unique = np.ones(keys.shape, dtype=bool)
+        unique[:,1] = keys[:,1] != keys[:,0]
+        unique[:,2] = (keys[:,2] != keys[:,0]) & (keys[:,2] != keys[:,1])
+        unique[:,3] = (keys[:,3] != keys[:,0]) & (keys[:,3] != keys[:,1])
+
+        #one entry per (mover, wall) pair, a wall may be listed more than once
+        queries, walls = self._pairs(self.wall_lookup, keys[unique])
+        queries = np.nonzero(unique)[0][queries]
+        walls = self.walls[walls]
+        ids = movers[queries]
+
+        #old and new position of the person of each pair, per axis
+        old = [old_x[ids], old_y[ids]]
+        new = [population[:,1][ids], population[:,2][ids]]
+
+        #after being moved back on one axis, someone walking into a corner
+        #may still cross a wall on the other, so x is checked once more
+        for axis in [0, 1, 0]:
+            #walls across this axis: vertical walls for x, horizontal for y
+            across = walls[:,axis] == walls[:,axis + 2]
+            side_old = old[axis] - walls[:,axis]
+            side_new = new[axis] - walls[:,axis]
+            crossed = across & ((side_old < 0) != (side_new < 0))
+
+            #where along the wall the path crosses it
+            other = 1 - axis
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t = side_old / (side_old - side_new)
+                at = old[other] + t * (new[other] - old[other])
+            crossed &= (at >= walls[:,other]) & (at <= walls[:,other + 2])
+
+            hit = np.zeros((len(movers),), dtype=bool)
+            hit[queries[crossed]] = True
+            population[:,axis + 1][movers[hit]] = (old_x if axis == 0 else old_y)[movers[hit]]
+            population[:,axis + 3][movers[hit]] = -population[:,axis + 3][movers[hit]]
+            new[axis] = np.where(hit[queries], old[axis], new[axis])
+
+        return population
+
+
+    def zone_of(self, x, y):
+        '''returns the index of the zone each position is in, -1 if none
+
+        Where zones overlap, the one added last is returned.
+        '''
+        x = np.atleast_1d(x)
+        y = np.atleast_1d(y)
+        zones = np.full((len(x),), -1, dtype=np.int64)
+        if len(self.zones) == 0:
+            return zones
+        if self.zone_lookup is None:
+            self.zone_lookup = self._build_lookup(self.zones)
+
+        cx, cy = self._cells(x, y)
+        queries, index = self._pairs(self.zone_lookup, cx * self.ny + cy)
+        inside = ((self.zones[index,0] <= x[queries]) & (x[queries] <= self.zones[index,2]) &
+                  (self.zones[index,1] <= y[queries]) & (y[queries] <= self.zones[index,3]))
+        np.maximum.at(zones, queries[inside], index[inside])
+        return zones
+
+
+    def draw(self, ax, color='black'):
+        '''draws all walls on given axis'''
+        if len(self.walls) > 0:
+            ax.add_collection(LineCollection(self.walls.reshape(-1, 2, 2), colors=color))
+
+
+def build_environment(Config):
+    '''returns the walls and zones set by Config, or None if there are none
+
+    With self-isolation active (Config.self_isolate), the isolation area
+    (Config.isolation_bounds) is walled in and added as zone 'isolation'.
+    Its entrance is the middle half of the side facing the center of the
+    world, which is where those sent there arrive from. Those heading for
+    it are steered towards its center every timestep, so anyone walking
+    into a wall slides along it to the entrance.
+
+    Keyword arguments
+    -----------------
+    Config : Configuration
+        the configuration of the simulation
+    '''
+    if not Config.self_isolate or Config.isolation_bounds is None:
+        return None
+
+    xmin, ymin, xmax, ymax = Config.isolation_bounds
+    environment = Environment([min(Config.xbounds[0], xmin), max(Config.xbounds[1], xmax)],
+                              [min(Config.ybounds[0], ymin), max(Config.ybounds[1], ymax)])
+
+    #side of the isolation area facing the center of the world
+    dx = ((Config.xbounds[0] + Config.xbounds[1]) - (xmin + xmax)) / 2
+    dy = ((Config.ybounds[0] + Config.ybounds[1]) - (ymin + ymax)) / 2
+    if abs(dx) >= abs(dy):
+        side = 'right' if dx > 0 else 'left'
+        entrance = [side, ymin + (ymax - ymin) / 4, ymax - (ymax - ymin) / 4]
+    else:
+        side = 'top' if dy > 0 else 'bottom'
+        entrance = [side, xmin + (xmax - xmin) / 4, xmax - (xmax - xmin) / 4]
+
+    environment.add_building(Config.isolation_bounds, entrance, name = 'isolation')
+    return environment
@@ -4,14 +4,22 @@ new infections, recoveries, and deaths
 '''
 # let's make one more productive change here, shall we?
 
+import heapq
+
 import numpy as np
-from path_planning import go_to_location
+from path_planning import go_to_locations
+from population import get_indices, set_state, set_treatment
+from spatial import Spatial_grid
 
 
 def find_nearby(population, infection_zone, traveling_infects=False,
-                kind='healthy', infected_previous_step=[]):
+                kind='healthy', infected_previous_step=[], grid=None):
     '''finds nearby IDs
 
+    Searches a Spatial_grid, so only agents in the cells around the infection
+    zone are inspected. Arrays of fewer than 256 rows are masked as a whole
+    instead, which is faster than indexing them.
+
     Keyword Arguments
     -----------------
 
@@ -19,6 +27,13 @@ def find_nearby(population, infection_zone, traveling_infects=False,
         determines whether infected or healthy individuals are returned
         within the infection_zone
 
+    grid : Spatial_grid or None
+        spatial index to search, with cells at least half the width of the
+        infection zone. Must be built over 'population' if kind='healthy',
+        and over 'infected_previous_step' if kind='infected'. When searching
+        many zones, build it once and pass it to every call. If None, one is
+        built over the candidates of this call.
+
 
     Returns
     -------
@@ -33,43 +48,58 @@ def find_nearby(population, infection_zone, traveling_infects=False,
     '''
 
     if kind.lower() == 'healthy':
-        indices = np.int32(population[:,0][(infection_zone[0] < population[:,1]) &
-                                            (population[:,1] < infection_zone[2]) &
-                                            (infection_zone[1] < population [:,2]) &
-                                            (population[:,2] < infection_zone[3]) &
-                                            (population[:,6] == 0)])
-        return indices
-
+        searched = population
     elif kind.lower() == 'infected':
-        if traveling_infects:
-            infected_number = len(infected_previous_step[:,6][(infection_zone[0] < infected_previous_step[:,1]) &
-                                                            (infected_previous_step[:,1] < infection_zone[2]) &
-                                                            (infection_zone[1] < infected_previous_step [:,2]) &
-                                                            (infected_previous_step[:,2] < infection_zone[3]) &
-                                                            (infected_previous_step[:,6] == 1)])
-        else:
-            infected_number = len(infected_previous_step[:,6][(infection_zone[0] < infected_previous_step[:,1]) &
-                                                            (infected_previous_step[:,1] < infection_zone[2]) &
-                                                            (infection_zone[1] < infected_previous_step [:,2]) &
-                                                            (infected_previous_step[:,2] < infection_zone[3]) &
-                                                            (infected_previous_step[:,6] == 1) &
-                                                            (infected_previous_step[:,11] == 0)])
-        return infected_number
-
+        searched = infected_previous_step
     else:
         raise ValueError('type to find %s not understood! Must be either \'healthy\' or \'ill\'')
 
+    #whom to look for
+    if kind.lower() == 'healthy':
+        wanted = searched[:,6] == 0
+    elif traveling_infects:
+        wanted = searched[:,6] == 1
+    else:
+        wanted = (searched[:,6] == 1) & (searched[:,11] == 0)
+
+    half_width = max(infection_zone[2] - infection_zone[0],
+                     infection_zone[3] - infection_zone[1]) / 2
+
+    if grid is not None:
+        rows = grid.query_box(searched, infection_zone)
+        rows = rows[wanted[rows]]
+    elif len(searched) >= 256 and half_width > 0:
+        grid = Spatial_grid(searched, half_width, rows = np.flatnonzero(wanted))
+        rows = grid.query_box(searched, infection_zone)
+    else:
+        rows = np.flatnonzero((infection_zone[0] < searched[:,1]) &
+                              (searched[:,1] < infection_zone[2]) &
+                              (infection_zone[1] < searched[:,2]) &
+                              (searched[:,2] < infection_zone[3]) &
+                              wanted)
+
+    if kind.lower() == 'healthy':
+        return np.int32(searched[:,0][rows])
+    else:
+        return len(rows)
+
 
 
 
 
 def infect(population, Config, frame, send_to_location=False,
            location_bounds=[], destinations=[], location_no=1,
-           location_odds=1.0):
+           location_odds=1.0, scheduler=None, registry=None,
+           exposure_kernel=None, group_size=None):
     '''finds new infections.
 
     Function that finds new infections in an area around infected persens
-    defined by infection_range, and infects others with chance infection_chance
+    defined by infection_range, and infects others with chance infection_chance.
+
+    All pairs of infected and healthy people within range are collected at once,
+    and the dice for all exposed healthy people are rolled in a single draw. Someone
+    exposed to k infected people becomes infected with odds 1 - (1 - infection_chance)^k.
+    Free places in the healthcare system are then handed to the newly infected.
 
     Keyword arguments
     -----------------
@@ -115,89 +145,87 @@ def infect(population, Config, frame, send_to_location=False,
 
     traveling_infects : bool
         whether infected people heading to a destination can still infect others on the way there
+
+    scheduler : Recovery_scheduler or None
+        if given, the newly infected are scheduled for their recovery or death
+
+    registry : State_registry or None
+        if given, used to look up who is healthy, infected and in treatment,
+        and kept up to date with the new infections
+
+    exposure_kernel : function or None
+        function used to count exposures, with the signature of count_exposures
+        (which is used if None). Lets other backends supply a compiled version.
+
+    group_size : int or None
+        if given, the population is made up of consecutive blocks of this size
+        (for example ensemble replicas) that cannot infect each other and each
+        have their own healthcare capacity. If None, everyone is one group.
     '''
 
-    #mark those already infected first
-    infected_previous_step = population[population[:,6] == 1]
-    healthy_previous_step = population[population[:,6] == 0]
-
-    new_infections = []
-
-    #if less than half are infected, slice based on infected (to speed up computation)
-    if len(infected_previous_step) < (Config.pop_size // 2):
-        for patient in infected_previous_step:
-            #define infection zone for patient
-            infection_zone = [patient[1] - Config.infection_range, patient[2] - Config.infection_range,
-                                patient[1] + Config.infection_range, patient[2] + Config.infection_range]
-
-            #find healthy people surrounding infected patient
-            if Config.traveling_infects or patient[11] == 0:
-                indices = find_nearby(population, infection_zone, kind = 'healthy')
-            else:
-                indices = []
-
-            for idx in indices:
-                #roll die to see if healthy person will be infected
-                if np.random.random() < Config.infection_chance:
-                    population[idx][6] = 1
-                    population[idx][8] = frame
-                    if len(population[population[:,10] == 1]) <= Config.healthcare_capacity:
-                        population[idx][10] = 1
-                        if send_to_location:
-                            #send to location if die roll is positive
-                            if np.random.uniform() <= location_odds:
-                                population[idx],\
-                                destinations[idx] = go_to_location(population[idx],
-                                                                   destinations[idx],
-                                                                   location_bounds,
-                                                                   dest_no=location_no)
-                        else:
-                            pass
-                    new_infections.append(idx)
+    if group_size is None:
+        group_size = len(population)
+    n_groups = len(population) // group_size
 
-    else:
-        #if more than half are infected slice based in healthy people (to speed up computation)
-
-
-
-        for person in healthy_previous_step:
-            #define infecftion range around healthy person
-            infection_zone = [person[1] - Config.infection_range, person[2] - Config.infection_range,
-                                person[1] + Config.infection_range, person[2] + Config.infection_range]
-
-            if person[6] == 0: #if person is not already infected, find if infected are nearby
-                #find infected nearby healthy person
-                if Config.traveling_infects:
-                    poplen = find_nearby(population, infection_zone,
-                                         traveling_infects = True,
-                                         kind = 'infected')
-                else:
-                    poplen = find_nearby(population, infection_zone,
-                                         traveling_infects = True,
-                                         kind = 'infected',
-                                         infected_previous_step = infected_previous_step)
-
-                if poplen > 0:
-                    if np.random.random() < (Config.infection_chance * poplen):
-                        #roll die to see if healthy person will be infected
-                        population[np.int32(person[0])][6] = 1
-                        population[np.int32(person[0])][8] = frame
-                        if len(population[population[:,10] == 1]) <= Config.healthcare_capacity:
-                            population[np.int32(person[0])][10] = 1
-                            if send_to_location:
-                                #send to location and add to treatment if die roll is positive
-                                if np.random.uniform() < location_odds:
-                                    population[np.int32(person[0])],\
-                                    destinations[np.int32(person[0])] = go_to_location(population[np.int32(person[0])],
-                                                                                        destinations[np.int32(person[0])],
-                                                                                        location_bounds,
-                                                                                        dest_no=location_no)
-
-
-                        new_infections.append(np.int32(person[0]))
+    #mark those already infected first, everything below acts on this snapshot
+    infected = get_indices(population, 1, registry)
+    healthy = get_indices(population, 0, registry)
+
+    #only those not traveling to a destination infect others, unless traveling_infects
+    if not Config.traveling_infects:
+        infected = infected[population[:,11][infected] == 0]
+
+    new_infections = np.zeros((0,), dtype=np.int32)
+
+    if exposure_kernel is None:
+        exposure_kernel = count_exposures
+
+    if len(infected) > 0 and len(healthy) > 0:
+        if n_groups > 1:
+            #lay groups out next to each other, far enough apart not to interact
+            positions = np.zeros((len(population), 3))
+            spacing = np.ptp(population[:,1]) + (2 * Config.infection_range) + 1
+            positions[:,1] = population[:,1] + (np.arange(len(population)) // group_size) * spacing
+            positions[:,2] = population[:,2]
+        else:
+            positions = population
+
+        #number of infected each healthy person is exposed to
+        exposures = exposure_kernel(positions, infected, healthy, Config.infection_range)
+        exposed = np.flatnonzero(exposures)
+
+        #roll all dice at once, each exposure is an independent chance of infection
+        infection_odds = 1 - (1 - Config.infection_chance) ** exposures[exposed]
+        new_infections = np.int32(exposed[np.random.random(size = len(exposed)) < infection_odds])
+
+    if len(new_infections) > 0:
+        set_state(population, new_infections, 1, registry)
+        population[:,8][new_infections] = frame
+
+        if scheduler is not None:
+            scheduler.schedule(population, new_infections, Config)
+
+        #hand out the remaining treatment slots of each group in order of ID
+        if registry is not None:
+            in_treatment = registry.treatment.indices()
+        else:
+            in_treatment = np.flatnonzero(population[:,10] == 1)
+        free_slots = Config.healthcare_capacity - np.bincount(in_treatment // group_size,
+                                                              minlength = n_groups)
+        group = new_infections // group_size
+        rank = np.arange(len(new_infections)) - np.searchsorted(group, group, side='left')
+        treated = new_infections[rank < free_slots[group]]
+        set_treatment(population, treated, 1, registry)
+
+        if send_to_location:
+            #send to location if die roll is positive
+            to_location = treated[np.random.uniform(size = len(treated)) <= location_odds]
+            population, destinations = go_to_locations(population, destinations, to_location,
+                                                       location_bounds, dest_no=location_no,
+                                                       registry=registry)
 
     if len(new_infections) > 0 and Config.verbose:
-        print('\nat timestep %i these people got sick: %s' %(frame, new_infections))
+        print('\nat timestep %i these people got sick: %s' %(frame, list(new_infections)))
 
     if len(destinations) == 0:
         return population
@@ -205,9 +233,48 @@ def infect(population, Config, frame, send_to_location=False,
         return population, destinations
 
 
-def recover_or_die(population, frame, Config):
+def count_exposures(population, infected, healthy, infection_range):
+    '''counts for each healthy person how many infected are within range
+
+    Collects every (infected, healthy) pair within range in one query on
+    a Spatial_grid holding only the healthy.
+
+    Keyword arguments
+    -----------------
+    population : ndarray
+        array containing all data on the population
+
+    infected : ndarray
+        indices of those who can infect others
+
+    healthy : ndarray
+        indices of those who can become infected
+
+    infection_range : float
+        the radius around each infected person where transmission of virus can take place
+
+    Returns
+    -------
+    exposures : ndarray
+        the number of exposures for every row of population, 0 for anyone
+        not in healthy
+    '''
+    grid = Spatial_grid(population, infection_range, rows = healthy)
+    _, rows = grid.query_pairs(population,
+                               population[:,1][infected],
+                               population[:,2][infected],
+                               infection_range)
+
+    return np.bincount(rows, minlength = len(population))
+
+
+def recover_or_die(population, frame, Config, scheduler=None, registry=None,
+                   mortality_kernel=None):
     '''see whether to recover or die
 
+    Finds everyone whose illness has run its course and decides for all of
+    them at once whether they recover or die, using one random draw per person.
+    Age dependent mortality is read from the table given by get_mortality_table.
 
     Keyword arguments
     -----------------
@@ -250,63 +317,216 @@ def recover_or_die(population, frame, Config):
 
     verbose : bool
         whether to report to terminal the recoveries and deaths for each simulation step
+
+    scheduler : Recovery_scheduler or None
+        if given, only those the scheduler reports as due are handled, rather than
+        checking everyone who is infected
+
+    registry : State_registry or None
+        if given, used to look up who is infected and kept up to date with
+        the recoveries and deaths
+
+    mortality_kernel : function or None
+        function used to compute mortality chances, with the signature of
+        get_mortality_chances (which is used if None)
+    '''
+
+    if mortality_kernel is None:
+        mortality_kernel = get_mortality_chances
+
+    if scheduler is not None:
+        indices = scheduler.pop_due(population, frame)
+    else:
+        #find infected people, and who of them is due to recover or die
+        infected = get_indices(population, 1, registry)
+        indices = infected[is_due(population, infected, frame, Config)]
+
+    if len(indices) > 0:
+        updated_mortality_chance = mortality_kernel(population, indices, Config)
+
+        #decide whether to die or recover (become immune)
+        dies = np.random.random(size = len(indices)) <= updated_mortality_chance
+        fatalities = np.int32(indices[dies])
+        recovered = np.int32(indices[~dies])
+
+        set_state(population, fatalities, 3, registry)
+        set_state(population, recovered, 2, registry)
+        set_treatment(population, indices, 0, registry)
+
+        if len(fatalities) > 0 and Config.verbose:
+            print('\nat timestep %i these people died: %s' %(frame, list(fatalities)))
+        if len(recovered) > 0 and Config.verbose:
+            print('\nat timestep %i these people recovered: %s' %(frame, list(recovered)))
+
+    return population
+
+
+def get_mortality_chances(population, indices, Config):
+    '''returns the mortality chance of each of indices
+
+    Takes age (if Config.age_dependent_risk) and treatment (if
+    Config.treatment_dependent_risk) into account.
+
+    Keyword arguments
+    -----------------
+    population : ndarray
+        array containing all data on the population
+
+    indices : ndarray
+        indices of the people to compute mortality chances for
     '''
 
-    #find infected people
-    infected_people = population[population[:,6] == 1]
+    #check if we want risk to be age dependent
+    if Config.age_dependent_risk:
+        mortality_table = get_mortality_table(Config)
+        ages = np.clip(np.int32(population[:,7][indices]), 0, len(mortality_table) - 1)
+        updated_mortality_chance = mortality_table[ages]
+    else:
+        updated_mortality_chance = np.full(len(indices), Config.mortality_chance)
+
+    if Config.treatment_dependent_risk:
+        #decrease risk for those in treatment, increase for those without by
+        updated_mortality_chance = np.where(population[:,10][indices] == 1,
+                                            updated_mortality_chance * Config.treatment_factor,
+                                            updated_mortality_chance * Config.no_treatment_factor)
+
+    return updated_mortality_chance
+
+
+def is_due(population, indices, frame, Config):
+    '''returns for each of indices whether their illness has run its course at frame
+
+    Someone is due to recover or die once the time they have been sick,
+    scaled to the recovery_duration range, reaches their recovery vector.
+
+    Keyword arguments
+    -----------------
+    population : ndarray
+        array containing all data on the population
+
+    indices : ndarray
+        indices of the infected people to check
+
+    frame : int or ndarray
+        the timestep to check, or one timestep per index
+    '''
 
     #define vector of how long everyone has been sick
-    illness_duration_vector = frame - infected_people[:,8]
+    illness_duration_vector = frame - population[:,8][indices]
 
     recovery_odds_vector = (illness_duration_vector - Config.recovery_duration[0]) / np.ptp(Config.recovery_duration)
     recovery_odds_vector = np.clip(recovery_odds_vector, a_min = 0, a_max = None)
 
-    #update states of sick people
-    indices = infected_people[:,0][recovery_odds_vector >= infected_people[:,9]]
-
-    recovered = []
-    fatalities = []
-
-    #decide whether to die or recover
-    for idx in indices:
-        #check if we want risk to be age dependent
-        #if age_dependent_risk:
-        if Config.age_dependent_risk:
-            updated_mortality_chance = compute_mortality(infected_people[infected_people[:,0] == idx][:,7][0],
-                                                            Config.mortality_chance,
-                                                            Config.risk_age, Config.critical_age,
-                                                            Config.critical_mortality_chance,
-                                                            Config.risk_increase)
-        else:
-            updated_mortality_chance = Config.mortality_chance
-
-        if infected_people[infected_people[:,0] == int(idx)][:,10] == 0 and Config.treatment_dependent_risk:
-            #if person is not in treatment, increase risk by no_treatment_factor
-            updated_mortality_chance = updated_mortality_chance * Config.no_treatment_factor
-        elif infected_people[infected_people[:,0] == int(idx)][:,10] == 1 and Config.treatment_dependent_risk:
-            #if person is in treatment, decrease risk by
-            updated_mortality_chance = updated_mortality_chance * Config.treatment_factor
-
-        if np.random.random() <= updated_mortality_chance:
-            #die
-            infected_people[:,6][infected_people[:,0] == idx] = 3
-            infected_people[:,10][infected_people[:,0] == idx] = 0
-            fatalities.append(np.int32(infected_people[infected_people[:,0] == idx][:,0][0]))
-        else:
-            #recover (become immune)
-            infected_people[:,6][infected_people[:,0] == idx] = 2
-            infected_people[:,10][infected_people[:,0] == idx] = 0
-            recovered.append(np.int32(infected_people[infected_people[:,0] == idx][:,0][0]))
+    return recovery_odds_vector >= population[:,9][indices]
 
-    if len(fatalities) > 0 and Config.verbose:
-        print('\nat timestep %i these people died: %s' %(frame, fatalities))
-    if len(recovered) > 0 and Config.verbose:
-        print('\nat timestep %i these people recovered: %s' %(frame, recovered))
 
-    #put array back into population
-    population[population[:,6] == 1] = infected_people
+class Recovery_scheduler():
+    '''schedules recoveries and deaths at the frame they become due
 
-    return population
+    Whether and when someone recovers or dies is fixed once the frame they got
+    infected (column 8) and their recovery vector (column 9) are known. The
+    scheduler computes that due frame once, at infection, and files the person
+    in a bucket for that frame. Each timestep then only the buckets that have
+    come due are emptied, so the work per timestep scales with the number of
+    recoveries and deaths instead of with the number of infected.
+
+    Anyone infected outside of infect() (for example in Simulation.callback)
+    needs to be passed to schedule() as well, or sync() needs to be called.
+    '''
+    def __init__(self):
+        self.buckets = {} #due frame -> list of (indices, infected_since) arrays
+        self.due_frames = [] #heap of frames that have a bucket
+
+
+    def schedule(self, population, indices, Config):
+        '''files infected people under the frame their illness runs its course'''
+        indices = np.asarray(indices, dtype=np.int64)
+        if len(indices) == 0:
+            return
+
+        since = population[:,8][indices].copy()
+
+        #solve is_due for the frame, then correct for rounding of the float math.
+        #a recovery vector of 0 or less is met as soon as someone is infected
+        recovery_vector = population[:,9][indices]
+        due = np.where(recovery_vector <= 0, since,
+                       np.ceil(since + Config.recovery_duration[0] +
+                               recovery_vector * np.ptp(Config.recovery_duration)))
+        earlier = (due > since) & is_due(population, indices, due - 1, Config)
+        due[earlier] -= 1
+        due[~is_due(population, indices, due, Config)] += 1
+
+        order = np.argsort(due, kind='stable')
+        frames, starts = np.unique(due[order], return_index=True)
+        for frame, group in zip(np.int64(frames), np.split(order, starts[1:])):
+            if frame not in self.buckets:
+                self.buckets[frame] = []
+                heapq.heappush(self.due_frames, frame)
+            self.buckets[frame].append((indices[group], since[group]))
+
+
+    def sync(self, population, Config):
+        '''(re-)schedules everyone currently infected
+
+        Use after changing states directly in the population matrix. Entries that
+        were already scheduled are not duplicated in the result of pop_due.
+        '''
+        self.schedule(population, get_indices(population, 1), Config)
+
+
+    def pop_due(self, population, frame):
+        '''returns sorted indices of everyone due to recover or die at or before frame
+
+        Entries whose state or infection frame changed since they were scheduled
+        are stale and dropped.
+        '''
+        entries = []
+        while len(self.due_frames) > 0 and self.due_frames[0] <= frame:
+            entries.extend(self.buckets.pop(heapq.heappop(self.due_frames)))
+
+        if len(entries) == 0:
+            return np.zeros((0,), dtype=np.int64)
+
+        indices = np.concatenate([entry[0] for entry in entries])
+        since = np.concatenate([entry[1] for entry in entries])
+        valid = (population[:,6][indices] == 1) & (population[:,8][indices] == since)
+        return np.unique(indices[valid])
+
+
+    def clear(self):
+        '''removes everything that is scheduled'''
+        self.buckets = {}
+        self.due_frames = []
+
+
+#mortality tables computed so far, keyed by the parameters they were computed with
+_mortality_tables = {}
+
+
+def get_mortality_table(Config):
+    '''returns mortality chance for every age, indexed by whole years
+
+    The table is computed with compute_mortality for ages 0 up to and including
+    Config.max_age. Tables are cached in this module per set of mortality
+    parameters, so one is only computed once for each configuration used.
+
+    Keyword arguments
+    -----------------
+    Config : class
+        the configuration class
+    '''
+
+    params = (Config.mortality_chance, Config.risk_age, Config.critical_age,
+              Config.critical_mortality_chance, Config.risk_increase, Config.max_age)
+
+    if params not in _mortality_tables:
+        _mortality_tables[params] = np.array([compute_mortality(age, Config.mortality_chance,
+                                                                Config.risk_age, Config.critical_age,
+                                                                Config.critical_mortality_chance,
+                                                                Config.risk_increase)
+                                              for age in range(int(Config.max_age) + 1)])
+
+    return _mortality_tables[params]
 
 
 def compute_mortality(age, mortality_chance, risk_age=50,
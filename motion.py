@@ -26,12 +26,58 @@ def update_positions(population):
     return population
 
 
-def out_of_bounds(population, xbounds, ybounds):
+def out_of_bounds(population, xbounds, ybounds, ids=None):
     '''checks which people are about to go out of bounds and corrects
 
     Function that updates headings of individuals that are about to 
-    go outside of the world boundaries.
+    go outside of the world boundaries. Works in place on the population.
     
+    Keyword arguments
+    -----------------
+    population : ndarray
+        the array containing all the population information
+
+    xbounds, ybounds : list, tuple or ndarray
+        contains the lower and upper bounds of the world [min, max]. Either
+        one pair for everyone, or an array of shape (n, 2) with bounds
+        per person (for example per region), n being len(ids) if given,
+        or the size of the population otherwise
+
+    ids : ndarray or None
+        if given, only these people are checked, for example those
+        without a destination. Everyone is checked otherwise.
+    '''
+    if ids is None:
+        ids = np.arange(len(population))
+    xbounds = np.asarray(xbounds, dtype=np.float64)
+    ybounds = np.asarray(ybounds, dtype=np.float64)
+
+    for position, heading, bounds in [[1, 3, xbounds], [2, 4, ybounds]]:
+        x = population[:,position][ids]
+        h = population[:,heading][ids]
+
+        #at lower bound and heading out, set heading positive
+        out = ids[(x <= bounds[...,0]) & (h < 0)]
+        population[:,heading][out] = np.clip(np.random.normal(loc = 0.5,
+                                                              scale = 0.5/3,
+                                                              size = out.shape),
+                                             a_min = 0.05, a_max = 1)
+        #at upper bound and heading out, set heading negative
+        out = ids[(x >= bounds[...,1]) & (h > 0)]
+        population[:,heading][out] = np.clip(-np.random.normal(loc = 0.5,
+                                                               scale = 0.5/3,
+                                                               size = out.shape),
+                                             a_min = -1, a_max = -0.05)
+
+    return population
+
+
+def wrap_around(population, xbounds, ybounds, ids=None):
+    '''moves those who left the world back in on the opposite side
+
+    Used for periodic (torus) world boundaries, see Config.boundary.
+    Works in place on the population.
+
     Keyword arguments
     -----------------
     population : ndarray
@@ -39,54 +85,66 @@ def out_of_bounds(population, xbounds, ybounds):
 
     xbounds, ybounds : list or tuple
         contains the lower and upper bounds of the world [min, max]
+
+    ids : ndarray or None
+        if given, only these people are wrapped around, for example those
+        without a destination. Everyone is wrapped around otherwise.
     '''
-    #update headings and positions where out of bounds
-    #update x heading
-    #determine number of elements that need to be updated
-
-    shp = population[:,3][(population[:,1] <= xbounds[:,0]) &
-                            (population[:,3] < 0)].shape
-    population[:,3][(population[:,1] <= xbounds[:,0]) &
-                    (population[:,3] < 0)] = np.clip(np.random.normal(loc = 0.5, 
-                                                                        scale = 0.5/3,
-                                                                        size = shp),
-                                                        a_min = 0.05, a_max = 1)
-
-    shp = population[:,3][(population[:,1] >= xbounds[:,1]) &
-                            (population[:,3] > 0)].shape
-    population[:,3][(population[:,1] >= xbounds[:,1]) &
-                    (population[:,3] > 0)] = np.clip(-np.random.normal(loc = 0.5, 
-                                                                        scale = 0.5/3,
-                                                                        size = shp),
-                                                        a_min = -1, a_max = -0.05)
-
-    #update y heading
-    shp = population[:,4][(population[:,2] <= ybounds[:,0]) &
-                            (population[:,4] < 0)].shape
-    population[:,4][(population[:,2] <= ybounds[:,0]) &
-                    (population[:,4] < 0)] = np.clip(np.random.normal(loc = 0.5, 
-                                                                        scale = 0.5/3,
-                                                                        size = shp),
-                                                        a_min = 0.05, a_max = 1)
-
-    shp = population[:,4][(population[:,2] >= ybounds[:,1]) &
-                            (population[:,4] > 0)].shape
-    population[:,4][(population[:,2] >= ybounds[:,1]) &
-                    (population[:,4] > 0)] = np.clip(-np.random.normal(loc = 0.5, 
-                                                                        scale = 0.5/3,
-                                                                        size = shp),
-                                                        a_min = -1, a_max = -0.05)
+    for position, bounds in [[1, xbounds], [2, ybounds]]:
+        if ids is None:
+            column = population[:,position]
+            np.subtract(column, bounds[0], out=column, casting='same_kind')
+            np.mod(column, bounds[1] - bounds[0], out=column, casting='same_kind')
+            np.add(column, bounds[0], out=column, casting='same_kind')
+        else:
+            population[:,position][ids] = bounds[0] + np.mod(population[:,position][ids] - bounds[0],
+                                                             bounds[1] - bounds[0])
 
     return population
 
 
+def sample_events(size, chance, random_state=np.random):
+    '''returns sorted indices of the members that have an event happen
+
+    Every one of 'size' members independently has an event with odds 'chance'.
+    Rather than drawing a random number for every member, the gaps between
+    consecutive events are drawn from a geometric distribution, so the cost
+    scales with the number of events.
+
+    Keyword arguments
+    -----------------
+    size : int
+        the number of members
+
+    chance : float
+        the odds of the event happening for each member
+
+    random_state : module or Generator
+        source of random numbers, np.random or a numpy Generator
+    '''
+    if chance <= 0 or size == 0:
+        return np.zeros((0,), dtype=np.int64)
+    if chance >= 1:
+        return np.arange(size)
+
+    #draw enough gaps to almost always get past the end in one go
+    mean = size * chance
+    positions = np.cumsum(random_state.geometric(chance, size=int(mean + 5 * np.sqrt(mean) + 10))) - 1
+    while positions[-1] < size:
+        gaps = random_state.geometric(chance, size=int(np.sqrt(mean) + 10))
+        positions = np.concatenate([positions, positions[-1] + np.cumsum(gaps)])
+
+    return positions[:np.searchsorted(positions, size)]
+
+
 def update_randoms(population, pop_size, speed=0.01, heading_update_chance=0.02, 
                    speed_update_chance=0.02, heading_multiplication=1,
                    speed_multiplication=1):
     '''updates random states such as heading and speed
     
     Function that randomized the headings and speeds for population members
-    with settable odds.
+    with settable odds. Only the members that get updated are sampled,
+    see sample_events.
 
     Keyword arguments
     -----------------
@@ -100,7 +158,7 @@ def update_randoms(population, pop_size, speed=0.01, heading_update_chance=0.02,
         the odds of updating the heading of each member, each time step
 
     speed_update_chance : float
-        the oodds of updating the speed of each member, each time step
+        the odds of updating the speed of each member, each time step
 
     heading_multiplication : int or float
         factor to multiply heading with (default headings are between -1 and 1)
@@ -115,28 +173,326 @@ def update_randoms(population, pop_size, speed=0.01, heading_update_chance=0.02,
 
     #randomly update heading
     #x
-    update = np.random.random(size=(pop_size,))
-    shp = update[update <= heading_update_chance].shape
-    population[:,3][update <= heading_update_chance] = np.random.normal(loc = 0, 
-                                                        scale = 1/3,
-                                                        size = shp) * heading_multiplication
+    update = sample_events(pop_size, heading_update_chance)
+    population[:,3][update] = np.random.normal(loc = 0,
+                                               scale = 1/3,
+                                               size = update.shape) * heading_multiplication
     #y
-    update = np.random.random(size=(pop_size,))
-    shp = update[update <= heading_update_chance].shape
-    population[:,4][update <= heading_update_chance] = np.random.normal(loc = 0, 
-                                                        scale = 1/3,
-                                                        size = shp) * heading_multiplication
+    update = sample_events(pop_size, heading_update_chance)
+    population[:,4][update] = np.random.normal(loc = 0,
+                                               scale = 1/3,
+                                               size = update.shape) * heading_multiplication
     #randomize speeds
-    update = np.random.random(size=(pop_size,))
-    shp = update[update <= heading_update_chance].shape
-    population[:,5][update <= heading_update_chance] = np.random.normal(loc = speed, 
-                                                        scale = speed / 3,
-                                                        size = shp) * speed_multiplication
+    update = sample_events(pop_size, speed_update_chance)
+    population[:,5][update] = np.random.normal(loc = speed,
+                                               scale = speed / 3,
+                                               size = update.shape) * speed_multiplication
 
     population[:,5] = np.clip(population[:,5], a_min=0.0001, a_max=0.05)
     return population
 
 
+def social_distancing(population, neighbour_list, distancing, radius=0.03, strength=0.5):
+    '''steers those distancing away from others nearby
+
+    For everyone in 'distancing', adds a unit vector pointing away from every
+    other person within 'radius' to their heading, times 'strength'. Headings
+    are then clipped between -1 and 1.
+
+    Keyword arguments
+    -----------------
+    population : ndarray
+        the array containing all the population information
+
+    neighbour_list : Neighbour_list
+        cached pairs of people near each other, see spatial.Neighbour_list.
+        Its cutoff must be at least 'radius'
+
+    distancing : ndarray
+        boolean array, True for those practicing social distancing
+
+    radius : float
+        the distance within which others are avoided
+
+    strength : float
+        how much each neighbour changes the heading
+    '''
+    i, j = neighbour_list.pairs_within(population, radius)
+    dx = population[:,1][i] - population[:,1][j]
+    dy = population[:,2][i] - population[:,2][j]
+    distance = np.sqrt(dx**2 + dy**2)
+    close = (distance < radius) & (distance > 0)
+    i, j, distance = i[close], j[close], distance[close]
+    dx = dx[close] / distance
+    dy = dy[close] / distance
+
+    #i is pushed along (dx, dy), j the opposite way
+    steer_i = distancing[i]
+    steer_j = distancing[j]
+    people = np.concatenate([i[steer_i], j[steer_j]])
+    push_x = np.concatenate([dx[steer_i], -dx[steer_j]])
+    push_y = np.concatenate([dy[steer_i], -dy[steer_j]])
+    if len(people) == 0:
+        return population
+
+    steered = np.unique(people)
+    position = np.searchsorted(steered, people)
+    population[:,3][steered] = np.clip(population[:,3][steered] + strength *
+                                       np.bincount(position, push_x, minlength = len(steered)),
+                                       a_min = -1, a_max = 1)
+    population[:,4][steered] = np.clip(population[:,4][steered] + strength *
+                                       np.bincount(position, push_y, minlength = len(steered)),
+                                       a_min = -1, a_max = 1)
+    return population
+
+class Motion_kernel():
+    '''fused, in-place motion step
+
+    Does the work of out_of_bounds, update_randoms and update_positions in
+    one step, writing straight into the population and reusing scratch
+    buffers that are allocated once, so no arrays the size of the
+    population are allocated per timestep. Only those whose heading
+    or speed changes are sampled (see sample_events), from a numpy
+    Generator seeded from numpy's global random state when the kernel
+    is created.
+
+    The kernel keeps an index of who can move. The dead are retired for
+    good (see retire), and during a lockdown those complying can be held
+    in place (see hold). When many people are stopped, only the movers are
+    gathered into a compact buffer, moved, and written back, so the cost
+    of a step depends on the number of movers rather than the population.
+
+    Keyword arguments
+    -----------------
+    pop_size : int
+        the size of the population the kernel is used on
+    '''
+    def __init__(self, pop_size):
+        self.rng = np.random.default_rng(np.random.randint(0, 2**31))
+        self.allocate(pop_size)
+
+
+    def allocate(self, pop_size):
+        '''(re-)allocates all buffers for a population of pop_size'''
+        self.pop_size = pop_size
+        self.scratch = np.zeros((pop_size,))
+        self.mask = np.zeros((pop_size,), dtype=bool)
+        self.condition = np.zeros((pop_size,), dtype=bool)
+        self.wandering = np.zeros((pop_size,), dtype=bool)
+        self.old_x = np.zeros((pop_size,))
+        self.old_y = np.zeros((pop_size,))
+
+        #who cannot move, and a cached index of those who can
+        self.retired = np.zeros((pop_size,), dtype=bool)
+        self.held = np.zeros((pop_size,), dtype=bool)
+        self.movers = None
+        self.stopped = None
+        self.moving = None
+
+
+    def retire(self, population, ids):
+        '''stops ids from moving for good, for example the dead
+
+        Their heading and speed are set to 0, and they are left out of all
+        following steps. Those already retired are skipped, so the index of
+        movers is only rebuilt when someone new is retired.
+        '''
+        ids = np.asarray(ids, dtype=np.int64)
+        ids = ids[~self.retired[ids]]
+        if len(ids) == 0:
+            return population
+        population[:,3][ids] = 0
+        population[:,4][ids] = 0
+        population[:,5][ids] = 0
+        self.retired[ids] = True
+        self.movers = None
+        return population
+
+
+    def hold(self, ids=None):
+        '''keeps ids in place until hold is called again, nobody if None
+
+        Unlike the retired, those held keep their heading and speed,
+        and move on from where they were when they are released.
+        '''
+        self.held[:] = False
+        if ids is not None:
+            self.held[ids] = True
+        self.movers = None
+
+
+    def clear(self, pop_size=None):
+        '''lets everyone move again, for a new population
+
+        If pop_size is given and differs from the current one,
+        the buffers are resized to it first (see allocate).
+        '''
+        if pop_size is not None and pop_size != self.pop_size:
+            self.allocate(pop_size)
+        self.retired[:] = False
+        self.held[:] = False
+        self.movers = None
+
+
+    def get_movers(self):
+        '''returns the indices of everyone who is not retired or held'''
+        if self.movers is None:
+            stopped = self.retired | self.held
+            self.movers = np.flatnonzero(~stopped)
+            self.stopped = np.flatnonzero(stopped)
+        return self.movers
+
+
+    def reflect(self, population, position, heading, lower, upper):
+        '''turns around those past a bound that are heading further out'''
+        n = len(population)
+        mask = self.mask[:n]
+        condition = self.condition[:n]
+        wandering = self.wandering[:n]
+
+        #lower bound, heading negative
+        np.less_equal(population[:,position], lower, out=mask)
+        np.less(population[:,heading], 0, out=condition)
+        np.logical_and(mask, condition, out=mask)
+        np.logical_and(mask, wandering, out=mask)
+        count = np.count_nonzero(mask)
+        if count > 0:
+            population[:,heading][mask] = np.clip(self.rng.normal(0.5, 0.5 / 3, count),
+                                                  a_min = 0.05, a_max = 1)
+
+        #upper bound, heading positive
+        np.greater_equal(population[:,position], upper, out=mask)
+        np.greater(population[:,heading], 0, out=condition)
+        np.logical_and(mask, condition, out=mask)
+        np.logical_and(mask, wandering, out=mask)
+        count = np.count_nonzero(mask)
+        if count > 0:
+            population[:,heading][mask] = np.clip(-self.rng.normal(0.5, 0.5 / 3, count),
+                                                  a_min = -1, a_max = -0.05)
+
+
+    def resample(self, population, column, chance, loc, scale):
+        '''redraws the values of a column for each member with given chance'''
+        update = sample_events(len(population), chance, self.rng)
+        if len(update) > 0:
+            population[:,column][update] = self.rng.normal(loc, scale, len(update))
+
+
+    def step(self, population, Config, randomize=True, frozen=None,
+             heading_update_chance=0.02, speed_update_chance=0.02, environment=None):
+        '''moves the population one timestep
+
+        Turns around those without an active destination who are at the
+        world bounds (see out_of_bounds), randomly updates headings and
+        speeds (see update_randoms), and updates positions (see
+        update_positions). With a torus world (Config.boundary), no one is
+        turned around, but those without an active destination leaving the
+        world are wrapped around (see wrap_around). Those with an active
+        destination are kept within its bounds by keep_at_destination
+        instead. The retired and those held are left alone.
+
+        Keyword arguments
+        -----------------
+        population : ndarray
+            the array containing all the population information
+
+        Config : Configuration
+            used for the world bounds (Config.xbounds and Config.ybounds)
+            and the mean speed (Config.speed)
+
+        randomize : bool
+            whether to randomly update headings and speeds, set to False
+            for example during a lockdown
+
+        frozen : ndarray or None
+            indices of people who stop moving for good, for example
+            the dead. They are retired (see retire) before moving.
+
+        heading_update_chance : float
+            the odds of updating the heading of each member, each time step
+
+        speed_update_chance : float
+            the odds of updating the speed of each member, each time step
+
+        environment : Environment or None
+            if given, nobody can move through its walls
+        '''
+        if frozen is not None and len(frozen) > 0:
+            self.retire(population, frozen)
+        movers = self.get_movers()
+
+        #with few stopped, moving everyone and stopping those few is cheaper
+        if not self.held.any() and len(self.stopped) <= len(population) / 2:
+            return self._step(population, Config, randomize, self.stopped,
+                              heading_update_chance, speed_update_chance, environment)
+
+        if len(movers) == 0:
+            return population
+        if self.moving is None:
+            self.moving = np.zeros(population.shape)
+        moving = self.moving[:len(movers)]
+        if hasattr(population, 'columns'):
+            #columnar population, gather column by column rather than as a matrix
+            for col, column in enumerate(population.columns):
+                moving[:,col] = column[movers]
+        else:
+            np.take(population, movers, axis=0, out=moving)
+        self._step(moving, Config, randomize, None,
+                   heading_update_chance, speed_update_chance, environment)
+        #only positions, headings and speeds change
+        population[movers,1:6] = moving[:,1:6]
+        return population
+
+
+    def _step(self, population, Config, randomize, stopped,
+              heading_update_chance, speed_update_chance, environment):
+        '''moves all rows of population, see step'''
+        n = len(population)
+
+        #bounds only apply to those without a destination
+        wandering = self.wandering[:n]
+        np.equal(population[:,11], 0, out=wandering)
+        if Config.boundary == 'reflect':
+            self.reflect(population, 1, 3, Config.xbounds[0] + 0.02, Config.xbounds[1] - 0.02)
+            self.reflect(population, 2, 4, Config.ybounds[0] + 0.02, Config.ybounds[1] - 0.02)
+
+        if randomize:
+            self.resample(population, 3, heading_update_chance, 0, 1 / 3)
+            self.resample(population, 4, heading_update_chance, 0, 1 / 3)
+            self.resample(population, 5, speed_update_chance, Config.speed, Config.speed / 3)
+            np.clip(population[:,5], 0.0001, 0.05, out=population[:,5])
+
+        #the stopped may have been resampled as well, stop them again
+        if stopped is not None and len(stopped) > 0:
+            population[:,3][stopped] = 0
+            population[:,4][stopped] = 0
+            population[:,5][stopped] = 0
+
+        if environment is not None:
+            self.old_x[:n] = population[:,1]
+            self.old_y[:n] = population[:,2]
+
+        #update positions
+        scratch = self.scratch[:n]
+        np.multiply(population[:,3], population[:,5], out=scratch)
+        np.add(population[:,1], scratch, out=population[:,1], casting='same_kind')
+        np.multiply(population[:,4], population[:,5], out=scratch)
+        np.add(population[:,2], scratch, out=population[:,2], casting='same_kind')
+
+        if environment is not None:
+            environment.collide(population, self.old_x[:n], self.old_y[:n])
+
+        if Config.boundary == 'torus':
+            #wrap those without a destination, so nobody leaves theirs
+            for position, bounds in [[1, Config.xbounds], [2, Config.ybounds]]:
+                np.subtract(population[:,position], bounds[0], out=scratch)
+                np.mod(scratch, bounds[1] - bounds[0], out=scratch)
+                np.add(scratch, bounds[0], out=scratch)
+                np.copyto(population[:,position], scratch, where=wandering, casting='same_kind')
+
+        return population
+
+
 def get_motion_parameters(xmin, ymin, xmax, ymax):
     '''gets destination center and wander ranges
 
@@ -0,0 +1,341 @@
+'''
+contains Numba compiled versions of the functions on the hot path of
+Simulation.tstep, and the logic to select between them and the NumPy versions
+
+Numba is optional: if it cannot be imported, select_backend falls back
+to the NumPy implementations. Compiled functions are cached on disk
+(next to this file, in __pycache__), so the JIT cost is only paid on the
+first run.
+
+Note that compiled functions draw from Numba's own random generator,
+which is not affected by np.random.seed. Use seed() to seed it.
+'''
+
+from types import SimpleNamespace
+
+import numpy as np
+
+import infection
+import motion
+
+try:
+    from numba import njit, prange
+    numba_available = True
+except ImportError:
+    numba_available = False
+
+
+if numba_available:
+
+    @njit(cache=True)
+    def _seed(seed):
+        np.random.seed(seed)
+
+
+    @njit(parallel=True, cache=True)
+    def _update_positions(population):
+        for i in prange(population.shape[0]):
+            population[i,1] += population[i,3] * population[i,5]
+            population[i,2] += population[i,4] * population[i,5]
+
+
+    @njit(cache=True)
+    def _out_of_bounds(population, ids, xbounds, ybounds):
+        #bounds are either one row shared by everyone, or one row per id
+        for k in range(len(ids)):
+            i = ids[k]
+            b = k if xbounds.shape[0] > 1 else 0
+            #update x heading
+            if population[i,1] <= xbounds[b,0] and population[i,3] < 0:
+                population[i,3] = min(max(np.random.normal(0.5, 0.5 / 3), 0.05), 1)
+            if population[i,1] >= xbounds[b,1] and population[i,3] > 0:
+                population[i,3] = min(max(-np.random.normal(0.5, 0.5 / 3), -1), -0.05)
+            #update y heading
+            if population[i,2] <= ybounds[b,0] and population[i,4] < 0:
+                population[i,4] = min(max(np.random.normal(0.5, 0.5 / 3), 0.05), 1)
+            if population[i,2] >= ybounds[b,1] and population[i,4] > 0:
+                population[i,4] = min(max(-np.random.normal(0.5, 0.5 / 3), -1), -0.05)
+
+
+    @njit(cache=True)
+    def _resample(population, column, chance, loc, scale, factor=1.0):
+        #skip ahead to the next member to update, so only they are sampled
+        if chance <= 0:
+            return
+        i = -1
+        while True:
+            i += 1 if chance >= 1 else np.random.geometric(chance)
+            if i >= population.shape[0]:
+                break
+            population[i,column] = np.random.normal(loc, scale) * factor
+
+
+    @njit(cache=True)
+    def _update_randoms(population, speed, heading_update_chance, speed_update_chance,
+                        heading_multiplication, speed_multiplication):
+        _resample(population, 3, heading_update_chance, 0, 1 / 3, heading_multiplication)
+        _resample(population, 4, heading_update_chance, 0, 1 / 3, heading_multiplication)
+        _resample(population, 5, speed_update_chance, speed, speed / 3, speed_multiplication)
+        for i in range(population.shape[0]):
+            population[i,5] = min(max(population[i,5], 0.0001), 0.05)
+
+
+    @njit(cache=True)
+    def _resample_rows(population, rows, column, chance, loc, scale):
+        #like _resample, over the given rows only
+        if chance <= 0:
+            return
+        k = -1
+        while True:
+            k += 1 if chance >= 1 else np.random.geometric(chance)
+            if k >= len(rows):
+                break
+            population[rows[k],column] = np.random.normal(loc, scale)
+
+
+    @njit(cache=True)
+    def _motion_step(population, movers, xmin, xmax, ymin, ymax, reflect, wrap, randomize,
+                     speed, heading_update_chance, speed_update_chance):
+        for k in range(len(movers)):
+            i = movers[k]
+            #turn around those without destination that are at the bounds
+            if reflect and population[i,11] == 0:
+                if population[i,1] <= xmin and population[i,3] < 0:
+                    population[i,3] = min(max(np.random.normal(0.5, 0.5 / 3), 0.05), 1)
+                if population[i,1] >= xmax and population[i,3] > 0:
+                    population[i,3] = min(max(-np.random.normal(0.5, 0.5 / 3), -1), -0.05)
+                if population[i,2] <= ymin and population[i,4] < 0:
+                    population[i,4] = min(max(np.random.normal(0.5, 0.5 / 3), 0.05), 1)
+                if population[i,2] >= ymax and population[i,4] > 0:
+                    population[i,4] = min(max(-np.random.normal(0.5, 0.5 / 3), -1), -0.05)
+
+        #update headings and speeds
+        if randomize:
+            _resample_rows(population, movers, 3, heading_update_chance, 0, 1 / 3)
+            _resample_rows(population, movers, 4, heading_update_chance, 0, 1 / 3)
+            _resample_rows(population, movers, 5, speed_update_chance, speed, speed / 3)
+
+        for k in range(len(movers)):
+            i = movers[k]
+            if randomize:
+                population[i,5] = min(max(population[i,5], 0.0001), 0.05)
+            population[i,1] += population[i,3] * population[i,5]
+            population[i,2] += population[i,4] * population[i,5]
+            #with a torus, those without destination leaving come back in on the
+            #opposite side, those with one are kept there by keep_at_destination
+            if wrap and population[i,11] == 0:
+                population[i,1] = xmin + (population[i,1] - xmin) % (xmax - xmin)
+                population[i,2] = ymin + (population[i,2] - ymin) % (ymax - ymin)
+
+
+    @njit(cache=True)
+    def _cell_hash(cx, cy, mask):
+        return ((cx * 73856093) ^ (cy * 19349663)) & mask
+
+
+    @njit(parallel=True, cache=True)
+    def _count_exposures(population, infected, healthy, infection_range):
+        exposures = np.zeros(population.shape[0], dtype=np.int64)
+
+        #bin the infected in cells of infection_range, hashed into a table of
+        #about twice as many buckets as infected, so its size does not depend
+        #on how far apart people are (such as ensemble replicas laid side by side)
+        cell_size = infection_range * (1 + 1e-6)
+        x = population[infected,1]
+        y = population[infected,2]
+        xmin = x.min()
+        ymin = y.min()
+        cells_x = np.floor((x - xmin) / cell_size).astype(np.int64)
+        cells_y = np.floor((y - ymin) / cell_size).astype(np.int64)
+
+        buckets = 64
+        while buckets < 2 * len(infected):
+            buckets *= 2
+        mask = buckets - 1
+
+        keys = np.empty(len(infected), dtype=np.int64)
+        for k in range(len(infected)):
+            keys[k] = _cell_hash(cells_x[k], cells_y[k], mask)
+        starts = np.zeros(buckets + 1, dtype=np.int64)
+        for key in keys:
+            starts[key + 1] += 1
+        starts = np.cumsum(starts)
+        fill = starts[:-1].copy()
+        members = np.zeros(len(infected), dtype=np.int64)
+        for k in range(len(keys)):
+            members[fill[keys[k]]] = k
+            fill[keys[k]] += 1
+
+        #every healthy person only writes their own count, so this is safe in parallel
+        for k in prange(len(healthy)):
+            j = healthy[k]
+            cx = np.int64(np.floor((population[j,1] - xmin) / cell_size))
+            cy = np.int64(np.floor((population[j,2] - ymin) / cell_size))
+            count = 0
+            for ix in range(cx - 1, cx + 2):
+                for iy in range(cy - 1, cy + 2):
+                    key = _cell_hash(ix, iy, mask)
+                    for m in range(starts[key], starts[key + 1]):
+                        #cells sharing a bucket are skipped, so nobody is counted twice
+                        if cells_x[members[m]] != ix or cells_y[members[m]] != iy:
+                            continue
+                        i = infected[members[m]]
+                        if ((population[i,1] - infection_range) < population[j,1] and
+                            population[j,1] < (population[i,1] + infection_range) and
+                            (population[i,2] - infection_range) < population[j,2] and
+                            population[j,2] < (population[i,2] + infection_range)):
+                            count += 1
+            exposures[j] = count
+
+        return exposures
+
+
+    @njit(parallel=True, cache=True)
+    def _mortality_chances(ages, in_treatment, mortality_table, mortality_chance,
+                           age_dependent_risk, treatment_dependent_risk,
+                           treatment_factor, no_treatment_factor):
+        chances = np.empty(len(ages))
+        for k in prange(len(ages)):
+            if age_dependent_risk:
+                age = min(max(np.int64(ages[k]), 0), len(mortality_table) - 1)
+                chances[k] = mortality_table[age]
+            else:
+                chances[k] = mortality_chance
+            if treatment_dependent_risk:
+                if in_treatment[k] == 1:
+                    chances[k] *= treatment_factor
+                else:
+                    chances[k] *= no_treatment_factor
+        return chances
+
+
+def seed(seed):
+    '''seeds the random generator used by the compiled functions'''
+    if numba_available:
+        _seed(seed)
+
+
+def update_positions(population):
+    '''compiled version of motion.update_positions'''
+    _update_positions(population)
+    return population
+
+
+def out_of_bounds(population, xbounds, ybounds, ids=None):
+    '''compiled version of motion.out_of_bounds'''
+    if ids is None:
+        ids = np.arange(len(population))
+    _out_of_bounds(population, np.asarray(ids, dtype=np.int64),
+                   np.asarray(xbounds, dtype=np.float64).reshape(-1, 2),
+                   np.asarray(ybounds, dtype=np.float64).reshape(-1, 2))
+    return population
+
+
+def update_randoms(population, pop_size, speed=0.01, heading_update_chance=0.02,
+                   speed_update_chance=0.02, heading_multiplication=1,
+                   speed_multiplication=1):
+    '''compiled version of motion.update_randoms'''
+    _update_randoms(population, speed, heading_update_chance, speed_update_chance,
+                    heading_multiplication, speed_multiplication)
+    return population
+
+
+class Motion_kernel(motion.Motion_kernel):
+    '''compiled version of motion.Motion_kernel
+
+    Needs no scratch buffers, as all work is done row by row, looping
+    over the index of movers only. With an environment, positions before
+    moving are copied for the collision check.
+    '''
+    def __init__(self, pop_size):
+        self.allocate(pop_size)
+
+    def allocate(self, pop_size):
+        self.pop_size = pop_size
+        self.retired = np.zeros((pop_size,), dtype=bool)
+        self.held = np.zeros((pop_size,), dtype=bool)
+        self.movers = None
+        self.stopped = None
+
+    def step(self, population, Config, randomize=True, frozen=None,
+             heading_update_chance=0.02, speed_update_chance=0.02, environment=None):
+        if frozen is not None and len(frozen) > 0:
+            self.retire(population, frozen)
+        movers = self.get_movers()
+
+        torus = Config.boundary == 'torus'
+        if torus:
+            bounds = [Config.xbounds[0], Config.xbounds[1], Config.ybounds[0], Config.ybounds[1]]
+        else:
+            bounds = [Config.xbounds[0] + 0.02, Config.xbounds[1] - 0.02,
+                      Config.ybounds[0] + 0.02, Config.ybounds[1] - 0.02]
+
+        if environment is None:
+            _motion_step(population, movers, *bounds, not torus, torus, randomize,
+                         Config.speed, heading_update_chance, speed_update_chance)
+        else:
+            #check collisions before wrapping around
+            old_x = population[:,1].copy()
+            old_y = population[:,2].copy()
+            _motion_step(population, movers, *bounds, not torus, False, randomize,
+                         Config.speed, heading_update_chance, speed_update_chance)
+            environment.collide(population, old_x, old_y)
+            if torus:
+                motion.wrap_around(population, Config.xbounds, Config.ybounds,
+                                   ids = movers[population[:,11][movers] == 0])
+        return population
+
+
+def count_exposures(population, infected, healthy, infection_range):
+    '''compiled version of infection.count_exposures'''
+    return _count_exposures(population, np.asarray(infected, dtype=np.int64),
+                            np.asarray(healthy, dtype=np.int64), infection_range)
+
+
+def get_mortality_chances(population, indices, Config):
+    '''compiled version of infection.get_mortality_chances'''
+    return _mortality_chances(population[:,7][indices], population[:,10][indices],
+                              infection.get_mortality_table(Config), Config.mortality_chance,
+                              Config.age_dependent_risk, Config.treatment_dependent_risk,
+                              Config.treatment_factor, Config.no_treatment_factor)
+
+
+def infect(*args, **kwargs):
+    '''infection.infect, counting exposures with the compiled kernel unless another is given'''
+    kwargs.setdefault('exposure_kernel', count_exposures)
+    return infection.infect(*args, **kwargs)
+
+
+def recover_or_die(*args, **kwargs):
+    '''infection.recover_or_die, computing mortality with the compiled kernel'''
+    return infection.recover_or_die(*args, mortality_kernel=get_mortality_chances, **kwargs)
+
+
+def select_backend(name='numpy'):
+    '''returns the set of hot path functions to use
+
+    Keyword arguments
+    -----------------
+    name : str
+        'numpy' or 'numba'. If 'numba' is requested but Numba cannot be
+        imported, the NumPy functions are returned.
+    '''
+
+    if name.lower() == 'numba' and numba_available:
+        return SimpleNamespace(name='numba',
+                               update_positions=update_positions,
+                               out_of_bounds=out_of_bounds,
+                               update_randoms=update_randoms,
+                               Motion_kernel=Motion_kernel,
+                               infect=infect,
+                               recover_or_die=recover_or_die)
+    elif name.lower() in ['numpy', 'numba']:
+        return SimpleNamespace(name='numpy',
+                               update_positions=motion.update_positions,
+                               out_of_bounds=motion.out_of_bounds,
+                               update_randoms=motion.update_randoms,
+                               Motion_kernel=motion.Motion_kernel,
+                               infect=infection.infect,
+                               recover_or_die=infection.recover_or_die)
+    else:
+        raise ValueError('backend %s not understood! Must be either \'numpy\' or \'numba\'' %name)
@@ -5,7 +5,8 @@ and path planning
 
 import numpy as np
 
-from motion import get_motion_parameters, update_randoms, out_of_bounds
+from motion import get_motion_parameters, out_of_bounds
+from population import set_active_destination
 
 def go_to_location(patient, destination, location_bounds, dest_no=1):
     '''sends patient to defined location
@@ -29,9 +30,7 @@ def go_to_location(patient, destination, location_bounds, dest_no=1):
         the location number, used as index for destinations array if multiple possible
         destinations are defined`.
 
-
-    TODO: vectorize
-
+    To send many people at once, use go_to_locations instead.
     '''
 
     x_center, y_center, x_wander, y_wander = get_motion_parameters(location_bounds[0],
@@ -49,7 +48,80 @@ def go_to_location(patient, destination, location_bounds, dest_no=1):
     return patient, destination
 
 
-def set_destination(population, destinations):
+def go_to_locations(population, destinations, ids, location_bounds, dest_no=1,
+                    registry=None):
+    '''sends everyone in ids to defined locations
+
+    Batched version of go_to_location: sets the wander ranges, destination
+    centers and active destination of all ids in one operation.
+
+    Keyword arguments
+    -----------------
+    population : ndarray
+        the array containing all the population information
+
+    destinations : ndarray
+        the array containing all destinations information
+
+    ids : ndarray or list
+        indices of the people to send
+
+    location_bounds : list, tuple or ndarray
+        defines bounds for the location people will roam in when sent there.
+        Either one location for everyone, format: [xmin, ymin, xmax, ymax],
+        or an array of shape (len(ids), 4) with a location per person.
+
+    dest_no : int or ndarray
+        the location number, used as index for destinations array. Either
+        one number for everyone, or an array with a number per person.
+        0 clears the active destination.
+
+    registry : State_registry or None
+        if given, kept up to date with the new active destinations
+    '''
+    ids = np.asarray(ids, dtype=np.int64)
+    if len(ids) == 0:
+        return population, destinations
+
+    location_bounds = np.asarray(location_bounds, dtype=np.float64)
+    x_center, y_center, x_wander, y_wander = get_motion_parameters(location_bounds[...,0],
+                                                                    location_bounds[...,1],
+                                                                    location_bounds[...,2],
+                                                                    location_bounds[...,3])
+    population[:,13][ids] = x_wander
+    population[:,14][ids] = y_wander
+
+    #destination 0 means no destination, so has no center to set
+    dest_no = np.broadcast_to(np.asarray(dest_no, dtype=np.int64), ids.shape)
+    x_center = np.broadcast_to(x_center, ids.shape)
+    y_center = np.broadcast_to(y_center, ids.shape)
+    active = dest_no != 0
+    destinations[ids[active], (dest_no[active] - 1) * 2] = x_center[active]
+    destinations[ids[active], ((dest_no[active] - 1) * 2) + 1] = y_center[active]
+
+    set_active_destination(population, ids, dest_no, registry)
+
+    return population, destinations
+
+
+def get_destination_ids(population, registry=None):
+    '''returns sorted indices of everyone with an active destination'''
+    if registry is not None:
+        return registry.destination.indices()
+    return np.flatnonzero(population[:,11] != 0)
+
+
+def get_destination_coordinates(population, destinations, ids):
+    '''returns the x and y coordinates of the active destination of each of ids
+
+    Looks up every person's own destination in one go, so people with
+    different destinations are handled together.
+    '''
+    columns = (population[:,11][ids].astype(np.int64) - 1) * 2
+    return destinations[ids, columns], destinations[ids, columns + 1]
+
+
+def set_destination(population, destinations, ids=None):
     '''sets destination of population
 
     Sets the destination of population if destination marker is not 0.
@@ -62,38 +134,30 @@ def set_destination(population, destinations):
 
     destinations : ndarray
         the array containing all destinations information
+
+    ids : ndarray or None
+        indices of everyone with an active destination, see
+        get_destination_ids. Computed if not given.
     '''
-    
-    #how many destinations are active
-    active_dests = np.unique(population[:,11][population[:,11] != 0])
-
-    #set destination
-    for d in active_dests:
-        dest_x = destinations[:,int((d - 1) * 2)]
-        dest_y = destinations[:,int(((d - 1) * 2) + 1)]
-
-        #compute new headings
-        head_x = dest_x - population[:,1]
-        head_y = dest_y - population[:,2]
-
-        #head_x = head_x / np.sqrt(head_x)
-        #head_y = head_y / np.sqrt(head_y)
-
-        #reinsert headings into population of those not at destination yet
-        population[:,3][(population[:,11] == d) &
-                        (population[:,12] == 0)] = head_x[(population[:,11] == d) &
-                                                            (population[:,12] == 0)]
-        population[:,4][(population[:,11] == d) &
-                        (population[:,12] == 0)] = head_y[(population[:,11] == d) &
-                                                            (population[:,12] == 0)]
-        #set speed to 0.01
-        population[:,5][(population[:,11] == d) &
-                        (population[:,12] == 0)] = 0.02
+    if ids is None:
+        ids = get_destination_ids(population)
+
+    #only those not at destination yet
+    ids = ids[population[:,12][ids] == 0]
+    dest_x, dest_y = get_destination_coordinates(population, destinations, ids)
+
+    #compute new headings
+    population[:,3][ids] = dest_x - population[:,1][ids]
+    population[:,4][ids] = dest_y - population[:,2][ids]
+
+    #set speed to 0.02
+    population[:,5][ids] = 0.02
 
     return population
 
 
-def check_at_destination(population, destinations, wander_factor=1.5, speed = 0.01):
+def check_at_destination(population, destinations, wander_factor=1.5, speed = 0.01,
+                         ids=None):
     '''check who is at their destination already
 
     Takes subset of population with active destination and
@@ -111,40 +175,34 @@ def check_at_destination(population, destinations, wander_factor=1.5, speed = 0.
     wander_factor : int or float
         defines how far outside of 'wander range' the destination reached
         is triggered
-    '''
-
-    #how many destinations are active
-    active_dests = np.unique(population[:,11][(population[:,11] != 0)])
-
-    #see who is at destination
-    for d in active_dests:
-        dest_x = destinations[:,int((d - 1) * 2)]
-        dest_y = destinations[:,int(((d - 1) * 2) + 1)]
-
-        #see who arrived at destination and filter out who already was there
-        at_dest = population[(np.abs(population[:,1] - dest_x) < (population[:,13] * wander_factor)) & 
-                                (np.abs(population[:,2] - dest_y) < (population[:,14] * wander_factor)) &
-                                (population[:,12] == 0)]
-
-        if len(at_dest) > 0:
-            #mark those as arrived
-            at_dest[:,12] = 1
-            #insert random headings and speeds for those at destination
-            at_dest = update_randoms(at_dest, pop_size = len(at_dest), speed = speed,
-                                     heading_update_chance = 1, speed_update_chance = 1)
-
-            #at_dest[:,5] = 0.001
-
-            #reinsert into population
-            population[(np.abs(population[:,1] - dest_x) < (population[:,13] * wander_factor)) & 
-                        (np.abs(population[:,2] - dest_y) < (population[:,14] * wander_factor)) &
-                        (population[:,12] == 0)] = at_dest
 
+    ids : ndarray or None
+        indices of everyone with an active destination, see
+        get_destination_ids. Computed if not given.
+    '''
+    if ids is None:
+        ids = get_destination_ids(population)
+
+    #see who arrived at destination and filter out who already was there
+    ids = ids[population[:,12][ids] == 0]
+    dest_x, dest_y = get_destination_coordinates(population, destinations, ids)
+    at_dest = ids[(np.abs(population[:,1][ids] - dest_x) < (population[:,13][ids] * wander_factor)) &
+                  (np.abs(population[:,2][ids] - dest_y) < (population[:,14][ids] * wander_factor))]
+
+    if len(at_dest) > 0:
+        #mark those as arrived
+        population[:,12][at_dest] = 1
+        #insert random headings and speeds for those at destination
+        population[:,3][at_dest] = np.random.normal(loc = 0, scale = 1/3, size = at_dest.shape)
+        population[:,4][at_dest] = np.random.normal(loc = 0, scale = 1/3, size = at_dest.shape)
+        population[:,5][at_dest] = np.clip(np.random.normal(loc = speed, scale = speed / 3,
+                                                            size = at_dest.shape),
+                                           a_min = 0.0001, a_max = 0.05)
 
     return population
         
 
-def keep_at_destination(population, destinations, wander_factor=1):
+def keep_at_destination(population, destinations, wander_factor=1, ids=None):
     '''keeps those who have arrived, within wander range
 
     Function that keeps those who have been marked as arrived at their
@@ -161,59 +219,40 @@ def keep_at_destination(population, destinations, wander_factor=1):
     wander_factor : int or float
         defines how far outside of 'wander range' the destination reached
         is triggered
-    ''' 
-
-    #how many destinations are active
-    active_dests = np.unique(population[:,11][(population[:,11] != 0) &
-                                                (population[:,12] == 1)])
 
-    for d in active_dests:
-        dest_x = destinations[:,int((d - 1) * 2)][(population[:,12] == 1) &
-                                                    (population[:,11] == d)]
-        dest_y = destinations[:,int(((d - 1) * 2) + 1)][(population[:,12] == 1) &
-                                                        (population[:,11] == d)]
-
-        #see who is marked as arrived
-        arrived = population[(population[:,12] == 1) &
-                                (population[:,11] == d)]
+    ids : ndarray or None
+        indices of everyone with an active destination, see
+        get_destination_ids. Computed if not given.
+    ''' 
+    if ids is None:
+        ids = get_destination_ids(population)
+
+    #see who is marked as arrived
+    arrived = ids[population[:,12][ids] == 1]
+    dest_x, dest_y = get_destination_coordinates(population, destinations, arrived)
+    x = population[:,1][arrived]
+    y = population[:,2][arrived]
+    x_wander = population[:,13][arrived] * wander_factor
+    y_wander = population[:,14][arrived] * wander_factor
+
+    #check if there are those out of bounds
+    #where x larger than destination + wander, set heading negative
+    out = arrived[x > (dest_x + x_wander)]
+    population[:,3][out] = -np.random.normal(loc = 0.5, scale = 0.5 / 3, size = out.shape)
+    #where x smaller than destination - wander, set heading positive
+    out = arrived[x < (dest_x - x_wander)]
+    population[:,3][out] = np.random.normal(loc = 0.5, scale = 0.5 / 3, size = out.shape)
+    #where y larger than destination + wander, set heading negative
+    out = arrived[y > (dest_y + y_wander)]
+    population[:,4][out] = -np.random.normal(loc = 0.5, scale = 0.5 / 3, size = out.shape)
+    #where y smaller than destination - wander, set heading positive
+    out = arrived[y < (dest_y - y_wander)]
+    population[:,4][out] = np.random.normal(loc = 0.5, scale = 0.5 / 3, size = out.shape)
+
+    #slow speed
+    population[:,5][arrived] = np.random.normal(loc = 0.005, scale = 0.005 / 3,
+                                                size = arrived.shape)
 
-        ids = np.int32(arrived[:,0]) # find unique IDs of arrived persons
-        
-        #check if there are those out of bounds
-        #replace x oob
-        #where x larger than destination + wander, AND heading wrong way, set heading negative
-        shp = arrived[:,3][arrived[:,1] > (dest_x + (arrived[:,13] * wander_factor))].shape
-
-        arrived[:,3][arrived[:,1] > (dest_x + (arrived[:,13] * wander_factor))] = -np.random.normal(loc = 0.5,
-                                                                scale = 0.5 / 3,
-                                                                size = shp)
-
-
-        #where x smaller than destination - wander, set heading positive
-        shp = arrived[:,3][arrived[:,1] < (dest_x - (arrived[:,13] * wander_factor))].shape
-        arrived[:,3][arrived[:,1] < (dest_x - (arrived[:,13] * wander_factor))] = np.random.normal(loc = 0.5,
-                                                            scale = 0.5 / 3,
-                                                            size = shp)
-        #where y larger than destination + wander, set heading negative
-        shp = arrived[:,4][arrived[:,2] > (dest_y + (arrived[:,14] * wander_factor))].shape
-        arrived[:,4][arrived[:,2] > (dest_y + (arrived[:,14] * wander_factor))] = -np.random.normal(loc = 0.5,
-                                                                scale = 0.5 / 3,
-                                                                size = shp)
-        #where y smaller than destination - wander, set heading positive
-        shp = arrived[:,4][arrived[:,2] < (dest_y - (arrived[:,14] * wander_factor))].shape
-        arrived[:,4][arrived[:,2] < (dest_y - (arrived[:,14] * wander_factor))] = np.random.normal(loc = 0.5,
-                                                            scale = 0.5 / 3,
-                                                            size = shp)
-
-        #slow speed
-        arrived[:,5] = np.random.normal(loc = 0.005,
-                                        scale = 0.005 / 3, 
-                                        size = arrived[:,5].shape)
-
-        #reinsert into population
-        population[(population[:,12] == 1) &
-                    (population[:,11] == d)] = arrived
-                                
     return population
 
 
@@ -243,7 +282,8 @@ def reset_destinations(population, ids=[]):
     
     pass
 
-def update_pops_destination(population, destinations, Config):
+def update_pops_destination(population, destinations, Config, registry=None,
+                            backend=None, check_bounds=True, schedule=None, frame=0):
     '''update the destination of population at one time
 
     Function that aggragate set_destination, check_at_destination 
@@ -258,31 +298,55 @@ def update_pops_destination(population, destinations, Config):
 
     destinations : ndarray
         the array containing all destinations information
+
+    registry : State_registry or None
+        if given, used to find those with an active destination
+
+    backend : SimpleNamespace or None
+        the backend from numba_backend.select_backend to take out_of_bounds
+        from. If None, motion.out_of_bounds is used.
+
+    check_bounds : bool
+        whether to turn around those without destination at the world bounds.
+        Set to False if this is done by a Motion_kernel instead.
+
+    schedule : Travel_schedule or None
+        if given, everyone due to leave at 'frame' is first sent to the
+        next destination on their schedule
+
+    frame : int
+        the current timestep, used with schedule
     '''
     #check destinations if active
     #define motion vectors if destinations active and not everybody is at destination
     
-    active_dests_length = len(population[population[:,11] != 0])
-    at_destination_length = len(population[population[:,12] == 1])
+    if schedule is not None:
+        population = schedule.apply(population, frame, registry)
+
+    ids = get_destination_ids(population, registry)
+    active_dests_length = len(ids)
+    at_destination_length = np.count_nonzero(population[:,12][ids] == 1)
     population_length = len(population)
 
     if active_dests_length > 0:
-        if at_destination_length < population_length:
-            population = set_destination(population,destinations)
+        if at_destination_length < active_dests_length:
+            population = set_destination(population, destinations, ids)
             population = check_at_destination(population, destinations,
                                                 wander_factor = Config.wander_factor_dest,
-                                                speed = Config.speed)
+                                                speed = Config.speed, ids = ids)
             
         if at_destination_length > 0:
             # Keep them at destination
             population = keep_at_destination(population, destinations,
-                                                Config.wander_factor)
-    #out of bounds
-    #define bounds arrays, excluding those who are marked as having a custom destination    
-    if active_dests_length < population_length:
-        _xbounds = np.array([[Config.xbounds[0] + 0.02, Config.xbounds[1] - 0.02]] * len(population[population[:,11] == 0]))
-        _ybounds = np.array([[Config.ybounds[0] + 0.02, Config.ybounds[1] - 0.02]] * len(population[population[:,11] == 0]))
-        population[population[:,11] == 0] = out_of_bounds(population[population[:,11] == 0],
-                                                            _xbounds, _ybounds)
+                                                Config.wander_factor, ids)
+    #out of bounds, excluding those who are marked as having a custom destination
+    #with a torus world, those leaving are wrapped around after moving instead
+    if check_bounds and Config.boundary == 'reflect' and active_dests_length < population_length:
+        free = np.flatnonzero(population[:,11] == 0)
+        bounds_function = out_of_bounds if backend is None else backend.out_of_bounds
+        population = bounds_function(population,
+                                     [Config.xbounds[0] + 0.02, Config.xbounds[1] - 0.02],
+                                     [Config.ybounds[0] + 0.02, Config.ybounds[1] - 0.02],
+                                     ids = free)
     
     return population
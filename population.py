@@ -3,7 +3,6 @@ this file contains functions that help initialize the population
 parameters for the simulation
 '''
 
-from glob import glob
 import os
 
 import numpy as np
@@ -52,7 +51,11 @@ def initialize_population(Config, mean_age=45, max_age=105,
     '''
 
     #initialize population matrix
-    population = np.zeros((Config.pop_size, 15))
+    if Config.population_format == 'matrix':
+        population = np.zeros((Config.pop_size, 15))
+    else:
+        population = Columnar_population(Config.pop_size,
+                                         float32 = Config.population_format == 'columnar32')
 
     #initalize unique IDs
     population[:,0] = [x for x in range(Config.pop_size)]
@@ -74,12 +77,10 @@ def initialize_population(Config, mean_age=45, max_age=105,
 
     #initalize ages
     std_age = (max_age - mean_age) / 3
-    population[:,7] = np.int32(np.random.normal(loc = mean_age, 
-                                                scale = std_age, 
-                                                size=(Config.pop_size,)))
-
-    population[:,7] = np.clip(population[:,7], a_min = 0, 
-                              a_max = max_age) #clip those younger than 0 years
+    population[:,7] = np.clip(np.int32(np.random.normal(loc = mean_age, 
+                                                        scale = std_age, 
+                                                        size=(Config.pop_size,))),
+                              a_min = 0, a_max = max_age) #clip those younger than 0 years
 
     #build recovery_vector
     population[:,9] = np.random.normal(loc = 0.5, scale = 0.5 / 3, size=(Config.pop_size,))
@@ -87,6 +88,116 @@ def initialize_population(Config, mean_age=45, max_age=105,
     return population
 
 
+class Columnar_population():
+    '''population stored as one compact array per column
+
+    Alternative to the (pop_size, 15) float64 population matrix, with the same
+    columns (see initialize_population), each stored in the smallest type that
+    holds it: integer IDs and frames, small integers for states, flags and ages,
+    and floats for positions, headings, speeds and wander ranges. Selecting a
+    column or a subset of rows does not copy the other columns along.
+
+    Supports the indexing the population matrix is used with:
+    population[:,6] (the column array itself, writable), population[:,1:3],
+    population[mask] (a Columnar_population holding those rows), population[i]
+    (a Population_row), and assignment to each of these. np.asarray gives the
+    float64 matrix.
+
+    Keyword arguments
+    -----------------
+    size : int
+        the number of people in the population
+
+    float32 : bool
+        whether to store positions, headings, speeds, recovery vector and wander
+        ranges as float32 rather than float64
+    '''
+    def __init__(self, size, float32=True, columns=None):
+        if columns is None:
+            float_type = np.float32 if float32 else np.float64
+            dtypes = [np.int32, float_type, float_type, float_type, float_type, float_type,
+                      np.int8, np.uint8, np.int32, float_type, np.int8, np.int16, np.int8,
+                      float_type, float_type]
+            columns = [np.zeros((size,), dtype=dtype) for dtype in dtypes]
+        self.columns = columns
+
+    @property
+    def shape(self):
+        return (len(self.columns[0]), len(self.columns))
+
+    @property
+    def nbytes(self):
+        return sum(column.nbytes for column in self.columns)
+
+    def __len__(self):
+        return len(self.columns[0])
+
+    def _column_ids(self, cols):
+        if isinstance(cols, slice):
+            return range(len(self.columns))[cols]
+        return cols
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            rows, cols = key
+            if isinstance(cols, (int, np.integer)):
+                return self.columns[cols][rows]
+            return np.column_stack([self.columns[col][rows] for col in self._column_ids(cols)])
+        elif isinstance(key, (int, np.integer)):
+            return Population_row(self, key)
+        else:
+            return Columnar_population(0, columns=[column[key] for column in self.columns])
+
+    def __setitem__(self, key, value):
+        if isinstance(key, tuple):
+            rows, cols = key
+            if isinstance(cols, (int, np.integer)):
+                self.columns[cols][rows] = value
+            else:
+                value = np.asarray(value)
+                for i, col in enumerate(self._column_ids(cols)):
+                    self.columns[col][rows] = value[...,i] if value.ndim > 0 else value
+        elif isinstance(key, (int, np.integer)):
+            if isinstance(value, Population_row) and value.store is self and value.index == key:
+                return
+            for col, column in enumerate(self.columns):
+                column[key] = value[col]
+        else:
+            if isinstance(value, Columnar_population):
+                for column, values in zip(self.columns, value.columns):
+                    column[key] = values
+            else:
+                value = np.asarray(value)
+                for col, column in enumerate(self.columns):
+                    column[key] = value[...,col]
+
+    def __array__(self, dtype=None, copy=None):
+        return self.to_array().astype(dtype if dtype is not None else np.float64, copy=False)
+
+    def to_array(self):
+        '''returns the population as a (pop_size, 15) float64 matrix'''
+        return np.column_stack(self.columns).astype(np.float64)
+
+    def copy(self):
+        return Columnar_population(0, columns=[column.copy() for column in self.columns])
+
+
+class Population_row():
+    '''view on one person of a Columnar_population, indexed by column'''
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    def __len__(self):
+        return len(self.store.columns)
+
+    def __getitem__(self, col):
+        return self.store.columns[col][self.index]
+
+    def __setitem__(self, col, value):
+        self.store.columns[col][self.index] = value
+
+
 def initialize_destination_matrix(pop_size, total_destinations):
     '''intializes the destination matrix
 
@@ -158,8 +269,8 @@ def set_destination_bounds(population, destinations, xmin, ymin,
     return population, destinations
 
 
-def save_data(population, pop_tracker):
-    '''dumps simulation data to disk
+def save_population(population, tstep=0, folder='data_tstep'):
+    '''dumps population data at given timestep to disk
 
     Function that dumps the simulation data to specific files on the disk.
     Saves final state of the population matrix, the array of infected over time,
@@ -170,37 +281,183 @@ def save_data(population, pop_tracker):
     population : ndarray
         the array containing all the population information
 
-    infected : list or ndarray
-        the array containing data of infections over time
-
-    fatalities : list or ndarray
-        the array containing data of fatalities over time
+    tstep : int
+        the timestep that will be saved
     ''' 
-    num_files = len(glob('data/*'))
-    check_folder('data/%i' %num_files)
-    np.save('data/%i/population.npy' %num_files, population)
-    np.save('data/%i/infected.npy' %num_files, pop_tracker.infectious)
-    np.save('data/%i/recovered.npy' %num_files, pop_tracker.recovered)
-    np.save('data/%i/fatalities.npy' %num_files, pop_tracker.fatalities)
+    check_folder('%s/' %(folder))
+    np.save('%s/population_%i.npy' %(folder, tstep), population)
 
 
-def save_population(population, tstep=0, folder='data_tstep'):
-    '''dumps population data at given timestep to disk
+class Index_set():
+    '''set of population indices that supports batched adding and removing
 
-    Function that dumps the simulation data to specific files on the disk.
-    Saves final state of the population matrix, the array of infected over time,
-    and the array of fatalities over time
+    Members are kept in a dense array together with the position of each
+    member in it, so adding or removing k indices costs O(k) regardless
+    of population size. Removed members are replaced by members from the
+    end of the array.
+
+    Keyword arguments
+    -----------------
+    size : int
+        the size of the population the indices refer to
+    '''
+    def __init__(self, size):
+        self.members = np.zeros((size,), dtype=np.int32)
+        self.position = np.full((size,), -1, dtype=np.int32)
+        self.count = 0
+        self._sorted = None
+
+    def indices(self):
+        '''returns the members in ascending order'''
+        if self._sorted is None:
+            self._sorted = np.sort(self.members[:self.count])
+        return self._sorted
+
+    def add(self, ids):
+        '''adds ids to the set, ids already present are ignored'''
+        ids = np.unique(np.asarray(ids, dtype=np.int32))
+        ids = ids[self.position[ids] < 0]
+        if len(ids) == 0:
+            return
+
+        self.members[self.count:self.count + len(ids)] = ids
+        self.position[ids] = np.arange(self.count, self.count + len(ids))
+        self.count += len(ids)
+        self._sorted = None
+
+    def remove(self, ids):
+        '''removes ids from the set, ids not present are ignored'''
+        ids = np.unique(np.asarray(ids, dtype=np.int32))
+        ids = ids[self.position[ids] >= 0]
+        if len(ids) == 0:
+            return
+
+        new_count = self.count - len(ids)
+        holes = self.position[ids]
+        holes = np.sort(holes[holes < new_count])
+        self.position[ids] = -1
+
+        #fill the holes with the members at the end that are staying
+        tail = self.members[new_count:self.count]
+        movers = tail[self.position[tail] >= 0]
+        self.members[holes] = movers
+        self.position[movers] = holes
+        self.count = new_count
+        self._sorted = None
+
+    def clear(self):
+        '''removes all members'''
+        self.position[self.members[:self.count]] = -1
+        self.count = 0
+        self._sorted = None
+
+
+class State_registry():
+    '''keeps track of who is in which state
+
+    Holds an Index_set for every disease state (column 6), for those in
+    treatment (column 10) and for those with an active destination (column 11).
+    The sets are only updated when a transition is made through this registry,
+    so looking up members or counts does not require masking the whole population.
+
+    Code that changes these columns without going through the registry must call
+    rebuild() afterwards.
 
     Keyword arguments
     -----------------
     population : ndarray
         the array containing all the population information
+    '''
+    def __init__(self, population, n_states=5):
+        self.size = len(population)
+        self.states = [Index_set(self.size) for state in range(n_states)]
+        self.treatment = Index_set(self.size)
+        self.destination = Index_set(self.size)
+        self.rebuild(population)
+
+    def rebuild(self, population):
+        '''re-derives all sets from the population matrix'''
+        for state, members in enumerate(self.states):
+            members.clear()
+            members.add(np.flatnonzero(population[:,6] == state))
+        self.treatment.clear()
+        self.treatment.add(np.flatnonzero(population[:,10] == 1))
+        self.destination.clear()
+        self.destination.add(np.flatnonzero(population[:,11] != 0))
+
+    def in_state(self, state):
+        '''returns sorted indices of everyone in given state'''
+        return self.states[state].indices()
+
+    def count(self, state):
+        '''returns the number of people in given state'''
+        return self.states[state].count
+
+    def set_state(self, population, ids, state):
+        '''moves ids to given state'''
+        ids = np.asarray(ids, dtype=np.int32)
+        for old_state in np.unique(population[:,6][ids]):
+            self.states[int(old_state)].remove(ids[population[:,6][ids] == old_state])
+        self.states[state].add(ids)
+        population[:,6][ids] = state
+
+    def set_treatment(self, population, ids, value):
+        '''sets or clears the in treatment flag of ids'''
+        if value:
+            self.treatment.add(ids)
+        else:
+            self.treatment.remove(ids)
+        population[:,10][ids] = value
+
+    def set_destination(self, population, ids, dest_no):
+        '''sets the active destination of ids, 0 to clear it
+
+        dest_no is either one number for all ids, or an array with one per id
+        '''
+        if np.ndim(dest_no) == 0:
+            if dest_no != 0:
+                self.destination.add(ids)
+            else:
+                self.destination.remove(ids)
+        else:
+            ids = np.asarray(ids, dtype=np.int32)
+            self.destination.add(ids[np.asarray(dest_no) != 0])
+            self.destination.remove(ids[np.asarray(dest_no) == 0])
+        population[:,11][ids] = dest_no
+
+
+def get_indices(population, state, registry=None):
+    '''returns sorted indices of everyone in given state
+
+    Uses the registry if given, otherwise masks the population matrix.
+    '''
+    if registry is not None:
+        return registry.in_state(state)
+    return np.flatnonzero(population[:,6] == state)
+
+
+def set_state(population, ids, state, registry=None):
+    '''sets the state of ids, keeping the registry up to date if given'''
+    if registry is not None:
+        registry.set_state(population, ids, state)
+    else:
+        population[:,6][ids] = state
 
-    tstep : int
-        the timestep that will be saved
-    ''' 
-    check_folder('%s/' %(folder))
-    np.save('%s/population_%i.npy' %(folder, tstep), population)
+
+def set_treatment(population, ids, value, registry=None):
+    '''sets the treatment flag of ids, keeping the registry up to date if given'''
+    if registry is not None:
+        registry.set_treatment(population, ids, value)
+    else:
+        population[:,10][ids] = value
+
+
+def set_active_destination(population, ids, dest_no, registry=None):
+    '''sets the active destination of ids, keeping the registry up to date if given'''
+    if registry is not None:
+        registry.set_destination(population, ids, dest_no)
+    else:
+        population[:,11][ids] = dest_no
 
 
 class Population_trackers():
@@ -209,29 +466,112 @@ class Population_trackers():
     Can track population parameters over time that can then be used
     to compute statistics or to visualise. 
 
-    TODO: track age cohorts here as well
+    Counts are kept in preallocated arrays that double in size when full.
+    The attributes susceptible, infectious, recovered, fatalities,
+    immune_infectious (state 4) and in_treatment are arrays of the counts
+    so far, one per timestep.
+
+    Counts per age cohort and state can be recorded as well, see
+    track_age_cohorts. They are then available as age_counts, an array
+    of shape (timesteps, cohorts, states).
+
+    Keyword arguments
+    -----------------
+    capacity : int
+        the number of timesteps to preallocate room for
     '''
-    def __init__(self):
-        self.susceptible = []
-        self.infectious = []
-        self.recovered = []
-        self.fatalities = []
+    series = ['susceptible', 'infectious', 'recovered', 'fatalities',
+              'immune_infectious', 'in_treatment']
+
+    def __init__(self, capacity=1024):
+        self.length = 0
+        self.counts = np.zeros((len(self.series), capacity), dtype=np.int64)
+
+        #counts per age cohort and state, if tracked
+        self.age_bins = None
+        self.age_buffer = None
 
         #PLACEHOLDER - whether recovered individual can be reinfected
         self.reinfect = False 
 
-    def update_counts(self, population):
-        '''docstring
+    def __getattr__(self, name):
+        #the counts of each series so far, as a view of the buffer
+        if name in Population_trackers.series:
+            return self.counts[Population_trackers.series.index(name), :self.length]
+        if name == 'age_counts':
+            return None if self.age_buffer is None else self.age_buffer[:self.length]
+        raise AttributeError(name)
+
+    def track_age_cohorts(self, population, age_bins, states=5):
+        '''starts recording the number of people per age cohort and state
+
+        Everyone's cohort is computed once here, as ages do not change during
+        a simulation. Each timestep, all counts are then found with a single
+        bincount over cohort * states + state. Call before the first timestep.
+
+        Keyword arguments
+        -----------------
+        population : ndarray
+            the array containing all the population information
+
+        age_bins : list or ndarray
+            the lowest age of each cohort, in increasing order. Those younger
+            than the first are counted in the first cohort.
+
+        states : int
+            the number of disease states
+        '''
+        self.age_bins = np.asarray(age_bins)
+        self.states = states
+        cohorts = np.clip(np.searchsorted(self.age_bins, population[:,7], side='right') - 1,
+                          0, len(self.age_bins) - 1)
+        self.cohort_keys = cohorts.astype(np.int64) * states
+        self.keys = np.zeros_like(self.cohort_keys)
+        self.age_buffer = np.zeros((self.counts.shape[1], len(self.age_bins), states),
+                                   dtype=np.int32)
+
+    def update_age_counts(self, population):
+        '''writes the counts per age cohort and state of the last timestep'''
+        np.add(self.cohort_keys, population[:,6], out=self.keys, casting='unsafe')
+        self.age_buffer[self.length - 1] = np.bincount(self.keys, minlength = self.age_buffer[0].size
+                                                       ).reshape(self.age_buffer.shape[1:])
+
+    def update_counts(self, population, registry=None):
+        '''appends the current counts of each state
+
+        Counts are read from the State_registry if given, otherwise
+        they are computed from the population matrix, in a single
+        bincount over state and treatment. If age cohorts are tracked
+        (see track_age_cohorts), their counts are recorded as well.
         '''
         pop_size = population.shape[0]
-        self.infectious.append(len(population[population[:,6] == 1]))
-        self.recovered.append(len(population[population[:,6] == 2]))
-        self.fatalities.append(len(population[population[:,6] == 3]))
+        if registry is not None:
+            self.add_counts(pop_size, registry.count(1), registry.count(2),
+                            registry.count(3), registry.count(4),
+                            registry.treatment.count)
+        else:
+            #two bins per state: not in treatment and in treatment
+            keys = population[:,6].astype(np.int64) * 2 + (population[:,10] == 1)
+            counts = np.bincount(keys, minlength = 10).reshape(-1, 2)
+            self.add_counts(pop_size, counts[1].sum(), counts[2].sum(),
+                            counts[3].sum(), counts[4].sum(), counts[:,1].sum())
+
+        if self.age_buffer is not None:
+            self.update_age_counts(population)
+
+    def add_counts(self, pop_size, infectious, recovered, fatalities,
+                   immune_infectious=0, in_treatment=0):
+        '''appends counts that have already been computed'''
+        if self.length == self.counts.shape[1]:
+            self.counts = np.concatenate([self.counts, np.zeros_like(self.counts)], axis=1)
+            if self.age_buffer is not None:
+                self.age_buffer = np.concatenate([self.age_buffer, np.zeros_like(self.age_buffer)])
 
         if self.reinfect:
-            self.susceptible.append(pop_size - (self.infectious[-1] +
-                                                self.fatalities[-1]))
+            susceptible = pop_size - (infectious + fatalities)
         else:
-            self.susceptible.append(pop_size - (self.infectious[-1] +
-                                                self.recovered[-1] +
-                                                self.fatalities[-1]))
\ No newline at end of file
+            susceptible = pop_size - (infectious + recovered + fatalities)
+
+        self.counts[:,self.length] = [susceptible, infectious, recovered, fatalities,
+                                      immune_infectious, in_treatment]
+        self.length += 1
@@ -0,0 +1,123 @@
+'''
+contains tools to profile where the time of a simulation timestep goes
+'''
+
+from contextlib import nullcontext
+import json
+import time
+import tracemalloc
+
+import numpy as np
+
+
+class Stage_profiler():
+    '''times named stages of a timestep
+
+    Keeps the durations of the last 'window' calls of every stage in a
+    ring buffer, from which the p50, p95 and max are computed on request.
+    If trace_memory is set, tracemalloc is used to also record the peak
+    number of bytes allocated within each stage.
+
+    Usage:
+
+        with profiler.stage('infect'):
+            ...
+
+    Keyword arguments
+    -----------------
+    window : int
+        the number of most recent calls per stage to keep statistics over
+
+    trace_memory : bool
+        whether to track memory allocations with tracemalloc. This slows
+        down the simulation considerably.
+    '''
+    def __init__(self, window=1000, trace_memory=False):
+        self.window = window
+        self.trace_memory = trace_memory
+        self.stages = {}
+
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def stage(self, name):
+        '''returns a context manager that times the stage with given name'''
+        return _Stage_timer(self, name)
+
+    def record(self, name, duration, allocated=0):
+        '''adds a measurement of a stage'''
+        if name not in self.stages:
+            self.stages[name] = {'durations': np.zeros((self.window,)),
+                                 'allocated': np.zeros((self.window,)),
+                                 'calls': 0, 'total': 0.0}
+        stage = self.stages[name]
+        stage['durations'][stage['calls'] % self.window] = duration
+        stage['allocated'][stage['calls'] % self.window] = allocated
+        stage['calls'] += 1
+        stage['total'] += duration
+
+    def get_statistics(self):
+        '''returns statistics for every stage
+
+        Returns
+        -------
+        statistics : dict
+            maps stage names to a dict of the number of calls, total time,
+            and the p50, p95 and max duration (in seconds) over the window.
+            If memory is traced, also the p50 and max of the bytes allocated.
+        '''
+        statistics = {}
+        for name, stage in self.stages.items():
+            n = min(stage['calls'], self.window)
+            durations = stage['durations'][:n]
+            statistics[name] = {'calls': stage['calls'],
+                                'total': stage['total'],
+                                'p50': float(np.percentile(durations, 50)),
+                                'p95': float(np.percentile(durations, 95)),
+                                'max': float(np.max(durations))}
+            if self.trace_memory:
+                allocated = stage['allocated'][:n]
+                statistics[name]['allocated_p50'] = float(np.percentile(allocated, 50))
+                statistics[name]['allocated_max'] = float(np.max(allocated))
+        return statistics
+
+    def dump(self, path):
+        '''writes the statistics to a json file'''
+        with open(path, 'w') as f:
+            json.dump(self.get_statistics(), f, indent=2)
+
+
+class _Stage_timer():
+    '''context manager used by Stage_profiler.stage'''
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        if self.profiler.trace_memory:
+            tracemalloc.reset_peak()
+            self.memory = tracemalloc.get_traced_memory()[0]
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        duration = time.perf_counter() - self.start
+        allocated = 0
+        if self.profiler.trace_memory:
+            allocated = tracemalloc.get_traced_memory()[1] - self.memory
+        self.profiler.record(self.name, duration, allocated)
+        return False
+
+
+class Null_profiler():
+    '''stand-in for Stage_profiler when profiling is disabled, does nothing'''
+    trace_memory = False
+    _context = nullcontext()
+
+    def stage(self, name):
+        return self._context
+
+    def get_statistics(self):
+        return {}
+
+    def dump(self, path):
+        pass
@@ -0,0 +1,160 @@
+'''
+contains the travel schedule, which sends people to destinations such as
+work, school or shops at set times of the day
+'''
+
+import numpy as np
+
+from population import set_active_destination
+
+
+class Travel_schedule():
+    '''daily itineraries of the whole population
+
+    Every person has a number of legs per day. A leg is a destination number
+    (column of the destinations matrix, see initialize_destination_matrix,
+    0 meaning roaming freely) and the tick of the day at which to leave for it.
+    Itineraries are stored as integer arrays of shape (pop_size, legs), and
+    indexed by departure tick, so finding and sending everyone due at a tick
+    only costs in proportion to the number of people leaving.
+
+    The destination centers themselves are read from the destinations matrix,
+    which must therefore hold the location of each scheduled destination for
+    every person (for example their own home and work).
+
+    Destination 1 is reserved for self-isolation (see infection.infect) and
+    cannot be scheduled. People who are dead, or whose active destination is
+    not one from the schedule (for example those sent to self-isolate), are
+    left alone.
+
+    Keyword arguments
+    -----------------
+    pop_size : int
+        the size of the population
+
+    destination_count : int
+        the number of destinations in the destinations matrix, which
+        holds two columns per destination (destinations.shape[1] // 2)
+
+    legs : int
+        the maximum number of legs per person per day
+
+    day_length : int
+        the number of timesteps in a day
+    '''
+    def __init__(self, pop_size, destination_count, legs=4, day_length=100):
+        self.pop_size = pop_size
+        self.destination_count = destination_count
+        self.legs = legs
+        self.day_length = day_length
+
+        self.destination = np.zeros((pop_size, legs), dtype=np.int16)
+        #departure tick of the day, -1 for unused legs
+        self.departure = np.full((pop_size, legs), -1, dtype=np.int32)
+        #x and y wander range around the destination
+        self.wander_range = np.zeros((pop_size, legs, 2), dtype=np.float32)
+
+        self.order = None
+
+
+    def set_leg(self, ids, leg, destination, departure, wander_range=(0.05, 0.05)):
+        '''sets one leg of the itinerary of ids
+
+        Keyword arguments
+        -----------------
+        ids : ndarray or list
+            indices of the people to set the leg for
+
+        leg : int
+            which leg to set, between 0 and legs - 1
+
+        destination : int or ndarray
+            the destination number to go to, 0 to roam freely. 1 is
+            reserved for self-isolation. Must be below destination_count.
+            One for everyone, or one per id.
+
+        departure : int or ndarray
+            the tick of the day to leave at, below day_length, -1 to remove
+            the leg. One for everyone, or one per id.
+
+        wander_range : tuple or ndarray
+            x and y range to wander within around the destination.
+            One for everyone, or an array of shape (len(ids), 2).
+        '''
+        if np.any(np.asarray(destination) == 1):
+            raise ValueError('destination 1 is reserved for self-isolation')
+        if np.any(np.asarray(destination) < 0) or np.any(np.asarray(destination) >= self.destination_count):
+            raise ValueError('destination must be below the number of destinations, %i'
+                             %self.destination_count)
+        if np.any(np.asarray(departure) < -1) or np.any(np.asarray(departure) >= self.day_length):
+            raise ValueError('departure must be a tick of the day, between 0 and %i, or -1'
+                             %(self.day_length - 1))
+
+        self.destination[ids, leg] = destination
+        self.departure[ids, leg] = departure
+        self.wander_range[ids, leg] = wander_range
+        self.order = None
+
+
+    def build(self):
+        '''indexes all legs by departure tick
+
+        Called automatically when the schedule has changed. Legs are sorted
+        by departure tick, with offsets[t] the position of the first leg
+        leaving at tick t.
+        '''
+        departure = self.departure.ravel()
+        order = np.argsort(departure, kind='stable')
+        order = order[departure[order] >= 0]
+        self.order = order
+        self.offsets = np.searchsorted(departure[order], np.arange(self.day_length + 1))
+        self.scheduled = np.union1d(np.unique(self.destination.ravel()[order]), [0])
+
+
+    def due(self, frame):
+        '''returns indices and legs of everyone leaving at given frame'''
+        if self.order is None:
+            self.build()
+        tick = frame % self.day_length
+        legs = self.order[self.offsets[tick]:self.offsets[tick + 1]]
+        return legs // self.legs, legs % self.legs
+
+
+    def apply(self, population, frame, registry=None):
+        '''sends everyone due at given frame to the destination of their leg
+
+        Sets the active destination, marks them as not arrived and
+        sets their wander range. If someone has multiple legs leaving at
+        the same tick, the last one is used.
+
+        Keyword arguments
+        -----------------
+        population : ndarray
+            the array containing all the population information
+
+        frame : int
+            the current timestep
+
+        registry : State_registry or None
+            if given, kept up to date with the new active destinations
+        '''
+        ids, legs = self.due(frame)
+        if len(ids) == 0:
+            return population
+
+        #leave the dead and those sent elsewhere alone
+        follow = ((population[:,6][ids] != 3) &
+                  np.isin(population[:,11][ids], self.scheduled))
+        ids = ids[follow]
+        legs = legs[follow]
+
+        #of multiple legs leaving at once, keep the last
+        ids, last = np.unique(ids[::-1], return_index=True)
+        legs = legs[::-1][last]
+
+        population[:,12][ids] = 0
+        population[:,13][ids] = self.wander_range[ids, legs, 0]
+        population[:,14][ids] = self.wander_range[ids, legs, 1]
+        set_active_destination(population, ids, self.destination[ids, legs], registry)
+
+        return population
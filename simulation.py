@@ -6,16 +6,21 @@ import matplotlib.pyplot as plt
 from matplotlib.animation import FuncAnimation
 
 from config import Configuration, config_error
-from environment import build_hospital
+from environment import build_hospital, build_environment
 from infection import find_nearby, infect, recover_or_die, compute_mortality,\
-healthcare_infection_correction
+healthcare_infection_correction, Recovery_scheduler
 from motion import update_positions, out_of_bounds, update_randoms,\
-get_motion_parameters
+get_motion_parameters, social_distancing
 from path_planning import go_to_location, set_destination, check_at_destination,\
 keep_at_destination, reset_destinations, update_pops_destination
+from numba_backend import select_backend, seed as seed_numba
+from spatial import Neighbour_list
 from population import initialize_population, initialize_destination_matrix,\
-set_destination_bounds, save_data, save_population, Population_trackers
-from visualiser import build_fig, draw_tstep, set_style, plot_sir
+set_destination_bounds, save_population, Population_trackers,\
+State_registry, set_active_destination
+from profiler import Stage_profiler, Null_profiler
+from storage import Snapshot_store, Run_store, new_run_path
+from visualiser import Renderer, set_style, plot_sir, plot_sir_by_age
 
 #set seed for reproducibility
 #np.random.seed(100)
@@ -30,14 +35,54 @@ class Simulation():
         self.Config = Configuration(*args, **kwargs)
         self.frame = 0
 
+        #functions used on the hot path, numpy or numba compiled
+        if self.Config.population_format == 'matrix':
+            self.backend = select_backend(self.Config.backend)
+        else:
+            self.backend = select_backend('numpy')
+
+        #compiled functions have their own random generator, seed it as well
+        if self.Config.seed is not None:
+            np.random.seed(self.Config.seed)
+            if self.backend.name == 'numba':
+                seed_numba(self.Config.seed)
+
         #initialize default population
         self.population_init()
 
         self.pop_tracker = Population_trackers()
 
+        #schedules recoveries and deaths as people get infected
+        self.recovery_scheduler = Recovery_scheduler()
+
         #initalise destinations vector
         self.destinations = initialize_destination_matrix(self.Config.pop_size, 1)
 
+        #optional daily travel schedule, see schedule.Travel_schedule
+        self.travel_schedule = None
+
+        #optional walls and zones, see environment.Environment. If None when
+        #the simulation starts, built from Config (see build_environment)
+        self.environment = None
+
+        #population snapshots, created on the first save if Config.save_pop is set
+        self.snapshots = None
+
+        #results of the run, created on the first timestep if Config.save_data is set,
+        #and the path they were written to once the run is done
+        self.results = None
+        self.results_path = None
+
+        #moves everyone each timestep, in place
+        self.motion_kernel = self.backend.Motion_kernel(self.Config.pop_size)
+
+        #times the stages of tstep if profiling is enabled
+        if self.Config.profile:
+            self.profiler = Stage_profiler(self.Config.profile_window,
+                                           self.Config.profile_memory)
+        else:
+            self.profiler = Null_profiler()
+
 
     def reinitialise(self):
         '''reset the simulation'''
@@ -45,7 +90,15 @@ class Simulation():
         self.frame = 0
         self.population_init()
         self.pop_tracker = Population_trackers()
+        if self.snapshots is not None:
+            self.snapshots.close()
+            self.snapshots = None
+        if self.results is not None:
+            self.results.close()
+            self.results = None
         self.destinations = initialize_destination_matrix(self.Config.pop_size, 1)
+        #the schedule pointed into the destinations just replaced
+        self.travel_schedule = None
 
 
     def population_init(self):
@@ -53,6 +106,22 @@ class Simulation():
         self.population = initialize_population(self.Config, self.Config.mean_age,
                                                 self.Config.max_age, self.Config.xbounds,
                                                 self.Config.ybounds)
+        #keeps index sets of who is in which state
+        self.state_registry = State_registry(self.population)
+
+        #who practices social distancing, neighbours are cached and shared with infect
+        self.distancing_vector = None
+        self.neighbour_list = None
+        if self.Config.proportion_distancing > 0:
+            self.distancing_vector = np.random.uniform(size=(self.Config.pop_size,)) < self.Config.proportion_distancing
+            self.neighbour_list = Neighbour_list(max(self.Config.distancing_radius,
+                                                     self.Config.infection_range),
+                                                 self.Config.neighbour_skin)
+        if hasattr(self, 'recovery_scheduler'):
+            self.recovery_scheduler.clear()
+        if hasattr(self, 'motion_kernel'):
+            self.motion_kernel.clear(len(self.population))
+        self.locked_down = False
 
 
     def tstep(self):
@@ -60,75 +129,148 @@ class Simulation():
         takes a time step in the simulation
         '''
 
-        if self.frame == 0 and self.Config.visualise:
-            #initialize figure
-            self.fig, self.spec, self.ax1, self.ax2 = build_fig(self.Config)
+        if self.frame == 0:
+            #pick up any changes made to the population during setup
+            self.state_registry.rebuild(self.population)
 
-        #update populations' destination conditioning on their current status and the information of destinations.                                                          _xbounds, _ybounds)
-        self.population = update_pops_destination(self.population, self.destinations, self.Config)
-
-        #set randoms
-        if self.Config.lockdown:
-            if len(self.pop_tracker.infectious) == 0:
-                mx = 0
-            else:
-                mx = np.max(self.pop_tracker.infectious)
-
-            if len(self.population[self.population[:,6] == 1]) >= len(self.population) * self.Config.lockdown_percentage or\
-               mx >= (len(self.population) * self.Config.lockdown_percentage):
-                #reduce speed of all members of society
-                self.population[:,5] = np.clip(self.population[:,5], a_min = None, a_max = 0.001)
-                #set speeds of complying people to 0
-                self.population[:,5][self.Config.lockdown_vector == 0] = 0
-            else:
-                #update randoms
-                self.population = update_randoms(self.population, self.Config.pop_size, self.Config.speed)
-        else:
-            #update randoms
-            self.population = update_randoms(self.population, self.Config.pop_size, self.Config.speed)
+            if self.environment is None:
+                self.environment = build_environment(self.Config)
 
-        #for dead ones: set speed and heading to 0
-        self.population[:,3:5][self.population[:,6] == 3] = 0
+            if self.Config.track_age_cohorts:
+                self.pop_tracker.track_age_cohorts(self.population, self.Config.age_bins)
 
-        #update positions
-        self.population = update_positions(self.population)
+            if self.Config.visualise:
+                #initialize figure
+                self.renderer = Renderer(self.Config, self.environment)
+                self.fig, self.spec, self.ax1, self.ax2 = (self.renderer.fig, self.renderer.spec,
+                                                           self.renderer.ax1, self.renderer.ax2)
 
-        #find new infections
-        self.population, self.destinations = infect(self.population, self.Config, self.frame,
-                                                    send_to_location = self.Config.self_isolate,
-                                                    location_bounds = self.Config.isolation_bounds,
-                                                    destinations = self.destinations,
-                                                    location_no = 1,
-                                                    location_odds = self.Config.self_isolate_proportion)
+        #update populations' destination conditioning on their current status and the information of destinations.                                                          _xbounds, _ybounds)
+        with self.profiler.stage('destinations'):
+            self.population = update_pops_destination(self.population, self.destinations, self.Config,
+                                                      registry = self.state_registry,
+                                                      backend = self.backend,
+                                                      check_bounds = False,
+                                                      schedule = self.travel_schedule,
+                                                      frame = self.frame)
+
+        #set randoms, turn around at bounds and update positions
+        with self.profiler.stage('motion'):
+            randomize = True
+            if self.Config.lockdown:
+                if len(self.pop_tracker.infectious) == 0:
+                    mx = 0
+                else:
+                    mx = np.max(self.pop_tracker.infectious)
+
+                if self.state_registry.count(1) >= len(self.population) * self.Config.lockdown_percentage or\
+                   mx >= (len(self.population) * self.Config.lockdown_percentage):
+                    if not self.locked_down:
+                        #set speeds of complying people to 0 and keep them in place
+                        complying = np.flatnonzero(self.Config.lockdown_vector == 0)
+                        self.population[:,5][complying] = 0
+                        self.motion_kernel.hold(complying)
+                        self.not_complying = np.flatnonzero(self.Config.lockdown_vector != 0)
+                        self.locked_down = True
+                    #reduce speed of the others
+                    self.population[:,5][self.not_complying] = np.clip(self.population[:,5][self.not_complying],
+                                                                       a_min = None, a_max = 0.001)
+                    randomize = False
+                elif self.locked_down:
+                    self.motion_kernel.hold(None)
+                    self.locked_down = False
+
+            #steer those distancing away from others
+            if self.distancing_vector is not None:
+                self.population = social_distancing(self.population, self.neighbour_list,
+                                                    self.distancing_vector,
+                                                    self.Config.distancing_radius,
+                                                    self.Config.distancing_strength)
+
+            #the dead are retired from motion for good
+            self.population = self.motion_kernel.step(self.population, self.Config,
+                                                      randomize = randomize,
+                                                      frozen = self.state_registry.in_state(3),
+                                                      environment = self.environment)
+
+        #find new infections, reusing the neighbour list if there is one
+        infect_kwargs = {}
+        if self.neighbour_list is not None:
+            infect_kwargs['exposure_kernel'] = self.neighbour_list.count_exposures
+        with self.profiler.stage('infect'):
+            self.population, self.destinations = self.backend.infect(self.population, self.Config, self.frame,
+                                                                     send_to_location = self.Config.self_isolate,
+                                                                     location_bounds = self.Config.isolation_bounds,
+                                                                     destinations = self.destinations,
+                                                                     location_no = 1,
+                                                                     location_odds = self.Config.self_isolate_proportion,
+                                                                     scheduler = self.recovery_scheduler,
+                                                                     registry = self.state_registry,
+                                                                     **infect_kwargs)
 
         #recover and die
-        self.population = recover_or_die(self.population, self.frame, self.Config)
-
-        #send cured back to population if self isolation active
-        #perhaps put in recover or die class
-        #send cured back to population
-        self.population[:,11][self.population[:,6] == 2] = 0
+        with self.profiler.stage('recover_or_die'):
+            self.population = self.backend.recover_or_die(self.population, self.frame, self.Config,
+                                                          scheduler = self.recovery_scheduler,
+                                                          registry = self.state_registry)
+
+            #send cured back to population if self isolation active
+            #perhaps put in recover or die class
+            #send cured back to population, only those in isolation (destination 1)
+            traveling = self.state_registry.destination.indices()
+            cured = traveling[(self.population[:,6][traveling] == 2) &
+                              (self.population[:,11][traveling] == 1)]
+            set_active_destination(self.population, cured, 0, self.state_registry)
 
         #update population statistics
-        self.pop_tracker.update_counts(self.population)
+        with self.profiler.stage('trackers'):
+            self.pop_tracker.update_counts(self.population, self.state_registry)
+
+        #write the counts to the run store if required
+        if self.Config.save_data:
+            with self.profiler.stage('save_data'):
+                if self.results is None:
+                    self.results = Run_store(new_run_path(self.Config.save_data_folder),
+                                             Config = self.Config, seed = self.Config.seed)
+                    self.results_path = self.results.path
+                self.results.append_row({name: getattr(self.pop_tracker, name)[-1]
+                                         for name in self.pop_tracker.series})
+                if self.pop_tracker.age_counts is not None:
+                    self.results.append('age_counts', self.pop_tracker.age_counts[-1])
 
         #visualise
         if self.Config.visualise:
-            draw_tstep(self.Config, self.population, self.pop_tracker, self.frame,
-                       self.fig, self.spec, self.ax1, self.ax2)
+            with self.profiler.stage('draw'):
+                self.renderer.draw(self.population, self.pop_tracker, self.frame,
+                                   self.state_registry)
 
         #report stuff to console
-        sys.stdout.write('\r')
-        sys.stdout.write('%i: healthy: %i, infected: %i, immune: %i, in treatment: %i, \
+        with self.profiler.stage('console'):
+            sys.stdout.write('\r')
+            sys.stdout.write('%i: healthy: %i, infected: %i, immune: %i, in treatment: %i, \
 dead: %i, of total: %i' %(self.frame, self.pop_tracker.susceptible[-1], self.pop_tracker.infectious[-1],
-                        self.pop_tracker.recovered[-1], len(self.population[self.population[:,10] == 1]),
-                        self.pop_tracker.fatalities[-1], self.Config.pop_size))
+                            self.pop_tracker.recovered[-1], self.state_registry.treatment.count,
+                            self.pop_tracker.fatalities[-1], self.Config.pop_size))
 
         #save popdata if required
         if self.Config.save_pop and (self.frame % self.Config.save_pop_freq) == 0:
-            save_population(self.population, self.frame, self.Config.save_pop_folder)
+            with self.profiler.stage('save_pop'):
+                if self.Config.save_pop_format == 'npy':
+                    save_population(self.population, self.frame, self.Config.save_pop_folder)
+                elif self.Config.save_pop_format == 'results':
+                    if self.results is None:
+                        raise ValueError("save_pop_format 'results' needs save_data to be set")
+                    self.results.add_snapshot(self.population, self.frame)
+                else:
+                    #a new file for every run, grown as snapshots are added
+                    if self.snapshots is None:
+                        self.snapshots = Snapshot_store(new_run_path(self.Config.save_pop_folder,
+                                                                     'population', 'snap'),
+                                                        len(self.population), self.population.shape[1])
+                    self.snapshots.append(self.population, self.frame)
         #run callback
-        self.callback()
+        with self.profiler.stage('callback'):
+            self.callback()
 
         #update frame
         self.frame += 1
@@ -139,13 +281,20 @@ dead: %i, of total: %i' %(self.frame, self.pop_tracker.susceptible[-1], self.pop
 
         By ovewriting this method any custom behaviour can be implemented.
         The method is called after every simulation timestep.
+
+        Anyone infected here must be passed to self.recovery_scheduler.schedule()
+        (or call self.recovery_scheduler.sync()) so their recovery is scheduled.
+        State changes made directly in the population matrix must be followed by
+        self.state_registry.rebuild(self.population), or be made through the
+        registry itself.
         '''
 
         if self.frame == 50:
             print('\ninfecting patient zero')
-            self.population[0][6] = 1
+            self.state_registry.set_state(self.population, [0], 1)
             self.population[0][8] = 50
-            self.population[0][10] = 1
+            self.state_registry.set_treatment(self.population, [0], 1)
+            self.recovery_scheduler.schedule(self.population, [0], self.Config)
 
 
     def run(self):
@@ -153,33 +302,53 @@ dead: %i, of total: %i' %(self.frame, self.pop_tracker.susceptible[-1], self.pop
 
         i = 0
 
-        while i < self.Config.simulation_steps:
-            try:
-                self.tstep()
-            except KeyboardInterrupt:
-                print('\nCTRL-C caught, exiting')
-                sys.exit(1)
-
-            #check whether to end if no infecious persons remain.
-            #check if self.frame is above some threshold to prevent early breaking when simulation
-            #starts initially with no infections.
-            if self.Config.endif_no_infections and self.frame >= 500:
-                if len(self.population[(self.population[:,6] == 1) |
-                                       (self.population[:,6] == 4)]) == 0:
-                    i = self.Config.simulation_steps
-
-        if self.Config.save_data:
-            save_data(self.population, self.pop_tracker)
+        #whatever ends the run, write out what is still buffered
+        try:
+            while i < self.Config.simulation_steps:
+                try:
+                    self.tstep()
+                except KeyboardInterrupt:
+                    print('\nCTRL-C caught, exiting')
+                    sys.exit(1)
+
+                i += 1
+
+                #check whether to end if no infecious persons remain.
+                #check if self.frame is above some threshold to prevent early breaking when simulation
+                #starts initially with no infections.
+                if self.Config.endif_no_infections and self.frame >= 500:
+                    if self.state_registry.count(1) + self.state_registry.count(4) == 0:
+                        i = self.Config.simulation_steps
+        finally:
+            #a run store is done once closed, a following run gets a new one
+            if self.results is not None:
+                self.results.close()
+                print('\nresults written to %s' %self.results.path)
+                self.results = None
+            if self.snapshots is not None:
+                self.snapshots.flush()
+
+        if self.Config.profile:
+            self.profiler.dump(self.Config.profile_path)
 
         #report outcomes
         print('\n-----stopping-----\n')
         print('total timesteps taken: %i' %self.frame)
-        print('total dead: %i' %len(self.population[self.population[:,6] == 3]))
-        print('total recovered: %i' %len(self.population[self.population[:,6] == 2]))
-        print('total infected: %i' %len(self.population[self.population[:,6] == 1]))
-        print('total infectious: %i' %len(self.population[(self.population[:,6] == 1) |
-                                                          (self.population[:,6] == 4)]))
-        print('total unaffected: %i' %len(self.population[self.population[:,6] == 0]))
+        print('total dead: %i' %self.state_registry.count(3))
+        print('total recovered: %i' %self.state_registry.count(2))
+        print('total infected: %i' %self.state_registry.count(1))
+        print('total infectious: %i' %(self.state_registry.count(1) +
+                                       self.state_registry.count(4)))
+        print('total unaffected: %i' %self.state_registry.count(0))
+
+
+    def get_profile(self):
+        '''returns timing statistics of the stages of tstep
+
+        Only available if Config.profile is set, see profiler.Stage_profiler
+        for the format. Returns an empty dict otherwise.
+        '''
+        return self.profiler.get_statistics()
 
 
     def plot_sir(self, size=(6,3), include_fatalities=False,
@@ -188,6 +357,12 @@ dead: %i, of total: %i' %(self.frame, self.pop_tracker.susceptible[-1], self.pop
                  title)
 
 
+    def plot_sir_by_age(self, size=(9,6), include_fatalities=False,
+                        title='S-I-R plot per age cohort'):
+        plot_sir_by_age(self.Config, self.pop_tracker, size, include_fatalities,
+                        title)
+
+
 
 if __name__ == '__main__':
 
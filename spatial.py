@@ -0,0 +1,398 @@
+'''
+contains spatial indexing structures used to speed up neighbourhood
+queries, such as finding who is within infection range of whom
+'''
+
+import numpy as np
+
+
+class Spatial_grid():
+    '''uniform grid (cell list) index over agent positions
+
+    Bins agents into square cells with sides of 'cell_size', so that all
+    agents within 'cell_size' of a point can be found by only inspecting
+    the 3x3 block of cells surrounding it, rather than the whole population.
+
+    The grid is stored as the cell keys of all agents sorted once, together
+    with the ordering that sorts them. Cells are located with a binary search,
+    so no memory is spent on empty cells, no matter how large the world is.
+    For many queries on a densely filled grid, the start of every cell is
+    looked up once instead (see _cell_ranges).
+
+    Keyword arguments
+    -----------------
+    population : ndarray
+        the array containing the population information to index. Columns
+        1 and 2 are used as x and y coordinates.
+
+    cell_size : float
+        the side length of a grid cell. Should be at least the largest query
+        range used on the grid (e.g. Config.infection_range)
+
+    rows : ndarray or None
+        if given, only these rows of population are indexed (for example only
+        the healthy). Queries still return row indices into population.
+    '''
+    def __init__(self, population, cell_size, rows=None):
+        #pad cells slightly so rounding can never push a neighbour two cells away
+        self.cell_size = cell_size * (1 + 1e-6)
+        self.cell_starts = None
+        if rows is None:
+            rows = np.arange(len(population))
+        self.size = len(rows)
+
+        if self.size == 0:
+            self.origin = np.zeros((2,))
+            self.ny = 1
+            self.keys = np.zeros((0,), dtype=np.int64)
+            self.order = np.zeros((0,), dtype=np.int64)
+            return
+
+        x = population[:,1][rows]
+        y = population[:,2][rows]
+        self.origin = np.array([x.min(), y.min()])
+        cells = self._cells(x, y)
+
+        #stride leaves room for the neighbours of clipped query cells on both sides
+        self.ny = np.int64(cells[:,1].max()) + 5
+        self.nx = np.int64(cells[:,0].max()) + 1
+
+        keys = self._keys(cells[:,0], cells[:,1])
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.order = np.asarray(rows, dtype=np.int64)[order]
+
+
+    def _cells(self, x, y):
+        '''returns integer cell coordinates of given positions'''
+        cells = np.empty((len(x), 2), dtype=np.int64)
+        cells[:,0] = np.floor((x - self.origin[0]) / self.cell_size)
+        cells[:,1] = np.floor((y - self.origin[1]) / self.cell_size)
+        return cells
+
+
+    def _keys(self, cx, cy):
+        '''returns the unique key of given cell coordinates'''
+        return (cx + 2) * self.ny + (cy + 2)
+
+
+    def _neighbour_keys(self, x, y):
+        '''returns keys of the 3x3 block of cells around each position
+
+        Positions outside the indexed area are clipped onto its border, which
+        can only add candidates, never remove them.
+        '''
+        cells = self._cells(np.atleast_1d(x), np.atleast_1d(y))
+        cells[:,0] = np.clip(cells[:,0], -1, self.nx)
+        cells[:,1] = np.clip(cells[:,1], -1, self.ny - 4)
+
+        offsets = np.array([-1, 0, 1], dtype=np.int64)
+        cx = cells[:,0][:,None,None] + offsets[None,:,None]
+        cy = cells[:,1][:,None,None] + offsets[None,None,:]
+        return self._keys(cx, cy).reshape(len(cells), 9)
+
+
+    def _cell_ranges(self, keys):
+        '''returns where the agents of each of keys start and end in the grid
+
+        For many keys, the start of every cell is looked up once, so each key
+        costs a lookup in that table rather than a binary search, as long as
+        the table is not much larger than the grid itself.
+        '''
+        cells = (self.nx + 4) * self.ny
+        if len(keys) < 64 or cells > 8 * max(self.size, len(keys)):
+            return (np.searchsorted(self.keys, keys, side='left'),
+                    np.searchsorted(self.keys, keys, side='right'))
+        if self.cell_starts is None:
+            self.cell_starts = np.searchsorted(self.keys, np.arange(cells + 1))
+        return self.cell_starts[keys], self.cell_starts[keys + 1]
+
+
+    def candidates(self, x, y):
+        '''returns sorted row indices of everyone in the 3x3 cells around (x, y)'''
+        if self.size == 0:
+            return np.zeros((0,), dtype=np.int64)
+
+        starts, ends = self._cell_ranges(self._neighbour_keys(x, y)[0])
+        rows = np.concatenate([self.order[s:e] for s, e in zip(starts, ends)])
+        return np.sort(rows)
+
+
+    def move(self, population, rows):
+        '''files rows of population under the cells of their current positions
+
+        Only works on a grid of the whole population. The entries of rows are
+        taken out and put back in at their new keys, so the cost is a copy of
+        the grid rather than a new sort. Returns False without changing the
+        grid if anyone moved outside the indexed area, in which case the grid
+        has to be built again.
+        '''
+        if len(rows) == 0:
+            return True
+        cells = self._cells(population[:,1][rows], population[:,2][rows])
+        if (cells[:,0].min() < -1 or cells[:,0].max() > self.nx or
+            cells[:,1].min() < -1 or cells[:,1].max() > self.ny - 4):
+            return False
+
+        is_moved = np.zeros((len(population),), dtype=bool)
+        is_moved[rows] = True
+        keep = ~is_moved[self.order]
+        keys = self.keys[keep]
+        order = self.order[keep]
+
+        new_keys = self._keys(cells[:,0], cells[:,1])
+        sort = np.argsort(new_keys, kind='stable')
+        positions = np.searchsorted(keys, new_keys[sort], side='right')
+        self.keys = np.insert(keys, positions, new_keys[sort])
+        self.order = np.insert(order, positions, np.asarray(rows, dtype=np.int64)[sort])
+        self.cell_starts = None
+        return True
+
+
+    def query_box(self, population, infection_zone):
+        '''returns sorted row indices of everyone strictly inside infection_zone
+
+        Gives the same result as masking the full population with the
+        infection zone, as long as the zone extends no further than the
+        cell size from its center.
+
+        Keyword arguments
+        -----------------
+        population : ndarray
+            the same array the grid was built from
+
+        infection_zone : list or tuple
+            the zone to query, format: [xmin, ymin, xmax, ymax]
+        '''
+        x_center = infection_zone[0] + ((infection_zone[2] - infection_zone[0]) / 2)
+        y_center = infection_zone[1] + ((infection_zone[3] - infection_zone[1]) / 2)
+        rows = self.candidates(x_center, y_center)
+
+        inside = ((infection_zone[0] < population[:,1][rows]) &
+                  (population[:,1][rows] < infection_zone[2]) &
+                  (infection_zone[1] < population[:,2][rows]) &
+                  (population[:,2][rows] < infection_zone[3]))
+        return rows[inside]
+
+
+    def query_pairs(self, population, x, y, query_range):
+        '''returns all (query, row) pairs where row is within query_range of a query point
+
+        Batched version of query_box: finds, for every query position at once,
+        the indexed agents strictly inside the square zone of half-width
+        query_range centered on it.
+
+        Keyword arguments
+        -----------------
+        population : ndarray
+            the same array the grid was built from
+
+        x, y : ndarray
+            coordinates of the query points
+
+        query_range : float
+            half-width of the square zone around each query point. Should
+            not exceed the cell size
+
+        Returns
+        -------
+        queries : ndarray
+            index into x and y of the query point of each pair
+
+        rows : ndarray
+            row index into population of the agent of each pair
+        '''
+        if self.size == 0 or len(x) == 0:
+            return np.zeros((0,), dtype=np.int64), np.zeros((0,), dtype=np.int64)
+
+        starts, ends = self._cell_ranges(self._neighbour_keys(x, y).ravel())
+        counts = ends - starts
+
+        #expand every (query, cell) range into one entry per candidate
+        queries = np.repeat(np.arange(len(x)).repeat(9), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        rows = self.order[np.repeat(starts, counts) + offsets]
+
+        inside = (((x[queries] - query_range) < population[:,1][rows]) &
+                  (population[:,1][rows] < (x[queries] + query_range)) &
+                  ((y[queries] - query_range) < population[:,2][rows]) &
+                  (population[:,2][rows] < (y[queries] + query_range)))
+        return queries[inside], rows[inside]
+
+
+class Neighbour_list():
+    '''Verlet neighbour list of all pairs of agents close to each other
+
+    Stores, for every agent, the agents within 'cutoff' + 'skin' of their
+    reference position (on both axes, like the square infection zone),
+    found with a Spatial_grid. The reference position is where an agent was
+    when their neighbours were last found. Pairs that are now within 'cutoff'
+    must be in the list, as long as nobody has moved more than half the skin
+    from their reference position. So each timestep, only those who have
+    moved that far get a new reference position and have their neighbours
+    found again, on a grid of reference positions that is kept up to date
+    rather than built again (see Spatial_grid.move). If many have moved that
+    far, the list is rebuilt.
+
+    Neighbours are kept in compressed sparse row form: the neighbours j > i of
+    agent i are neighbours[offsets[i]:offsets[i + 1]], stored as int32.
+
+    Queries for any range up to the cutoff filter the cached pairs, so the same
+    list can be shared between stages, such as distancing and infection.
+
+    Keyword arguments
+    -----------------
+    cutoff : float
+        the largest range the list is queried for
+
+    skin : float or None
+        extra margin around the cutoff. A larger skin means fewer agents to
+        update each timestep, but more pairs to store and filter. If None,
+        0.3 times the cutoff
+    '''
+    def __init__(self, cutoff, skin=None):
+        #pad slightly so rounding can never drop a pair right at the cutoff
+        self.cutoff = cutoff * (1 + 1e-6)
+        self.skin = 0.3 * cutoff if skin is None else skin
+        self.reference = None
+        self.rebuilds = 0
+
+
+    @property
+    def pair_count(self):
+        '''the number of cached pairs'''
+        return 0 if self.reference is None else len(self.neighbours)
+
+
+    @property
+    def nbytes(self):
+        '''the memory taken by the cached pairs and reference positions'''
+        if self.reference is None:
+            return 0
+        return self.neighbours.nbytes + self.offsets.nbytes + self.reference.nbytes
+
+
+    def build(self, population):
+        '''finds all pairs within cutoff + skin of the current positions'''
+        #laid out like the population, so a Spatial_grid can index it
+        self.reference = np.zeros((len(population), 3))
+        self.reference[:,1] = population[:,1]
+        self.reference[:,2] = population[:,2]
+        self.grid = Spatial_grid(self.reference, self.cutoff + self.skin)
+
+        queries, rows = self.grid.query_pairs(self.reference, self.reference[:,1],
+                                              self.reference[:,2], self.cutoff + self.skin)
+        #keep every pair once, queries come out in order
+        keep = queries < rows
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(queries[keep],
+                                                                  minlength = len(population)))])
+        self.neighbours = rows[keep].astype(np.int32)
+        self.rebuilds += 1
+
+
+    def refresh(self, population, moved):
+        '''finds the pairs of those in 'moved' again, keeping all other pairs'''
+        size = len(population)
+        self.reference[:,1][moved] = population[:,1][moved]
+        self.reference[:,2][moved] = population[:,2][moved]
+        if not self.grid.move(self.reference, moved):
+            self.build(population)
+            return
+
+        is_moved = np.zeros((size,), dtype=bool)
+        is_moved[moved] = True
+
+        #drop all pairs of the moved: their own rows, and their entries in other rows
+        marks = (np.bincount(self.offsets[moved], minlength = len(self.neighbours) + 1) -
+                 np.bincount(self.offsets[moved + 1], minlength = len(self.neighbours) + 1))
+        drop = (np.cumsum(marks[:-1]) > 0) | is_moved[self.neighbours]
+        dropped = np.flatnonzero(drop)
+        counts = np.diff(self.offsets) - np.bincount(np.searchsorted(self.offsets, dropped, side='right') - 1,
+                                                     minlength = size)
+        neighbours = self.neighbours[~drop]
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+
+        #find the pairs of the moved again
+        queries, rows = self.grid.query_pairs(self.reference, self.reference[:,1][moved],
+                                              self.reference[:,2][moved], self.cutoff + self.skin)
+        queries = moved[queries]
+        #pairs of two that both moved are found twice, keep them once
+        keep = (queries != rows) & (~is_moved[rows] | (queries < rows))
+        first = np.minimum(queries, rows)[keep]
+        second = np.maximum(queries, rows)[keep]
+
+        #add them at the end of the row of the first of each pair
+        sort = np.argsort(first, kind='stable')
+        first = first[sort]
+        self.neighbours = np.insert(neighbours, offsets[first + 1], second[sort].astype(np.int32))
+        self.offsets = offsets + np.concatenate([[0], np.cumsum(np.bincount(first, minlength = size))])
+
+
+    def update(self, population):
+        '''finds the pairs of anyone who moved more than half the skin again'''
+        if self.reference is None or len(self.reference) != len(population):
+            self.build(population)
+            return
+
+        moved = np.maximum(np.abs(population[:,1] - self.reference[:,1]),
+                           np.abs(population[:,2] - self.reference[:,2]))
+        moved = np.flatnonzero(moved >= self.skin / 2)
+        if len(moved) > len(population) / 4:
+            self.build(population)
+        elif len(moved) > 0:
+            self.refresh(population, moved)
+
+
+    def pairs_within(self, population, query_range):
+        '''returns all pairs (i, j), i < j, strictly within query_range on both axes
+
+        Keyword arguments
+        -----------------
+        population : ndarray
+            the array containing all the population information
+
+        query_range : float
+            the range to find pairs within, at most the cutoff
+        '''
+        if query_range > self.cutoff:
+            raise ValueError('query range %f exceeds the cutoff %f of the neighbour list'
+                             %(query_range, self.cutoff))
+        self.update(population)
+
+        x = population[:,1]
+        y = population[:,2]
+        i = np.repeat(np.arange(len(population), dtype=np.int32), np.diff(self.offsets))
+        j = self.neighbours
+        inside = ((np.abs(x[i] - x[j]) < query_range) &
+                  (np.abs(y[i] - y[j]) < query_range))
+        return i[inside], j[inside]
+
+
+    def count_exposures(self, population, infected, healthy, infection_range):
+        '''counts the infected within infection range of each healthy person
+
+        Works like infection.count_exposures, and can be passed to
+        infection.infect as its exposure_kernel.
+        '''
+        exposures = np.zeros((len(population),), dtype=np.int64)
+        if len(infected) == 0 or len(healthy) == 0:
+            return exposures
+
+        is_infected = np.zeros((len(population),), dtype=bool)
+        is_infected[infected] = True
+        is_healthy = np.zeros((len(population),), dtype=bool)
+        is_healthy[healthy] = True
+
+        #check the pairs in the same direction as the infection zone test
+        #of infection.count_exposures, so results are identical
+        i, j = self.pairs_within(population, infection_range * (1 + 1e-6))
+        sick = np.concatenate([i[is_infected[i] & is_healthy[j]], j[is_infected[j] & is_healthy[i]]])
+        exposed = np.concatenate([j[is_infected[i] & is_healthy[j]], i[is_infected[j] & is_healthy[i]]])
+
+        x = population[:,1]
+        y = population[:,2]
+        inside = (((x[sick] - infection_range) < x[exposed]) &
+                  (x[exposed] < (x[sick] + infection_range)) &
+                  ((y[sick] - infection_range) < y[exposed]) &
+                  (y[exposed] < (y[sick] + infection_range)))
+        return np.bincount(exposed[inside], minlength = len(population))
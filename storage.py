@@ -0,0 +1,463 @@
+'''
+contains stores to write simulation output to disk while the simulation runs
+'''
+
+from glob import glob
+import io
+import json
+import os
+import zlib
+
+import numpy as np
+
+from utils import check_folder
+
+
+class Snapshot_store():
+    '''memory-mapped file of population snapshots
+
+    All snapshots of a run go into one file, laid out as:
+
+        header : 8 byte magic, then int64 version, capacity, pop_size,
+                 columns and count, padded to 64 bytes
+        data   : float64 array of shape (capacity, pop_size, columns)
+        index  : int64 array of the frame of each snapshot, -1 if unused
+
+    The file is preallocated for 'capacity' snapshots and mapped into memory,
+    so a snapshot is written by copying the population straight into the
+    mapped file. If it fills up, the file is grown to twice its capacity.
+    The count in the header is only raised after a snapshot is written,
+    so a reader never sees a partially written one.
+
+    Snapshots are read back as slices of the mapped file, without
+    loading the rest of the run:
+
+        store = Snapshot_store('pop_data/population_0.snap', mode='r')
+        store.frames        #frame of each snapshot
+        store[-1]           #the last snapshot, shape (pop_size, columns)
+        store[:, :, 6]      #state of everyone in every snapshot
+        store.get_frame(50) #the snapshot taken at frame 50
+
+    Keyword arguments
+    -----------------
+    path : str
+        the file to write to or read from
+
+    pop_size : int
+        the size of the population, only needed when creating a file
+
+    columns : int
+        the number of columns of the population
+
+    capacity : int
+        the number of snapshots to preallocate room for
+
+    mode : str
+        'w' to create a new file (overwriting any existing one), 'r' to read
+        an existing one, or 'r+' to append to an existing one
+    '''
+    magic = b'SNAPSHOT'
+    version = 1
+    header_size = 64
+
+    def __init__(self, path, pop_size=None, columns=15, capacity=16, mode='w'):
+        self.path = path
+        self.mode = mode
+
+        if mode == 'w':
+            if pop_size is None:
+                raise ValueError('pop_size is needed to create a snapshot store')
+            check_folder(os.path.dirname(path) or '.')
+            with open(path, 'wb') as f:
+                f.write(self.magic)
+                f.write(np.array([self.version, capacity, pop_size, columns, 0],
+                                 dtype=np.int64).tobytes())
+            self.capacity = capacity
+            self.pop_size = pop_size
+            self.columns = columns
+            self.count = 0
+            self._resize()
+            self._map()
+            self.index[:] = -1
+        else:
+            with open(path, 'rb') as f:
+                if f.read(len(self.magic)) != self.magic:
+                    raise ValueError('%s is not a snapshot store' %path)
+                version, capacity, pop_size, columns, count = np.frombuffer(f.read(40),
+                                                                            dtype=np.int64)
+            if version != self.version:
+                raise ValueError('unsupported snapshot store version %i' %version)
+            self.capacity = int(capacity)
+            self.pop_size = int(pop_size)
+            self.columns = int(columns)
+            self.count = int(count)
+            self._map()
+
+
+    def _data_bytes(self):
+        return self.capacity * self.pop_size * self.columns * 8
+
+
+    def _resize(self):
+        '''sets the size of the file to fit the current capacity'''
+        with open(self.path, 'r+b') as f:
+            f.truncate(self.header_size + self._data_bytes() + self.capacity * 8)
+
+
+    def _map(self):
+        '''maps header, data and index of the file into memory'''
+        mode = 'r' if self.mode == 'r' else 'r+'
+        self.header = np.memmap(self.path, dtype=np.int64, mode=mode,
+                                offset=len(self.magic), shape=(5,))
+        self.data = np.memmap(self.path, dtype=np.float64, mode=mode, offset=self.header_size,
+                              shape=(self.capacity, self.pop_size, self.columns))
+        self.index = np.memmap(self.path, dtype=np.int64, mode=mode,
+                               offset=self.header_size + self._data_bytes(),
+                               shape=(self.capacity,))
+
+
+    def _grow(self):
+        '''doubles the capacity, the index moves to the new end of the file'''
+        frames = np.array(self.index[:self.count])
+        self.flush()
+        self.header = self.data = self.index = None
+
+        self.capacity *= 2
+        self._resize()
+        self._map()
+        self.index[:] = -1
+        self.index[:self.count] = frames
+        self.header[1] = self.capacity
+
+
+    def append(self, population, frame):
+        '''writes a snapshot of the population taken at given frame
+
+        Keyword arguments
+        -----------------
+        population : ndarray or Columnar_population
+            the population to store, of shape (pop_size, columns)
+
+        frame : int
+            the timestep the snapshot is taken at
+        '''
+        if self.mode == 'r':
+            raise ValueError('snapshot store is opened read-only')
+        if len(population) != self.pop_size:
+            raise ValueError('population size %i does not match the store (%i)'
+                             %(len(population), self.pop_size))
+        if self.count == self.capacity:
+            self._grow()
+
+        if hasattr(population, 'columns'):
+            #columnar population, copy column by column
+            for col, column in enumerate(population.columns):
+                self.data[self.count,:,col] = column
+        else:
+            self.data[self.count] = population
+        self.index[self.count] = frame
+
+        self.count += 1
+        self.header[4] = self.count
+
+
+    @property
+    def frames(self):
+        '''the frame of each stored snapshot'''
+        return np.asarray(self.index[:self.count])
+
+
+    def __len__(self):
+        return self.count
+
+
+    def __getitem__(self, key):
+        return self.data[:self.count][key]
+
+
+    def get_frame(self, frame):
+        '''returns the snapshot taken at given frame'''
+        position = np.flatnonzero(self.frames == frame)
+        if len(position) == 0:
+            raise KeyError('no snapshot of frame %i' %frame)
+        return self.data[position[-1]]
+
+
+    def flush(self):
+        '''writes changes to the mapped file to disk'''
+        if self.mode != 'r' and self.data is not None:
+            self.data.flush()
+            self.index.flush()
+            self.header.flush()
+
+
+    def close(self):
+        '''flushes and unmaps the file'''
+        self.flush()
+        self.header = self.data = self.index = None
+
+
+def new_run_path(folder='data', prefix='run', extension='run'):
+    '''returns a new, unused file path for a run
+
+    Numbers runs as <folder>/<prefix>_<i>.<extension>. The file is created
+    right away, with an exclusive create, so runs finishing at the same time,
+    in other processes as well, never get the same path.
+    '''
+    check_folder(folder)
+    i = len(glob(os.path.join(folder, '%s_*.%s' %(prefix, extension))))
+    while True:
+        path = os.path.join(folder, '%s_%i.%s' %(prefix, i, extension))
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return path
+        except FileExistsError:
+            i += 1
+
+
+def _to_json(value):
+    '''converts a Configuration value to something json can store'''
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (list, tuple)):
+        return [_to_json(item) for item in value]
+    if isinstance(value, dict):
+        return {str(key): _to_json(item) for key, item in value.items()}
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return repr(value)
+
+
+def _config_to_json(Config):
+    '''converts a Configuration to a dict json can store
+
+    Arrays with a value per person, such as lockdown_vector, are left out.
+    '''
+    return {key: _to_json(value) for key, value in vars(Config).items()
+            if not (isinstance(value, np.ndarray) and value.ndim > 0 and
+                    len(value) == Config.pop_size)}
+
+
+class Run_store():
+    '''result file of a single run
+
+    One append-only file, laid out as:
+
+        header  : 8 byte magic and int64 version
+        records : one after another, each made of the int64 sizes of its
+                  description and its data, the description as json, and the
+                  data as a zlib-compressed .npy array
+
+    The first record holds the metadata: the Configuration, seed and chunk
+    size. The others hold chunks of a time series, one value per timestep
+    from timestep start up to stop, or population snapshots.
+
+    Time series are appended one timestep at a time into a buffer, which is
+    compressed and appended to the file as a new record once it holds
+    chunk_size values. Nothing is ever rewritten. If a run crashes, only
+    the values still in the buffers are lost, and a record cut off halfway
+    is skipped when reading. Closing writes out the buffers and ends
+    writing for good.
+
+    When reading, only the descriptions of the records are read when the
+    store is opened. A series is read chunk by chunk, so reading part of it
+    only decompresses the chunks covering that part.
+
+    Keyword arguments
+    -----------------
+    path : str
+        the file to write to or read from, see new_run_path
+
+    mode : str
+        'w' to write a new run, 'r' to read one
+
+    Config : Configuration or None
+        the configuration of the run, stored in the metadata when writing
+
+    seed : int or None
+        the seed of the run, stored in the metadata when writing
+
+    chunk_size : int
+        the number of timesteps per chunk of each series
+    '''
+    magic = b'RUNSTORE'
+    version = 1
+
+    def __init__(self, path, mode='w', Config=None, seed=None, chunk_size=1024):
+        self.path = path
+        self.mode = mode
+
+        if mode == 'w':
+            self.chunk_size = chunk_size
+            self.metadata = {'version': self.version, 'seed': _to_json(seed),
+                             'chunk_size': chunk_size,
+                             'config': {} if Config is None else _config_to_json(Config)}
+            self.file = open(path, 'wb')
+            self.file.write(self.magic)
+            self.file.write(np.int64(self.version).tobytes())
+            self._write_record({'kind': 'metadata'},
+                               zlib.compress(json.dumps(self.metadata).encode()))
+            self.buffers = {}
+            self.lengths = {}
+        elif mode == 'r':
+            self.file = None
+            self._read_records()
+        else:
+            raise ValueError('mode must be \'w\' or \'r\', not %s' %mode)
+
+
+    def _write_record(self, description, data):
+        '''appends one record and pushes it to disk'''
+        description = json.dumps(description).encode()
+        self.file.write(np.array([len(description), len(data)], dtype=np.int64).tobytes())
+        self.file.write(description)
+        self.file.write(data)
+        self.file.flush()
+
+
+    def _read_records(self):
+        '''reads the descriptions of all complete records, with their data offsets'''
+        #chunks per series, with their timestep ranges and data offsets
+        self.chunks = {}
+        self.snapshot_offsets = {}
+        self.metadata = None
+        size = os.path.getsize(self.path)
+        with open(self.path, 'rb') as f:
+            if f.read(len(self.magic)) != self.magic:
+                raise ValueError('%s is not a run store' %self.path)
+            version = np.frombuffer(f.read(8), dtype=np.int64)[0]
+            if version != self.version:
+                raise ValueError('unsupported run store version %i' %version)
+            while True:
+                sizes = f.read(16)
+                if len(sizes) < 16:
+                    break
+                description_size, data_size = np.frombuffer(sizes, dtype=np.int64)
+                offset = f.tell() + description_size
+                if offset + data_size > size:
+                    #cut off while being written
+                    break
+                description = json.loads(f.read(description_size))
+                location = (int(offset), int(data_size))
+                if description['kind'] == 'metadata':
+                    self.metadata = json.loads(zlib.decompress(f.read(data_size)))
+                elif description['kind'] == 'series':
+                    self.chunks.setdefault(description['name'], []).append((description['start'],
+                                                                             description['stop'],
+                                                                             location))
+                elif description['kind'] == 'snapshot':
+                    self.snapshot_offsets[description['frame']] = location
+                f.seek(offset + data_size)
+
+        if self.metadata is None:
+            raise ValueError('%s holds no metadata' %self.path)
+        self.chunk_size = self.metadata['chunk_size']
+        for chunks in self.chunks.values():
+            chunks.sort()
+
+
+    def _write_array(self, description, array):
+        '''appends an array as a compressed .npy record'''
+        data = io.BytesIO()
+        np.save(data, array)
+        self._write_record(description, zlib.compress(data.getvalue()))
+
+
+    def _read_array(self, location):
+        '''reads the array of the record with data at given location'''
+        offset, size = location
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return np.load(io.BytesIO(zlib.decompress(f.read(size))))
+
+
+    def _check_writable(self):
+        if self.mode != 'w':
+            raise ValueError('run store %s is not open for writing' %self.path)
+
+
+    def append(self, name, value):
+        '''appends the value of a series at the next timestep
+
+        The value can be a number, or an array of the same shape every timestep.
+        '''
+        self._check_writable()
+        value = np.asarray(value)
+        if name not in self.buffers:
+            self.buffers[name] = np.zeros((self.chunk_size,) + value.shape, dtype=value.dtype)
+            self.lengths[name] = 0
+        length = self.lengths[name]
+        self.buffers[name][length % self.chunk_size] = value
+        self.lengths[name] = length + 1
+        if self.lengths[name] % self.chunk_size == 0:
+            self._write_chunk(name)
+
+
+    def append_row(self, values):
+        '''appends the values of several series, given as dict of name: value'''
+        self._check_writable()
+        for name, value in values.items():
+            self.append(name, value)
+
+
+    def _write_chunk(self, name):
+        '''writes the buffered values of a series that are not on disk yet'''
+        stop = self.lengths[name]
+        start = ((stop - 1) // self.chunk_size) * self.chunk_size
+        if stop > start:
+            self._write_array({'kind': 'series', 'name': name, 'start': start, 'stop': stop},
+                              self.buffers[name][:stop - start])
+
+
+    def add_snapshot(self, population, frame):
+        '''writes a compressed snapshot of the population at given frame'''
+        self._check_writable()
+        self._write_array({'kind': 'snapshot', 'frame': int(frame)}, np.asarray(population))
+
+
+    def close(self):
+        '''writes the remaining buffered values and ends writing
+
+        Nothing can be appended to a closed store. Closing again does nothing.
+        '''
+        if self.mode == 'w':
+            for name in self.buffers:
+                if self.lengths[name] % self.chunk_size != 0:
+                    self._write_chunk(name)
+            self.file.close()
+            self.file = None
+            self.mode = 'closed'
+
+
+    @property
+    def series_names(self):
+        return list(self.chunks)
+
+
+    @property
+    def snapshot_frames(self):
+        return sorted(self.snapshot_offsets)
+
+
+    def length(self, name):
+        '''returns the number of timesteps of a series, without reading it'''
+        return self.chunks[name][-1][1] if len(self.chunks[name]) > 0 else 0
+
+
+    def get_series(self, name, start=0, stop=None):
+        '''returns timesteps start up to stop of a series, reading only the chunks needed'''
+        if stop is None:
+            stop = self.length(name)
+        parts = [self._read_array(location)[max(start - first, 0):stop - first]
+                 for first, last, location in self.chunks[name]
+                 if first < stop and last > start]
+        if len(parts) == 0:
+            return np.zeros((0,))
+        return np.concatenate(parts)
+
+
+    def get_snapshot(self, frame):
+        '''returns the population snapshot at given frame'''
+        return self._read_array(self.snapshot_offsets[frame])
@@ -0,0 +1,198 @@
+'''
+contains the parameter sweep runner, which runs headless simulations for
+every combination of a grid of Configuration values, many times each, on
+a pool of processes
+'''
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import contextlib
+import csv
+import itertools
+import os
+
+import numpy as np
+
+from simulation import Simulation
+from utils import check_folder
+
+
+def default_setup(sim):
+    '''applies scenario flags that need more than setting a config value
+
+    Activates the lockdown (drawing the lockdown vector with
+    Config.lockdown_compliance) if Config.lockdown is set, and
+    re-initializes the population so it respects the configured bounds.
+    '''
+    if sim.Config.lockdown:
+        sim.Config.set_lockdown(sim.Config.lockdown_percentage,
+                                sim.Config.lockdown_compliance)
+    sim.population_init()
+
+
+def run_single(config_kwargs, seed, setup=default_setup):
+    '''runs one headless simulation and returns its curves
+
+    Keyword arguments
+    -----------------
+    config_kwargs : dict
+        keyword arguments passed to Simulation (and so to Configuration)
+
+    seed : int
+        seed for the random generators, see Config.seed
+
+    setup : function
+        called with the simulation before running, to apply scenarios
+
+    Returns
+    -------
+    infected, fatalities : ndarray
+        number of infectious and dead people over time
+    '''
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        sim = Simulation(**dict(config_kwargs, visualise = False, verbose = False, seed = seed))
+        if setup is not None:
+            setup(sim)
+        sim.run()
+
+    return np.asarray(sim.pop_tracker.infectious), np.asarray(sim.pop_tracker.fatalities)
+
+
+def format_value(value):
+    '''returns a parameter value as it appears in file names and the summary'''
+    return str(value).replace(' ', '')
+
+
+def pad_curves(curves):
+    '''stacks curves of unequal length, extending each with its last value'''
+    length = max(len(curve) for curve in curves)
+    padded = np.zeros((len(curves), length))
+    for i, curve in enumerate(curves):
+        padded[i,:len(curve)] = curve
+        padded[i,len(curve):] = curve[-1] if len(curve) > 0 else 0
+    return padded
+
+
+def save_atomic(path, array):
+    '''saves array so that a crash can never leave a partially written file'''
+    np.save(path + '.tmp.npy', array)
+    os.replace(path + '.tmp.npy', path)
+
+
+def run_sweep(parameter_grid, runs=100, output_folder='data/sweep', summary_file=None,
+              max_workers=None, base_seed=0, setup=default_setup, **config_kwargs):
+    '''runs a parameter sweep in parallel, resuming where a previous run stopped
+
+    Every combination of the values in parameter_grid (a 'cell') is simulated
+    'runs' times, with seeds base_seed up to base_seed + runs, so cells share
+    their random numbers. Runs are spread over a ProcessPoolExecutor.
+
+    As runs finish, their curves are written to
+    <output_folder>/<cell>/<seed>_infected.npy and <seed>_fatalities.npy.
+    Once all runs of a cell are done, the mean curves are written to
+    <output_folder>/<cell>_infected.npy and <cell>_fatalities.npy, and a row
+    with the mean, median, max and min over runs of the peak number of infected
+    and of the final number of fatalities is appended to the summary csv.
+
+    Cells already in the summary are skipped, and runs whose curves are already
+    on disk are loaded rather than run again.
+
+    Keyword arguments
+    -----------------
+    parameter_grid : dict
+        maps Configuration keys to lists of values to sweep over
+
+    runs : int
+        number of runs (seeds) per cell
+
+    output_folder : str
+        folder to write curves to
+
+    summary_file : str or None
+        csv file to write the summary to. Defaults to output_folder + '.csv'
+
+    max_workers : int or None
+        number of processes to use, defaults to the number of cpus
+
+    base_seed : int
+        seed of the first run of every cell
+
+    setup : function
+        applied to every simulation before running, must be picklable (defined
+        at module level)
+
+    all other arguments are passed to every Simulation
+    '''
+    if summary_file is None:
+        summary_file = output_folder.rstrip('/') + '.csv'
+    check_folder(output_folder)
+
+    keys = list(parameter_grid.keys())
+    stat_columns = ['%s_%s' %(curve, stat) for curve in ['infected', 'fatalities']
+                    for stat in ['mean', 'median', 'max', 'min']]
+
+    #find cells finished by a previous sweep
+    finished = set()
+    if os.path.exists(summary_file):
+        with open(summary_file, newline='') as f:
+            for row in csv.DictReader(f):
+                finished.add(tuple(row[key] for key in keys))
+    else:
+        with open(summary_file, 'w', newline='') as f:
+            csv.writer(f).writerow(keys + stat_columns)
+
+    cells = {}
+    for values in itertools.product(*[parameter_grid[key] for key in keys]):
+        labels = tuple(format_value(value) for value in values)
+        if labels in finished:
+            continue
+        name = '_'.join(labels) if len(keys) == 1 else\
+               '_'.join('%s=%s' %(key, label) for key, label in zip(keys, labels))
+        cells[labels] = {'name': name, 'params': dict(zip(keys, values)),
+                         'results': {}}
+
+    def finish_cell(labels):
+        cell = cells[labels]
+        seeds = sorted(cell['results'])
+        infected = pad_curves([cell['results'][seed][0] for seed in seeds])
+        fatalities = pad_curves([cell['results'][seed][1] for seed in seeds])
+        save_atomic(os.path.join(output_folder, '%s_infected.npy' %cell['name']), infected.mean(axis=0))
+        save_atomic(os.path.join(output_folder, '%s_fatalities.npy' %cell['name']), fatalities.mean(axis=0))
+
+        peaks = infected.max(axis=1)
+        final = fatalities[:,-1]
+        row = list(labels)
+        for values in [peaks, final]:
+            row += ['%f' %np.mean(values), '%f' %np.median(values),
+                    '%f' %np.max(values), '%f' %np.min(values)]
+        with open(summary_file, 'a', newline='') as f:
+            csv.writer(f).writerow(row)
+
+    #load runs that finished before, queue the rest
+    pending = []
+    for labels, cell in cells.items():
+        folder = os.path.join(output_folder, cell['name'])
+        check_folder(folder)
+        for seed in range(base_seed, base_seed + runs):
+            paths = [os.path.join(folder, '%i_infected.npy' %seed),
+                     os.path.join(folder, '%i_fatalities.npy' %seed)]
+            if all(os.path.exists(path) for path in paths):
+                cell['results'][seed] = [np.load(path) for path in paths]
+            else:
+                pending.append((labels, seed, paths))
+        if len(cell['results']) == runs:
+            finish_cell(labels)
+
+    with ProcessPoolExecutor(max_workers = max_workers) as executor:
+        futures = {executor.submit(run_single, dict(config_kwargs, **cells[labels]['params']),
+                                   seed, setup): (labels, seed, paths)
+                   for labels, seed, paths in pending}
+
+        for future in as_completed(futures):
+            labels, seed, paths = futures[future]
+            infected, fatalities = future.result()
+            save_atomic(paths[0], infected)
+            save_atomic(paths[1], fatalities)
+
+            cells[labels]['results'][seed] = [infected, fatalities]
+            if len(cells[labels]['results']) == runs:
+                finish_cell(labels)
@@ -0,0 +1,8 @@
+'''
+makes the modules of the repository importable from the tests
+'''
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
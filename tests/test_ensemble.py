@@ -0,0 +1,82 @@
+'''
+tests the ensemble engine running replicas side by side
+'''
+
+import numpy as np
+import pytest
+
+from ensemble import Ensemble
+
+
+def test_replicas_stay_in_the_world_and_the_dead_stay_put():
+    ensemble = Ensemble(replicas = 4, seed = 1, pop_size = 300, boundary = 'torus',
+                        verbose = False)
+    ensemble.state_registry.set_state(ensemble.flat_population, [5, 305], 3)
+    dead = ensemble.flat_population[[5, 305],1:3].copy()
+    for step in range(60):
+        ensemble.tstep()
+        assert np.array_equal(ensemble.flat_population[[5, 305],1:3], dead)
+
+    wandering = ensemble.flat_population[:,11] == 0
+    x = ensemble.flat_population[:,1][wandering]
+    y = ensemble.flat_population[:,2][wandering]
+    assert x.min() >= ensemble.Config.xbounds[0] and x.max() <= ensemble.Config.xbounds[1]
+    assert y.min() >= ensemble.Config.ybounds[0] and y.max() <= ensemble.Config.ybounds[1]
+
+
+def test_only_replicas_in_lockdown_are_held():
+    ensemble = Ensemble(replicas = 2, seed = 1, pop_size = 300, lockdown = True,
+                        lockdown_percentage = 0.1, verbose = False)
+    ensemble.callback = lambda: None
+    #put the first replica over the lockdown threshold
+    ensemble.state_registry.set_state(ensemble.flat_population, np.arange(40), 1)
+    before = ensemble.population[:,:,1:3].copy()
+    ensemble.tstep()
+
+    complying = ensemble.lockdown_vector[0] == 0
+    assert np.array_equal(ensemble.population[0][complying,1:3], before[0][complying])
+    assert not np.array_equal(ensemble.population[0][~complying,1:3], before[0][~complying])
+    assert ensemble.population[0][~complying,5].max() <= 0.001
+    assert np.count_nonzero((ensemble.population[1,:,1:3] != before[1]).all(axis=1)) > 250
+
+
+def test_numba_ensemble_runs():
+    pytest.importorskip('numba')
+    ensemble = Ensemble(replicas = 3, seed = 1, pop_size = 200, backend = 'numba',
+                        verbose = False)
+    for step in range(60):
+        ensemble.tstep()
+    assert ensemble.count_states(1).sum() > 0
+
+
+def test_replicas_do_not_infect_each_other():
+    ensemble = Ensemble(replicas = 3, seed = 2, pop_size = 300, infection_chance = 0.5,
+                        infection_range = 0.05, verbose = False)
+    ensemble.callback = lambda: None
+    #infect only the middle replica
+    patients = np.arange(300, 310)
+    ensemble.state_registry.set_state(ensemble.flat_population, patients, 1)
+    ensemble.recovery_scheduler.schedule(ensemble.flat_population, patients, ensemble.Config)
+    for step in range(50):
+        ensemble.tstep()
+
+    infected = ensemble.count_states(1) + ensemble.count_states(2) + ensemble.count_states(3)
+    assert infected[0] == 0 and infected[2] == 0
+    assert infected[1] > 10
+
+
+def test_statistics_aggregate_the_replica_trackers():
+    ensemble = Ensemble(replicas = 5, seed = 3, pop_size = 200, infection_chance = 0.3,
+                        infection_range = 0.05, verbose = False)
+    for step in range(80):
+        ensemble.tstep()
+
+    statistics = ensemble.get_statistics()
+    infectious = np.stack([tracker.infectious for tracker in ensemble.pop_trackers])
+    fatalities = np.stack([tracker.fatalities for tracker in ensemble.pop_trackers])
+    assert infectious.shape == (5, 80)
+    assert np.allclose(statistics['infectious']['mean'], infectious.mean(axis = 0))
+    assert np.allclose(statistics['infectious']['median'], np.median(infectious, axis = 0))
+    assert np.array_equal(statistics['infectious']['max'], infectious.max(axis = 0))
+    assert np.array_equal(statistics['fatalities']['min'], fatalities.min(axis = 0))
+    assert infectious[:,-1].sum() > 0
@@ -0,0 +1,40 @@
+'''
+tests the walls and zones of the environment
+'''
+
+import numpy as np
+
+from simulation import Simulation
+
+
+def test_nobody_crosses_a_wall_except_through_the_entrance():
+    np.random.seed(3)
+    sim = Simulation(pop_size = 400, visualise = False, verbose = False,
+                     infection_chance = 0.3, infection_range = 0.03)
+    sim.Config.set_self_isolation(self_isolate_proportion = 1,
+                                  isolation_bounds = [0.02, 0.02, 0.09, 0.98])
+    sim.population_init()
+    xmin, ymin, xmax, ymax = sim.Config.isolation_bounds
+    sent = 0
+
+    for frame in range(400):
+        old = sim.population[:,1:3].copy()
+        sim.tstep()
+        new = sim.population[:,1:3]
+
+        environment = sim.environment
+        was_inside = environment.zone_of(old[:,0], old[:,1]) == 0
+        inside = environment.zone_of(new[:,0], new[:,1]) == 0
+        #the healthy are never sent there, so never get in
+        assert not np.any(inside & (sim.population[:,6] == 0))
+
+        #anyone getting in or out passed the right wall, through its middle half
+        passed = np.flatnonzero(was_inside != inside)
+        t = (xmax - old[passed,0]) / (new[passed,0] - old[passed,0])
+        y = old[passed,1] + t * (new[passed,1] - old[passed,1])
+        assert np.all((t >= 0) & (t <= 1))
+        assert np.all((y >= ymin + (ymax - ymin) / 4) & (y <= ymax - (ymax - ymin) / 4))
+        sent += np.count_nonzero(inside & ~was_inside)
+
+    assert sent > 10
+    assert len(environment.walls) == 5
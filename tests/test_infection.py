@@ -0,0 +1,67 @@
+'''
+tests infecting, recovering and dying
+'''
+
+import numpy as np
+
+from config import Configuration
+from infection import Recovery_scheduler, infect, is_due
+from population import initialize_population
+
+
+def test_infect_reaches_everyone_in_range():
+    np.random.seed(0)
+    Config = Configuration(pop_size = 600, infection_chance = 1.0, infection_range = 0.03,
+                           healthcare_capacity = 20, verbose = False)
+    population = initialize_population(Config)
+    population[:,6][np.random.uniform(size = (600,)) < 0.1] = 1
+    infected = population[:,6] == 1
+
+    #everyone healthy with an infected person strictly inside the square around them
+    dx = np.abs(population[:,1][:,None] - population[:,1][infected][None,:])
+    dy = np.abs(population[:,2][:,None] - population[:,2][infected][None,:])
+    exposed = np.flatnonzero(~infected & np.any((dx < 0.03) & (dy < 0.03), axis = 1))
+
+    population = infect(population, Config, 5)
+    new_infections = np.flatnonzero(~infected & (population[:,6] == 1))
+    assert len(exposed) > 20
+    assert np.array_equal(new_infections, exposed)
+    assert np.all(population[:,8][new_infections] == 5)
+    #treatment slots go to the first newly infected
+    assert np.array_equal(np.flatnonzero(population[:,10] == 1), new_infections[:20])
+
+
+def test_recovery_scheduler_matches_is_due():
+    np.random.seed(0)
+    Config = Configuration(pop_size = 300)
+    population = initialize_population(Config)
+    scheduler = Recovery_scheduler()
+
+    infected = np.random.choice(300, 100, replace = False)
+    population[:,6][infected] = 1
+    population[:,8][infected] = np.random.randint(0, 20, size = (100,))
+    scheduler.schedule(population, infected, Config)
+
+    for frame in range(20, 600):
+        due = scheduler.pop_due(population, frame)
+        sick = np.flatnonzero(population[:,6] == 1)
+        expected = sick[is_due(population, sick, frame, Config)]
+        assert np.array_equal(due, expected)
+        population[:,6][due] = 2
+
+    assert np.all(population[:,6][infected] == 2)
+
+
+def test_recovery_scheduler_drops_stale_entries():
+    Config = Configuration(pop_size = 10)
+    population = np.zeros((10, 15))
+    population[:,6] = 1
+    population[:,9] = 0.5
+    scheduler = Recovery_scheduler()
+    scheduler.schedule(population, np.arange(10), Config)
+
+    #some recover early, others get reinfected later
+    population[:5,6] = 2
+    population[5:7,8] = 100
+    due = scheduler.pop_due(population, 10000)
+    assert due.tolist() == [7, 8, 9]
@@ -0,0 +1,96 @@
+'''
+tests the motion kernel
+'''
+
+import numpy as np
+import pytest
+
+from config import Configuration
+from motion import Motion_kernel
+from population import Columnar_population, initialize_population
+from simulation import Simulation
+
+
+def test_retired_stay_put():
+    np.random.seed(0)
+    Config = Configuration(pop_size = 200)
+    population = initialize_population(Config)
+    kernel = Motion_kernel(200)
+    dead = np.arange(20)
+    start = population[:,1:3][dead].copy()
+
+    for step in range(100):
+        kernel.step(population, Config, frozen = dead)
+
+    assert np.all(population[:,5][dead] == 0)
+    assert np.array_equal(population[:,1:3][dead], start)
+
+
+def test_held_columnar_population_is_gathered_per_column(monkeypatch):
+    np.random.seed(0)
+    Config = Configuration(pop_size = 100)
+    population = Columnar_population(100)
+    population[:,1] = np.random.uniform(size = (100,))
+    population[:,2] = np.random.uniform(size = (100,))
+    population[:,3] = np.random.normal(0, 1/3, size = (100,))
+    population[:,5] = 0.01
+
+    def no_matrix(*args, **kwargs):
+        raise AssertionError('the full population matrix was built')
+    monkeypatch.setattr(Columnar_population, '__array__', no_matrix)
+
+    kernel = Motion_kernel(100)
+    kernel.hold(np.arange(70))
+    x = population[:,1].copy()
+    kernel.step(population, Config)
+
+    assert np.array_equal(population[:,1][:70], x[:70])
+    assert np.all(population[:,1][70:] != x[70:])
+
+
+def test_torus_keeps_destinations():
+    np.random.seed(0)
+    Config = Configuration(pop_size = 100, boundary = 'torus')
+    population = initialize_population(Config)
+    #half are at a destination outside the world, heading further out
+    population[:50,1] = -0.1
+    population[:50,3] = -1
+    population[:50,5] = 0.02
+    population[:50,11] = 1
+    population[:50,12] = 1
+    #the other half roam, about to leave the world
+    xmin, xmax = Config.xbounds
+    population[50:,1] = xmax - 0.01
+    population[50:,3] = 1
+    population[50:,5] = 0.02
+
+    Motion_kernel(100).step(population, Config, randomize = False)
+
+    assert np.allclose(population[:50,1], -0.12)
+    assert np.allclose(population[50:,1], xmin + 0.01)
+
+
+def test_population_size_can_change():
+    np.random.seed(0)
+    sim = Simulation(pop_size = 100, visualise = False, verbose = False)
+    for frame in range(10):
+        sim.tstep()
+
+    sim.Config.pop_size = 300
+    sim.reinitialise()
+    for frame in range(10):
+        sim.tstep()
+    assert len(sim.population) == 300
+    assert sim.motion_kernel.pop_size == 300
+
+
+def test_numba_backend_is_reproducible():
+    pytest.importorskip('numba')
+    populations = []
+    for run in range(2):
+        sim = Simulation(pop_size = 200, visualise = False, verbose = False, seed = 4,
+                         backend = 'numba')
+        for frame in range(60):
+            sim.tstep()
+        populations.append(np.array(sim.population))
+    assert np.array_equal(populations[0], populations[1])
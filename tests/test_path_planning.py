@@ -0,0 +1,81 @@
+'''
+tests sending people to destinations and keeping them there
+'''
+
+import numpy as np
+
+from config import Configuration
+from path_planning import check_at_destination, go_to_location, go_to_locations,\
+keep_at_destination, set_destination
+from population import State_registry, initialize_destination_matrix, initialize_population
+
+
+def make_population(pop_size=300, destinations=4, seed=0):
+    np.random.seed(seed)
+    population = initialize_population(Configuration(pop_size = pop_size))
+    return population, initialize_destination_matrix(pop_size, destinations)
+
+
+def test_go_to_locations_matches_go_to_location():
+    population, destinations = make_population()
+    expected_population = population.copy()
+    expected_destinations = destinations.copy()
+    ids = np.array([3, 17, 40, 41, 299])
+    bounds = np.random.uniform(0, 1, size = (len(ids), 4))
+    bounds[:,2:] += 1
+    dest_no = np.array([1, 2, 4, 2, 3])
+
+    for i, patient in enumerate(ids):
+        go_to_location(expected_population[patient], expected_destinations[patient],
+                       bounds[i], dest_no[i])
+
+    registry = State_registry(population)
+    population, destinations = go_to_locations(population, destinations, ids, bounds,
+                                               dest_no, registry)
+    assert np.array_equal(population, expected_population)
+    assert np.array_equal(destinations, expected_destinations)
+    assert registry.destination.indices().tolist() == ids.tolist()
+
+    #one location for everyone, 0 clears the destination again
+    population, destinations = go_to_locations(population, destinations, ids[:2],
+                                               [0, 0, 0.2, 0.4], 0, registry)
+    assert population[:,11][ids[:2]].tolist() == [0, 0]
+    assert population[:,13][ids[:2]].tolist() == [0.1, 0.1]
+    assert registry.destination.indices().tolist() == ids[2:].tolist()
+
+
+def test_many_destinations_are_handled_per_person():
+    #every person has their own destination, out of hundreds
+    population, destinations = make_population(pop_size = 600, destinations = 300)
+    ids = np.arange(0, 600, 2)
+    dest_no = np.random.randint(1, 301, size = len(ids))
+    centers = np.random.uniform(0.1, 0.9, size = (len(ids), 2))
+    destinations[ids, (dest_no - 1) * 2] = centers[:,0]
+    destinations[ids, (dest_no - 1) * 2 + 1] = centers[:,1]
+    population[:,11][ids] = dest_no
+    population[:,13:15][ids] = 0.05
+    #half have arrived already
+    population[:,12][ids[::2]] = 1
+
+    set_destination(population, destinations)
+    travelling = ids[1::2]
+    assert np.allclose(population[:,3][travelling], centers[1::2,0] - population[:,1][travelling])
+    assert np.allclose(population[:,4][travelling], centers[1::2,1] - population[:,2][travelling])
+    assert np.all(population[:,5][travelling] == 0.02)
+
+    #move some of the travellers onto their destination
+    population[:,1:3][travelling[:20]] = centers[1::2][:20]
+    near = np.all(np.abs(population[:,1:3][travelling] - centers[1::2]) < 0.05 * 1.5, axis = 1)
+    check_at_destination(population, destinations, wander_factor = 1.5)
+    assert np.array_equal(population[:,12][travelling] == 1, near)
+    assert np.all(near[:20])
+
+    #those far off their destination are turned back towards it
+    arrived = ids[::2]
+    population[:,1][arrived] = centers[::2,0] + 0.5
+    population[:,2][arrived] = centers[::2,1] - 0.5
+    keep_at_destination(population, destinations)
+    assert np.all(population[:,3][arrived] < 0)
+    assert np.all(population[:,4][arrived] > 0)
+    #those without a destination are left alone
+    assert np.all(population[:,5][1::2] != 0.02)
@@ -0,0 +1,85 @@
+'''
+tests the state registry and the population trackers
+'''
+
+import io
+import contextlib
+
+import numpy as np
+
+from config import Configuration
+from population import Index_set, Population_trackers, State_registry, initialize_population
+from simulation import Simulation
+
+
+def test_index_set_add_and_remove():
+    members = Index_set(10)
+    members.add([3, 1, 3, 7])
+    members.remove([1, 5])
+    members.add([9])
+    assert members.indices().tolist() == [3, 7, 9]
+    assert members.count == 3
+    members.clear()
+    assert members.indices().tolist() == []
+
+
+def test_registry_matches_the_population_during_a_run():
+    sim = Simulation(pop_size = 500, visualise = False, verbose = False, seed = 1,
+                     infection_chance = 0.3, infection_range = 0.03, self_isolate = True)
+    sim.population[:,6][:5] = 1
+    for frame in range(300):
+        with contextlib.redirect_stdout(io.StringIO()):
+            sim.tstep()
+        registry = sim.state_registry
+        for state in range(5):
+            assert np.array_equal(registry.in_state(state), np.flatnonzero(sim.population[:,6] == state))
+            assert registry.count(state) == np.count_nonzero(sim.population[:,6] == state)
+        assert np.array_equal(registry.treatment.indices(), np.flatnonzero(sim.population[:,10] == 1))
+        assert np.array_equal(registry.destination.indices(), np.flatnonzero(sim.population[:,11] != 0))
+    assert registry.count(2) + registry.count(3) > 0
+
+
+def test_trackers_grow_and_count_every_series():
+    np.random.seed(0)
+    population = initialize_population(Configuration(pop_size = 200))
+    population[:,6] = np.random.randint(0, 5, size = 200)
+    population[:,10] = np.random.uniform(size = 200) < 0.2
+    registry = State_registry(population)
+
+    tracker = Population_trackers(capacity = 4)
+    with_registry = Population_trackers(capacity = 4)
+    for frame in range(10):
+        tracker.update_counts(population)
+        with_registry.update_counts(population, registry)
+
+    states = np.bincount(population[:,6].astype(int), minlength = 5)
+    assert len(tracker.infectious) == 10
+    assert tracker.counts.shape[1] >= 10
+    for counts in [tracker, with_registry]:
+        assert np.all(counts.infectious == states[1])
+        assert np.all(counts.recovered == states[2])
+        assert np.all(counts.fatalities == states[3])
+        assert np.all(counts.immune_infectious == states[4])
+        assert np.all(counts.in_treatment == np.count_nonzero(population[:,10]))
+        assert np.all(counts.susceptible == 200 - states[1] - states[2] - states[3])
+
+
+def test_age_cohort_counts():
+    np.random.seed(0)
+    population = initialize_population(Configuration(pop_size = 300))
+    population[:,6] = np.random.randint(0, 5, size = 300)
+    age_bins = [0, 20, 40, 60, 80]
+
+    tracker = Population_trackers(capacity = 2)
+    tracker.track_age_cohorts(population, age_bins)
+    for frame in range(3):
+        population[:,6][frame * 10] = 3
+        tracker.update_counts(population)
+
+    assert tracker.age_counts.shape == (3, 5, 5)
+    cohorts = np.clip(np.digitize(population[:,7], age_bins) - 1, 0, 4)
+    for cohort in range(5):
+        expected = np.bincount(population[:,6][cohorts == cohort].astype(int), minlength = 5)
+        assert np.array_equal(tracker.age_counts[-1, cohort], expected)
+    #every timestep counts everyone once
+    assert np.all(tracker.age_counts.sum(axis = (1, 2)) == 300)
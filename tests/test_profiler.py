@@ -0,0 +1,47 @@
+'''
+tests the stage profiler of Simulation.tstep
+'''
+
+import io
+import contextlib
+import json
+
+import numpy as np
+
+from profiler import Null_profiler, Stage_profiler
+from simulation import Simulation
+
+
+def test_profiled_run_reports_every_stage(tmp_path):
+    path = str(tmp_path / 'profile.json')
+    np.random.seed(0)
+    sim = Simulation(pop_size = 200, simulation_steps = 30, visualise = False, verbose = False,
+                     profile = True, profile_window = 10, profile_path = path)
+    with contextlib.redirect_stdout(io.StringIO()):
+        sim.run()
+
+    statistics = sim.get_profile()
+    for stage in ['destinations', 'motion', 'infect', 'recover_or_die', 'trackers', 'console']:
+        assert statistics[stage]['calls'] == 30
+        assert 0 <= statistics[stage]['p50'] <= statistics[stage]['p95'] <= statistics[stage]['max']
+    with open(path) as f:
+        assert json.load(f) == statistics
+
+
+def test_ring_buffer_keeps_the_last_window():
+    profiler = Stage_profiler(window = 4)
+    for duration in [5, 1, 1, 1, 1, 2]:
+        profiler.record('stage', duration)
+    statistics = profiler.get_statistics()['stage']
+    assert statistics['calls'] == 6
+    assert statistics['total'] == 11
+    assert statistics['max'] == 2
+
+
+def test_disabled_profiler_records_nothing():
+    np.random.seed(0)
+    sim = Simulation(pop_size = 100, visualise = False, verbose = False)
+    assert isinstance(sim.profiler, Null_profiler)
+    with contextlib.redirect_stdout(io.StringIO()):
+        sim.tstep()
+    assert sim.get_profile() == {}
@@ -0,0 +1,71 @@
+'''
+tests the travel schedule
+'''
+
+import numpy as np
+import pytest
+
+from population import initialize_destination_matrix
+from schedule import Travel_schedule
+from simulation import Simulation
+
+
+def test_due_and_apply():
+    schedule = Travel_schedule(4, 4, legs = 2, day_length = 10)
+    schedule.set_leg([0, 1], 0, 2, 3)
+    schedule.set_leg([2], 0, 3, 3)
+    schedule.set_leg([0], 1, 0, 7)
+
+    ids, legs = schedule.due(13)
+    assert sorted(ids.tolist()) == [0, 1, 2]
+    ids, legs = schedule.due(7)
+    assert ids.tolist() == [0]
+    assert len(schedule.due(5)[0]) == 0
+
+    population = np.zeros((4, 15))
+    population[1,6] = 3
+    schedule.apply(population, 3)
+    #the dead are left alone
+    assert population[:,11].tolist() == [2, 0, 3, 0]
+    assert population[0,13] == pytest.approx(0.05)
+
+    schedule.apply(population, 7)
+    assert population[:,11].tolist() == [0, 0, 3, 0]
+
+
+def test_set_leg_rejects_isolation_unknown_destinations_and_late_departures():
+    schedule = Travel_schedule(4, 3, day_length = 10)
+    with pytest.raises(ValueError):
+        schedule.set_leg([0], 0, 1, 3)
+    with pytest.raises(ValueError):
+        schedule.set_leg([0, 1], 0, [2, 3], 3)
+    with pytest.raises(ValueError):
+        schedule.set_leg([0], 0, 2, 10)
+    schedule.set_leg([0], 0, 2, -1)
+
+
+def test_recovered_keep_their_leg():
+    np.random.seed(0)
+    sim = Simulation(pop_size = 100, visualise = False, verbose = False)
+    sim.destinations = initialize_destination_matrix(100, 3)
+    sim.destinations[:,2:4] = 0.5
+    sim.travel_schedule = Travel_schedule(100, 3, legs = 1, day_length = 50)
+    sim.travel_schedule.set_leg(np.arange(100), 0, 2, 5)
+    sim.population[:,6][:10] = 2
+    sim.state_registry.rebuild(sim.population)
+
+    for frame in range(10):
+        sim.tstep()
+    assert np.all(sim.population[:,11][:10] == 2)
+
+
+def test_reinitialise_drops_the_schedule():
+    np.random.seed(0)
+    sim = Simulation(pop_size = 100, visualise = False, verbose = False)
+    sim.destinations = initialize_destination_matrix(100, 3)
+    sim.travel_schedule = Travel_schedule(100, 3, legs = 1, day_length = 50)
+    sim.travel_schedule.set_leg(np.arange(100), 0, 2, 5)
+    sim.reinitialise()
+    assert sim.travel_schedule is None
+    for frame in range(10):
+        sim.tstep()
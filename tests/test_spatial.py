@@ -0,0 +1,146 @@
+'''
+tests the spatial indexes against brute-force searches of the whole population
+'''
+
+import numpy as np
+import pytest
+
+from config import Configuration
+from infection import count_exposures, find_nearby
+from population import initialize_population
+from spatial import Neighbour_list, Spatial_grid
+
+
+def make_population(pop_size=600, seed=0):
+    np.random.seed(seed)
+    population = initialize_population(Configuration(pop_size=pop_size))
+    population[:,6][np.random.uniform(size=(pop_size,)) < 0.1] = 1
+    return population
+
+
+def in_box(population, zone):
+    '''masks everyone strictly inside zone'''
+    return ((zone[0] < population[:,1]) & (population[:,1] < zone[2]) &
+            (zone[1] < population[:,2]) & (population[:,2] < zone[3]))
+
+
+def brute_force_exposures(population, infection_range):
+    '''counts the infected around every healthy person by masking the population'''
+    exposures = np.zeros((len(population),), dtype=np.int64)
+    for j in np.flatnonzero(population[:,6] == 0):
+        x, y = population[j,1], population[j,2]
+        zone = [x - infection_range, y - infection_range, x + infection_range, y + infection_range]
+        exposures[j] = np.count_nonzero(in_box(population, zone) & (population[:,6] == 1))
+    return exposures
+
+
+def test_find_nearby_matches_masking_the_population():
+    population = make_population()
+    population[:,11][::7] = 1
+    grid = Spatial_grid(population, 0.05)
+    for patient in np.flatnonzero(population[:,6] == 1):
+        x, y = population[patient,1], population[patient,2]
+        zone = [x - 0.05, y - 0.05, x + 0.05, y + 0.05]
+        inside = in_box(population, zone)
+        healthy = np.flatnonzero(inside & (population[:,6] == 0))
+        infected = np.count_nonzero(inside & (population[:,6] == 1))
+        staying = np.count_nonzero(inside & (population[:,6] == 1) & (population[:,11] == 0))
+
+        for searched_grid in [grid, None]:
+            assert np.array_equal(find_nearby(population, zone, kind = 'healthy',
+                                              grid = searched_grid), healthy)
+            assert find_nearby(population, zone, kind = 'infected', traveling_infects = True,
+                               infected_previous_step = population,
+                               grid = searched_grid) == infected
+            assert find_nearby(population, zone, kind = 'infected',
+                               infected_previous_step = population,
+                               grid = searched_grid) == staying
+
+        #small arrays are masked as a whole
+        assert find_nearby(population[:100], zone, kind = 'healthy').tolist() == \
+            [row for row in healthy if row < 100]
+
+
+def test_count_exposures_matches_brute_force():
+    population = make_population()
+    infected = np.flatnonzero(population[:,6] == 1)
+    healthy = np.flatnonzero(population[:,6] == 0)
+    assert np.array_equal(count_exposures(population, infected, healthy, 0.03),
+                          brute_force_exposures(population, 0.03))
+
+
+def test_neighbour_list_matches_count_exposures_while_moving():
+    population = make_population()
+    infected = np.flatnonzero(population[:,6] == 1)
+    healthy = np.flatnonzero(population[:,6] == 0)
+    neighbour_list = Neighbour_list(0.03)
+
+    for step in range(40):
+        #some move a little, a few move far
+        population[:,1:3] += np.random.normal(0, 0.001, size = (len(population), 2))
+        jumping = np.random.choice(len(population), 20, replace = False)
+        population[jumping,1:3] += np.random.normal(0, 0.05, size = (20, 2))
+        assert np.array_equal(neighbour_list.count_exposures(population, infected, healthy, 0.03),
+                              count_exposures(population, infected, healthy, 0.03))
+    #most steps only refresh the pairs of those who moved
+    assert neighbour_list.rebuilds < 40
+
+
+def test_pairs_within_matches_brute_force():
+    population = make_population(300)
+    neighbour_list = Neighbour_list(0.05)
+    i, j = neighbour_list.pairs_within(population, 0.04)
+
+    dx = np.abs(population[:,1][:,None] - population[:,1][None,:])
+    dy = np.abs(population[:,2][:,None] - population[:,2][None,:])
+    expected = np.argwhere((dx < 0.04) & (dy < 0.04))
+    expected = expected[expected[:,0] < expected[:,1]]
+
+    found = sorted(zip(i.tolist(), j.tolist()))
+    assert found == sorted(map(tuple, expected.tolist()))
+
+
+def brute_force_pairs(population, query_range):
+    dx = np.abs(population[:,1][:,None] - population[:,1][None,:])
+    dy = np.abs(population[:,2][:,None] - population[:,2][None,:])
+    pairs = np.argwhere((dx < query_range) & (dy < query_range))
+    return sorted(map(tuple, pairs[pairs[:,0] < pairs[:,1]].tolist()))
+
+
+def test_pairs_within_stay_complete_while_moving():
+    population = make_population(400)
+    neighbour_list = Neighbour_list(0.04)
+    for step in range(30):
+        population[:,1:3] += np.random.normal(0, 0.003, size = (len(population), 2))
+        i, j = neighbour_list.pairs_within(population, 0.04)
+        assert sorted(zip(i.tolist(), j.tolist())) == brute_force_pairs(population, 0.04)
+    assert neighbour_list.rebuilds < 30
+
+
+def test_grid_move_matches_new_grid():
+    population = make_population(300)
+    grid = Spatial_grid(population, 0.05)
+    moved = np.random.choice(300, 40, replace = False)
+    population[moved,1:3] += np.random.normal(0, 0.05, size = (40, 2))
+    population[moved,1:3] = np.clip(population[moved,1:3], 0.1, 1.9)
+    assert grid.move(population, moved)
+
+    fresh = Spatial_grid(population, 0.05)
+    for row in range(0, 300, 7):
+        x, y = population[row,1], population[row,2]
+        assert np.array_equal(grid.query_box(population, [x - 0.05, y - 0.05, x + 0.05, y + 0.05]),
+                              fresh.query_box(population, [x - 0.05, y - 0.05, x + 0.05, y + 0.05]))
+
+
+def test_numba_count_exposures_with_replicas_far_apart():
+    pytest.importorskip('numba')
+    import numba_backend
+
+    population = make_population()
+    #lay out copies side by side, as infect does for ensemble replicas
+    replicas = np.concatenate([population] * 50)
+    replicas[:,1] += np.repeat(np.arange(50), len(population)) * 3.0
+    infected = np.flatnonzero(replicas[:,6] == 1)
+    healthy = np.flatnonzero(replicas[:,6] == 0)
+    assert np.array_equal(numba_backend.count_exposures(replicas, infected, healthy, 0.03),
+                          np.tile(brute_force_exposures(population, 0.03), 50))
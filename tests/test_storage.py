@@ -0,0 +1,165 @@
+'''
+tests writing and reading back snapshot and run stores
+'''
+
+import os
+
+import numpy as np
+import pytest
+
+from config import Configuration
+from population import Columnar_population
+from simulation import Simulation
+from storage import Run_store, Snapshot_store, new_run_path
+
+
+def test_snapshot_store_round_trip(tmp_path):
+    path = str(tmp_path / 'population.snap')
+    store = Snapshot_store(path, pop_size = 50, capacity = 2)
+    snapshots = [np.random.uniform(size = (50, 15)) for frame in range(5)]
+    for frame, snapshot in enumerate(snapshots):
+        store.append(snapshot, frame * 10)
+    store.close()
+
+    store = Snapshot_store(path, mode = 'r')
+    assert len(store) == 5
+    assert store.capacity == 8
+    assert np.array_equal(store.frames, [0, 10, 20, 30, 40])
+    assert np.array_equal(store.get_frame(30), snapshots[3])
+    assert np.array_equal(store[:, :, 6], np.stack(snapshots)[:, :, 6])
+    with pytest.raises(KeyError):
+        store.get_frame(35)
+
+    #appending to an existing store
+    store = Snapshot_store(path, mode = 'r+')
+    store.append(snapshots[0], 50)
+    store.close()
+    assert np.array_equal(Snapshot_store(path, mode = 'r').frames[-2:], [40, 50])
+
+
+def test_snapshot_store_columnar(tmp_path):
+    population = Columnar_population(20)
+    population[:,1] = np.linspace(0, 1, 20)
+    population[:,6] = 2
+    store = Snapshot_store(str(tmp_path / 'population.snap'), pop_size = 20)
+    store.append(population, 0)
+    assert np.array_equal(store[0], np.asarray(population))
+
+
+def test_run_store_round_trip(tmp_path):
+    Config = Configuration(pop_size = 10)
+    Config.lockdown_vector = np.zeros((10,))
+    path = new_run_path(str(tmp_path))
+    store = Run_store(path, Config = Config, seed = 3, chunk_size = 16)
+    for frame in range(50):
+        store.append_row({'infectious': frame, 'fatalities': 2 * frame})
+        store.append('age_counts', np.full((3,), frame))
+    store.add_snapshot(np.ones((10, 15)), 40)
+    store.close()
+
+    store = Run_store(path, mode = 'r')
+    assert store.metadata['seed'] == 3
+    assert store.metadata['config']['pop_size'] == 10
+    assert 'lockdown_vector' not in store.metadata['config']
+    assert sorted(store.series_names) == ['age_counts', 'fatalities', 'infectious']
+    assert store.length('infectious') == 50
+    assert np.array_equal(store.get_series('infectious'), np.arange(50))
+    assert np.array_equal(store.get_series('fatalities', 10, 40), 2 * np.arange(10, 40))
+    assert store.get_series('age_counts').shape == (50, 3)
+    assert store.snapshot_frames == [40]
+    assert np.array_equal(store.get_snapshot(40), np.ones((10, 15)))
+
+
+def test_run_store_readable_without_close(tmp_path):
+    path = new_run_path(str(tmp_path))
+    store = Run_store(path, chunk_size = 16)
+    for frame in range(40):
+        store.append('infectious', frame)
+
+    #full chunks are on disk, the rest is still buffered
+    assert np.array_equal(Run_store(path, mode = 'r').get_series('infectious'), np.arange(32))
+
+    #a record cut off while being written is skipped
+    store.append('infectious', 40)
+    store.file.write(np.int64(100).tobytes())
+    store.file.flush()
+    assert Run_store(path, mode = 'r').length('infectious') == 32
+
+
+def test_run_store_is_final_once_closed(tmp_path):
+    path = new_run_path(str(tmp_path))
+    store = Run_store(path, chunk_size = 16)
+    for frame in range(40):
+        store.append('infectious', frame)
+    store.close()
+    store.close()
+    with pytest.raises(ValueError):
+        store.append('infectious', 40)
+    with pytest.raises(ValueError):
+        store.add_snapshot(np.zeros((2, 15)), 40)
+
+    store = Run_store(path, mode = 'r')
+    assert store.length('infectious') == 40
+    assert np.array_equal(store.get_series('infectious'), np.arange(40))
+
+
+def test_new_run_path_is_unique(tmp_path):
+    paths = [new_run_path(str(tmp_path)) for run in range(3)]
+    paths += [new_run_path(str(tmp_path), 'population', 'snap') for run in range(2)]
+    assert len(set(paths)) == 5
+    assert all(os.path.isfile(path) for path in paths)
+
+
+def test_simulation_snapshots_per_run(tmp_path):
+    paths = []
+    for run in range(2):
+        np.random.seed(run)
+        sim = Simulation(pop_size = 50, visualise = False, verbose = False,
+                         save_pop = True, save_pop_freq = 5, save_pop_folder = str(tmp_path))
+        for frame in range(100):
+            sim.tstep()
+        sim.snapshots.close()
+        paths.append(sim.snapshots.path)
+
+    assert paths[0] != paths[1]
+    store = Snapshot_store(paths[0], mode = 'r')
+    assert len(store) == 20
+    #starts small, grows as needed
+    assert store.capacity == 32
+
+
+def test_results_snapshots_need_save_data(tmp_path):
+    sim = Simulation(pop_size = 50, visualise = False, verbose = False, save_pop = True,
+                     save_pop_format = 'results', save_pop_folder = str(tmp_path))
+    with pytest.raises(ValueError):
+        sim.tstep()
+
+
+def test_simulation_run_closes_results_on_error(tmp_path):
+    class Failing_simulation(Simulation):
+        def callback(self):
+            if self.frame == 20:
+                raise RuntimeError('failed')
+
+    sim = Failing_simulation(pop_size = 50, visualise = False, verbose = False,
+                             save_data = True, save_data_folder = str(tmp_path))
+    with pytest.raises(RuntimeError):
+        sim.run()
+
+    assert sim.results is None
+    store = Run_store(sim.results_path, mode = 'r')
+    assert store.length('infectious') == 21
+
+
+def test_every_run_gets_its_own_results(tmp_path):
+    sim = Simulation(pop_size = 50, visualise = False, verbose = False, simulation_steps = 30,
+                     save_data = True, save_data_folder = str(tmp_path))
+    sim.run()
+    first = sim.results_path
+    sim.run()
+    assert sim.results_path != first
+
+    for path in [first, sim.results_path]:
+        store = Run_store(path, mode = 'r')
+        assert store.length('infectious') == 30
+        assert len(store.get_series('infectious')) == 30
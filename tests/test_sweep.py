@@ -0,0 +1,46 @@
+'''
+tests the parameter sweep runner
+'''
+
+import csv
+import os
+
+import numpy as np
+
+from sweep import run_single, run_sweep
+
+
+def read_summary(path):
+    with open(path, newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def test_sweep_writes_every_cell_and_resumes(tmp_path):
+    output = str(tmp_path / 'sweep')
+    summary = output + '.csv'
+    grid = {'infection_chance': [0.1, 0.5]}
+    kwargs = dict(pop_size = 100, simulation_steps = 60, infection_range = 0.05)
+    run_sweep(grid, runs = 2, output_folder = output, max_workers = 2, **kwargs)
+
+    rows = read_summary(summary)
+    assert sorted(row['infection_chance'] for row in rows) == ['0.1', '0.5']
+    for row in rows:
+        assert float(row['infected_min']) <= float(row['infected_median']) <= float(row['infected_max'])
+    assert os.path.exists(os.path.join(output, '0.5', '1_infected.npy'))
+    infected, fatalities = run_single(dict(kwargs, infection_chance = 0.5), 1)
+    assert np.array_equal(np.load(os.path.join(output, '0.5', '1_infected.npy')), infected)
+
+    #a crash after one run of the second cell: its row and other run are lost
+    with open(summary, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames = list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerow([row for row in rows if row['infection_chance'] == '0.1'][0])
+    os.remove(os.path.join(output, '0.5', '0_infected.npy'))
+    os.remove(os.path.join(output, '0.1', '0_infected.npy'))
+
+    run_sweep(grid, runs = 2, output_folder = output, max_workers = 2, **kwargs)
+    resumed = read_summary(summary)
+    assert resumed[-1] == [row for row in rows if row['infection_chance'] == '0.5'][0]
+    assert len(resumed) == 2
+    #the finished cell was not run again
+    assert not os.path.exists(os.path.join(output, '0.1', '0_infected.npy'))
@@ -0,0 +1,82 @@
+'''
+tests the renderer on a non-interactive backend
+'''
+
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+
+from config import Configuration
+from population import Population_trackers, initialize_population
+from visualiser import Renderer
+
+
+def render(**kwargs):
+    np.random.seed(0)
+    Config = Configuration(pop_size = 500, **kwargs)
+    population = initialize_population(Config)
+    population[:,6][:50] = 1
+    population[:,6][50:60] = 3
+    tracker = Population_trackers()
+    tracker.add_counts(len(population), 50, 0, 10)
+    renderer = Renderer(Config)
+    renderer.draw(population, tracker, 0)
+    renderer.fig.canvas.draw()
+    return renderer
+
+
+def test_status_text_overlaps_no_title():
+    renderer = render()
+    canvas = renderer.fig.canvas.get_renderer()
+    status = renderer.text.get_window_extent(canvas)
+    assert renderer.text.get_text().endswith('healthy: 440 infected: 50 immune: 0 fatalities: 10')
+    for ax in [renderer.ax1, renderer.ax2]:
+        title = ax.title
+        if title.get_text():
+            assert not status.overlaps(title.get_window_extent(canvas))
+
+
+def test_frames_reuse_the_same_artists():
+    renderer = render(render_mode = 'scatter')
+    artists = len(renderer.ax1.get_children()) + len(renderer.ax2.get_children())
+    scatters = list(renderer.scatters)
+    np.random.seed(1)
+    population = initialize_population(renderer.Config)
+    tracker = Population_trackers()
+    for frame in range(5):
+        tracker.add_counts(len(population), frame, 0, 0)
+        renderer.draw(population, tracker, frame)
+
+    assert renderer.scatters == scatters
+    assert len(renderer.ax1.get_children()) + len(renderer.ax2.get_children()) == artists
+    assert len(renderer.scatters[0].get_offsets()) == len(population)
+    assert dict(renderer.lines)['infectious'].get_ydata().tolist() == [0, 1, 2, 3, 4]
+
+
+def test_raster_mode_is_picked_by_population_size():
+    assert not render().raster
+    assert render(raster_threshold = 500).raster
+    assert not render(render_mode = 'scatter', raster_threshold = 500).raster
+
+
+def test_raster_counts_everyone_per_state():
+    renderer = render(render_mode = 'raster')
+    population = initialize_population(renderer.Config)
+    population[:,6][:100] = 1
+    assert renderer.draw_raster(population).tolist() == [400, 100, 0, 0]
+    alpha = renderer.pixels[...,3]
+    assert 0 < alpha.max() <= 1
+
+    #a cell holding only infected has the colour of the infected
+    cell_x = int((population[0,1] - renderer.Config.x_plot[0]) / renderer.cell_size)
+    cell_y = int((population[0,2] - renderer.Config.y_plot[0]) / renderer.cell_size)
+    population[:,6] = 1
+    renderer.draw_raster(population)
+    assert np.allclose(renderer.pixels[cell_y, cell_x, :3], renderer.colors[1])
+
+
+def test_raster_uses_the_colorblind_palette():
+    Config = Configuration(colorblind_mode = True)
+    renderer = render(render_mode = 'raster', colorblind_mode = True)
+    assert np.allclose(renderer.colors, matplotlib.colors.to_rgba_array(Config.get_palette())[:,:3])
+    assert not np.allclose(renderer.colors, render(render_mode = 'raster').colors)
@@ -7,6 +7,7 @@ import matplotlib as mpl
 import numpy as np
 
 from environment import build_hospital
+from population import get_indices
 from utils import check_folder
 
 def set_style(Config):
@@ -37,91 +38,203 @@ def build_fig(Config, figsize=(5,7)):
     return fig, spec, ax1, ax2
 
 
-def draw_tstep(Config, population, pop_tracker, frame,
-               fig, spec, ax1, ax2):
-    #construct plot and visualise
+class Renderer():
+    '''draws the simulation every timestep, reusing its artists
 
-    #set plot style
-    set_style(Config)
+    The figure is built once (see build_fig), together with everything that
+    does not change: the title of the lines, axis limits, the hospital and walls, the
+    healthcare capacity line, the legend and the watermark. Each timestep,
+    only the positions and colours of the population scatter, the status
+    text and the data of the lines are updated.
 
-    #get color palettes
-    palette = Config.get_palette()
+    If the canvas supports it, blitting is used: the static part is drawn
+    once and stored, and each timestep it is restored and only the changing
+    artists are drawn on top of it. The stored background is taken again
+    whenever the whole figure is redrawn, for example when the window is
+    resized, or when the lines reach the end of the time axis, which is then
+    doubled in length.
 
-    spec = fig.add_gridspec(ncols=1, nrows=2, height_ratios=[5,2])
-    ax1.clear()
-    ax2.clear()
+    Large populations are drawn as a density raster rather than a scatter
+    (see Config.render_mode): the plot is divided into a grid of cells,
+    everyone is counted per state and cell with a single bincount, and each
+    cell is coloured by mixing the palette colours of the states in it, more
+    opaque the more people it holds. The result is shown as one image.
 
-    ax1.set_xlim(Config.x_plot[0], Config.x_plot[1])
-    ax1.set_ylim(Config.y_plot[0], Config.y_plot[1])
+    Keyword arguments
+    -----------------
+    Config : Configuration
+        the configuration of the simulation
+
+    environment : Environment or None
+        walls to draw, if any
+    '''
+    def __init__(self, Config, environment=None):
+        self.Config = Config
+        self.fig, self.spec, self.ax1, self.ax2 = build_fig(Config)
+        palette = Config.get_palette()
+
+        #static artists
+        self.ax1.set_xlim(Config.x_plot[0], Config.x_plot[1])
+        self.ax1.set_ylim(Config.y_plot[0], Config.y_plot[1])
+        if environment is not None:
+            environment.draw(self.ax1)
+        #the isolation area is drawn with the walls if it has them
+        walled = environment is not None and 'isolation' in environment.zone_names
+        if Config.self_isolate and Config.isolation_bounds != None and not walled:
+            build_hospital(Config.isolation_bounds[0], Config.isolation_bounds[2],
+                           Config.isolation_bounds[1], Config.isolation_bounds[3], self.ax1,
+                           addcross = False)
+        #the status text takes the place of the title above the population
+        self.ax1.set_title('')
+
+        self.ax2.text(0, Config.pop_size * 0.05,
+                      'https://github.com/paulvangentcom/python-corona-simulation',
+                      fontsize=6, alpha=0.5, transform=self.ax2.get_yaxis_transform())
+        self.ax2.set_ylim(0, Config.pop_size + 200)
+        self.ax2.set_xlim(0, 500)
+        if Config.treatment_dependent_risk:
+            self.ax2.axhline(Config.healthcare_capacity, color='r', linestyle=':',
+                             label='healthcare capacity')
+
+        #changing artists, only drawn when blitting
+        self.blit = self.fig.canvas.supports_blit
+        if Config.render_mode == 'auto':
+            self.raster = Config.pop_size >= Config.raster_threshold
+        else:
+            self.raster = Config.render_mode == 'raster'
+
+        if self.raster:
+            #square cells, raster_resolution along the longest side
+            width = Config.x_plot[1] - Config.x_plot[0]
+            height = Config.y_plot[1] - Config.y_plot[0]
+            self.cell_size = max(width, height) / Config.raster_resolution
+            self.nx = max(int(np.ceil(width / self.cell_size)), 1)
+            self.ny = max(int(np.ceil(height / self.cell_size)), 1)
+            self.colors = mpl.colors.to_rgba_array(palette)[:,:3]
+            #cells reach full opacity at this many people
+            self.saturation = max(4 * Config.pop_size / (self.nx * self.ny), 2)
+            self.pixels = np.zeros((self.ny, self.nx, 4))
+            self.image = self.ax1.imshow(self.pixels, origin='lower', interpolation='nearest',
+                                         extent=[Config.x_plot[0], Config.x_plot[0] + self.nx * self.cell_size,
+                                                 Config.y_plot[0], Config.y_plot[0] + self.ny * self.cell_size],
+                                         animated = self.blit)
+            self.ax1.set_xlim(Config.x_plot[0], Config.x_plot[1])
+            self.ax1.set_ylim(Config.y_plot[0], Config.y_plot[1])
+            self.ax1.set_aspect('auto')
+            self.people = [self.image]
+        else:
+            #one scatter per state, a single colour per collection is much faster to draw
+            self.scatters = [self.ax1.scatter(np.zeros((0,)), np.zeros((0,)), color=palette[state], s = 2,
+                                              animated = self.blit) for state in range(4)]
+            self.people = self.scatters
+        self.text = self.ax1.text(Config.x_plot[0],
+                                  Config.y_plot[1] + ((Config.y_plot[1] - Config.y_plot[0]) / 100),
+                                  '', fontsize=6, animated = self.blit)
+        if Config.plot_mode.lower() == 'default':
+            series = [['infectious', palette[1], None], ['fatalities', palette[3], 'fatalities']]
+        elif Config.plot_mode.lower() == 'sir':
+            series = [['susceptible', palette[0], 'susceptible'], ['infectious', palette[1], 'infectious'],
+                      ['recovered', palette[2], 'recovered'], ['fatalities', palette[3], 'fatalities']]
+        else:
+            raise ValueError('incorrect plot_style specified, use \'sir\' or \'default\'')
+        self.lines = [[name, self.ax2.plot([], [], color=color, label=label, animated = self.blit)[0]]
+                      for name, color, label in series]
+        self.ax2.legend(loc = 'best', fontsize = 6)
+
+        self.animated = self.people + [self.text] + [line for name, line in self.lines]
+        self.background = None
+        self.saving = False
+        self.fig.canvas.mpl_connect('draw_event', self.on_draw)
+        plt.show(block = False)
+
+
+    def on_draw(self, event):
+        '''stores the static part of the figure after each full redraw'''
+        if self.blit and not self.saving:
+            self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+            for artist in self.animated:
+                self.fig.draw_artist(artist)
+
+
+    def draw_raster(self, population):
+        '''updates the density raster, returns the number of people per state'''
+        Config = self.Config
+        cells = self.nx * self.ny
+        cx = np.clip(((population[:,1] - Config.x_plot[0]) / self.cell_size).astype(np.int64),
+                     0, self.nx - 1)
+        cy = np.clip(((population[:,2] - Config.y_plot[0]) / self.cell_size).astype(np.int64),
+                     0, self.ny - 1)
+        #count everyone per state and cell at once, states beyond 3 are not drawn
+        keys = population[:,6].astype(np.int64) * cells + cy * self.nx + cx
+        counts = np.bincount(keys, minlength = 5 * cells)[:4 * cells].reshape(4, self.ny, self.nx)
+
+        total = counts.sum(axis=0)
+        occupied = np.maximum(total, 1)
+        for channel in range(3):
+            self.pixels[...,channel] = np.tensordot(self.colors[:,channel], counts, axes=1) / occupied
+        self.pixels[...,3] = np.clip(np.log1p(total) / np.log1p(self.saturation), 0, 1)
+        self.image.set_data(self.pixels)
+        return counts.reshape(4, -1).sum(axis=1)
+
+
+    def draw(self, population, pop_tracker, frame, registry=None):
+        '''updates the figure to the current timestep
+
+        Keyword arguments
+        -----------------
+        population : ndarray
+            the array containing all the population information
+
+        pop_tracker : Population_trackers
+            the population tracker, for the lines
+
+        frame : int
+            the current timestep
+
+        registry : State_registry or None
+            used to find who is in which state if given
+        '''
+        if self.raster:
+            counts = self.draw_raster(population)
+        else:
+            counts = []
+            for state, scatter in enumerate(self.scatters):
+                ids = get_indices(population, state, registry)
+                scatter.set_offsets(np.column_stack([population[:,1][ids], population[:,2][ids]]))
+                counts.append(len(ids))
+
+        self.text.set_text('timestep: %i, total: %i, healthy: %i infected: %i immune: %i fatalities: %i'
+                           %(frame, len(population), counts[0], counts[1], counts[2], counts[3]))
+
+        for name, line in self.lines:
+            data = getattr(pop_tracker, name)
+            line.set_data(np.arange(len(data)), data)
+
+        #the time axis is full: make it longer and redraw everything
+        if len(pop_tracker.infectious) >= self.ax2.get_xlim()[1]:
+            self.ax2.set_xlim(0, max(self.ax2.get_xlim()[1] * 2, len(pop_tracker.infectious)))
+            self.fig.canvas.draw()
+        elif self.blit and self.background is not None:
+            self.fig.canvas.restore_region(self.background)
+            for artist in self.animated:
+                self.fig.draw_artist(artist)
+            self.fig.canvas.blit(self.fig.bbox)
+        else:
+            self.fig.canvas.draw()
+        self.fig.canvas.flush_events()
+
+        if self.Config.save_plot:
+            #animated artists are left out of full draws, so include them while saving
+            self.saving = True
+            for artist in self.animated:
+                artist.set_animated(False)
+            check_folder(self.Config.plot_path)
+            self.fig.savefig('%s/%i.png' %(self.Config.plot_path, frame))
+            for artist in self.animated:
+                artist.set_animated(self.blit)
+            self.saving = False
 
-    if Config.self_isolate and Config.isolation_bounds != None:
-        build_hospital(Config.isolation_bounds[0], Config.isolation_bounds[2],
-                       Config.isolation_bounds[1], Config.isolation_bounds[3], ax1,
-                       addcross = False)
-        
-    #plot population segments
-    healthy = population[population[:,6] == 0][:,1:3]
-    ax1.scatter(healthy[:,0], healthy[:,1], color=palette[0], s = 2, label='healthy')
-    
-    infected = population[population[:,6] == 1][:,1:3]
-    ax1.scatter(infected[:,0], infected[:,1], color=palette[1], s = 2, label='infected')
 
-    immune = population[population[:,6] == 2][:,1:3]
-    ax1.scatter(immune[:,0], immune[:,1], color=palette[2], s = 2, label='immune')
-    
-    fatalities = population[population[:,6] == 3][:,1:3]
-    ax1.scatter(fatalities[:,0], fatalities[:,1], color=palette[3], s = 2, label='dead')
-        
-    
-    #add text descriptors
-    ax1.text(Config.x_plot[0], 
-             Config.y_plot[1] + ((Config.y_plot[1] - Config.y_plot[0]) / 100), 
-             'timestep: %i, total: %i, healthy: %i infected: %i immune: %i fatalities: %i' %(frame,
-                                                                                             len(population),
-                                                                                             len(healthy), 
-                                                                                             len(infected), 
-                                                                                             len(immune), 
-                                                                                             len(fatalities)),
-                fontsize=6)
-    
-    ax2.set_title('number of infected')
-    ax2.text(0, Config.pop_size * 0.05, 
-                'https://github.com/paulvangentcom/python-corona-simulation',
-                fontsize=6, alpha=0.5)
-    #ax2.set_xlim(0, simulation_steps)
-    ax2.set_ylim(0, Config.pop_size + 200)
-
-    if Config.treatment_dependent_risk:
-        infected_arr = np.asarray(pop_tracker.infectious)
-        indices = np.argwhere(infected_arr >= Config.healthcare_capacity)
-
-        ax2.plot([Config.healthcare_capacity for x in range(len(pop_tracker.infectious))], 
-                 'r:', label='healthcare capacity')
-
-    if Config.plot_mode.lower() == 'default':
-        ax2.plot(pop_tracker.infectious, color=palette[1])
-        ax2.plot(pop_tracker.fatalities, color=palette[3], label='fatalities')
-    elif Config.plot_mode.lower() == 'sir':
-        ax2.plot(pop_tracker.susceptible, color=palette[0], label='susceptible')
-        ax2.plot(pop_tracker.infectious, color=palette[1], label='infectious')
-        ax2.plot(pop_tracker.recovered, color=palette[2], label='recovered')
-        ax2.plot(pop_tracker.fatalities, color=palette[3], label='fatalities')
-    else:
-        raise ValueError('incorrect plot_style specified, use \'sir\' or \'default\'')
-
-    ax2.legend(loc = 'best', fontsize = 6)
-    
-    plt.draw()
-    plt.pause(0.0001)
-
-    if Config.save_plot:
-        try:
-            plt.savefig('%s/%i.png' %(Config.plot_path, frame))
-        except:
-            check_folder(Config.plot_path)
-            plt.savefig('%s/%i.png' %(Config.plot_path, frame))
-       
-            
 def plot_sir(Config, pop_tracker, size=(6,3), include_fatalities=False,
              title='S-I-R plot of simulation'):
     '''plots S-I-R parameters in the population tracker
@@ -168,3 +281,77 @@ def plot_sir(Config, pop_tracker, size=(6,3), include_fatalities=False,
     
     #initialise
     plt.show()
+
+
+def plot_sir_by_age(Config, pop_tracker, size=(9,6), include_fatalities=False,
+                    title='S-I-R plot per age cohort'):
+    '''plots S-I-R parameters for each age cohort in the population tracker
+
+    Draws one panel per age cohort, with the fraction of the cohort in
+    each state over time. Needs the tracker to record age cohorts, see
+    Population_trackers.track_age_cohorts (or set Config.track_age_cohorts).
+
+    Keyword arguments
+    -----------------
+    Config : class
+        the configuration class
+
+    pop_tracker : Population_trackers
+        the population tracker, recording age cohorts
+
+    size : tuple
+        size at which the plot will be initialised (default: (9,6))
+
+    include_fatalities : bool
+        whether to plot the fatalities as well (default: False)
+    '''
+    if pop_tracker.age_counts is None:
+        raise ValueError('the population tracker does not record age cohorts')
+
+    #set plot style
+    set_style(Config)
+
+    #get color palettes
+    palette = Config.get_palette()
+
+    age_counts = pop_tracker.age_counts
+    age_bins = pop_tracker.age_bins
+    cohort_sizes = np.maximum(age_counts[0].sum(axis=1), 1)
+
+    columns = int(np.ceil(np.sqrt(len(age_bins))))
+    rows = int(np.ceil(len(age_bins) / columns))
+    fig, axes = plt.subplots(rows, columns, figsize=size, sharex=True, sharey=True,
+                             squeeze=False)
+    fig.suptitle(title)
+
+    for cohort, ax in enumerate(axes.ravel()):
+        if cohort >= len(age_bins):
+            ax.set_visible(False)
+            continue
+        if cohort == len(age_bins) - 1:
+            label = '%i+' %age_bins[cohort]
+        else:
+            label = '%i-%i' %(age_bins[cohort], age_bins[cohort + 1] - 1)
+
+        fractions = age_counts[:,cohort] / cohort_sizes[cohort]
+        ax.set_title('age %s (%i people)' %(label, age_counts[0, cohort].sum()))
+        ax.plot(fractions[:,0], color=palette[0], label='susceptible')
+        ax.plot(fractions[:,1] + fractions[:,4], color=palette[1], label='infectious')
+        ax.plot(fractions[:,2], color=palette[2], label='recovered')
+        if include_fatalities:
+            ax.plot(fractions[:,3], color=palette[3], label='fatalities')
+
+    #add axis labels
+    for ax in axes[-1]:
+        ax.set_xlabel('time in hours')
+    for ax in axes[:,0]:
+        ax.set_ylabel('fraction of cohort')
+
+    #add legend
+    axes[0,0].legend()
+
+    #beautify
+    plt.tight_layout()
+
+    #initialise
+    plt.show()